@@ -1,13 +1,32 @@
 #!/usr/bin/env python3
+import calendar
+import concurrent.futures
 import datetime
+import functools
+import itertools
+import json
+import time
 from logging import getLogger, StreamHandler, INFO, ERROR
 
-import boto3
-from mackerel.clienthde import Client
-
 from cli import Cli
+import checkpoint
+import columnar
+import engine
+import events
+import instrument
+import listing
+import logs
 import metric
+import partials
+import poster
 import query
+import resolver
+import segments
+import sinks
+import sketch
+import spec
+import topk
+import window
 
 handler = StreamHandler()
 handler.setLevel(ERROR)
@@ -17,20 +36,36 @@ logger.setLevel(ERROR)
 logger.addHandler(handler)
 logger.propagate = False
 
+# Run summaries of the instrumentation, one JSON line per run
+instrument_handler = StreamHandler()
+instrument_logger = getLogger("alb-accesslog-aggregator.instrument")
+instrument_logger.setLevel(INFO)
+instrument_logger.addHandler(instrument_handler)
+instrument_logger.propagate = False
+
 # Disable boto verbose log
 getLogger("boto3").setLevel(ERROR)
 getLogger("botocore").setLevel(ERROR)
 
-IGNORE_DELAY_BEFORE = 420  # Ignore bucket objects before 7 Min.
 INTERVAL_SECONDS = 60  # 1 Min. (mackerel.io can support metric point)
+ENGINES = ("s3select", "projection", "local", "numpy")
+S3_MAX_POOL_CONNECTIONS = 10  # botocore default
+
+# Kept in module scope, so warm Lambda containers reuse the clients and their
+# connections. (Mackerel API key, region, S3 pool size) -> clients
+_clients = {}
 
 
 def execute_query_alb_log(s3_client=None, bucket=None, key=None, query=None):
+    """Run `query` on the object and return a generator of its output lines.
+
+    Lines are decoded as the response streams in, so the output is never
+    held whole.
+    """
     if bucket is None or key is None or query is None:
         return None
 
-    records = []
-
+    began = time.perf_counter()
     resp = s3_client.select_object_content(
         Bucket=bucket,
         Key=key,
@@ -53,19 +88,224 @@ def execute_query_alb_log(s3_client=None, bucket=None, key=None, query=None):
             }
         },
     )
-    for event in resp["Payload"]:
+    # Records stream in as they are scanned, so the query is timed until the
+    # response is drained rather than only the request
+    payload = resp["Payload"]
+    if instrument.recorder.enabled:
+        payload = instrument.timed(
+            payload, "query", seconds=time.perf_counter() - began
+        )
+    lines = logs.stream_lines(select_payloads(payload, key=key))
+    if instrument.recorder.enabled:
+        lines = instrument.counted(lines, "records.returned", key=key)
+    return lines
+
+
+def select_payloads(events, key=None):
+    """Yield the payloads of the `Records` events of an S3 Select response.
+
+    A complete response ends with an `End` event. One cut short raises
+    IOError rather than passing for an object with fewer records.
+    """
+    end = False
+    for event in events:
         if "Records" in event:
-            records.append(event["Records"]["Payload"].decode("utf-8"))
+            yield event["Records"]["Payload"]
+        elif "Stats" in event:
+            details = event["Stats"]["Details"]
+            instrument.count("bytes.scanned", details["BytesScanned"], key=key)
+            instrument.count("bytes.processed", details["BytesProcessed"], key=key)
+            instrument.count("bytes.returned", details["BytesReturned"], key=key)
+        elif "End" in event:
+            end = True
+    if not end:
+        raise IOError(
+            "S3 Select response of {key} ended without End event".format(key=key)
+        )
+
+
+def aggregate_select(
+    s3_client=None, bucket=None, key=None, items=None, query="", timestamp=None
+):
+    """Run the S3 Select `query` of `Builder.selects` and return the metrics of its `items`."""
+    metrics = metric.Metrics()
+    lines = execute_query_alb_log(
+        s3_client=s3_client, bucket=bucket, key=key, query=query
+    )
+    types = tuple(float for _, q in items for _ in q["select"])
+    for row in logs.parse_rows(lines, types=types):
+        row = iter(row)
+        for host_id, q in items:
+            if q["aggregate"] == "distribution":
+                # SUM, COUNT, MIN and MAX; all but COUNT are empty for no record
+                total, count, minimum, maximum = [next(row) for _ in q["select"]]
+                value = sketch.Sketch()
+                if count:
+                    value = sketch.Sketch.from_summary(
+                        count=int(count), total=total, minimum=minimum, maximum=maximum
+                    )
+                metrics.add_distribution(
+                    host_id=host_id,
+                    name=q["name"],
+                    timestamp=timestamp,
+                    value=value,
+                    statistics=q["statistics"],
+                )
+                continue
+            # An aggregate of no record is empty
+            value = next(row)
+            metrics.add(
+                host_id=host_id,
+                name=q["name"],
+                timestamp=timestamp,
+                value=value if value is not None else 0.0,
+            )
+    return metrics
+
+
+def aggregate_object(
+    s3_client=None,
+    bucket=None,
+    key=None,
+    engine_name="local",
+    queries=None,
+    projection="",
+    windows=None,
+    cache=None,
+    etag="",
+    top=None,
+    extra=None,
+    log_cache=None,
+):
+    """Aggregate the object `key` into `windows` and return the metrics.
+
+    With `cache`, the windows are merged from the per-minute partials of the
+    object, computed and cached the first time the object is seen. `projection`
+    has to select every record then. With `top` and `extra`, the records of
+    each window are also summarized by a `top()` and an `extra()`, and
+    `projection` has to select the fields of `engine.columns` for them. With
+    `log_cache`, the `local` and `numpy` engines read the records from the
+    segment of the object, written the first time the object is seen.
+    """
+    metrics = metric.Metrics()
+    with instrument.timer("object"):
+        if cache is not None:
+            p = cache.get(key=key, etag=etag)
+            if p is None:
+                p = summarize_object(
+                    s3_client=s3_client,
+                    bucket=bucket,
+                    key=key,
+                    engine_name=engine_name,
+                    projection=projection,
+                )
+                cache.put(key=key, etag=etag, partials=p)
+            summaries = [p.window(w) for w in windows]
+        elif log_cache is not None and engine_name in ("local", "numpy"):
+            segment = log_cache.get(key=key, etag=etag)
+            if segment is None:
+                segment = log_cache.put(
+                    key=key,
+                    etag=etag,
+                    records=logs.read_object(
+                        s3_client=s3_client,
+                        bucket=bucket,
+                        key=key,
+                        columns=segments.COLUMNS,
+                    ),
+                )
+            if segment is None:
+                # Not written to the cache, read the object again
+                aggregate = (
+                    columnar.aggregate_numpy
+                    if engine_name == "numpy"
+                    else engine.aggregate_local
+                )
+                summaries = aggregate(
+                    s3_client=s3_client,
+                    bucket=bucket,
+                    key=key,
+                    windows=windows,
+                    top=top,
+                    extra=extra,
+                )
+            else:
+                with segment:
+                    summaries = segments.summarize(
+                        segment, windows, engine_name=engine_name, top=top, extra=extra
+                    )
+        elif engine_name == "projection":
+            records = execute_query_alb_log(
+                s3_client=s3_client, bucket=bucket, key=key, query=projection
+            )
+            summaries = engine.summarize(
+                logs.parse_projection(
+                    records, columns=engine.columns(top=top, extra=extra)
+                ),
+                windows,
+                top=top,
+                extra=extra,
+            )
+        elif engine_name == "numpy":
+            summaries = columnar.aggregate_numpy(
+                s3_client=s3_client,
+                bucket=bucket,
+                key=key,
+                windows=windows,
+                top=top,
+                extra=extra,
+            )
+        else:
+            summaries = engine.aggregate_local(
+                s3_client=s3_client,
+                bucket=bucket,
+                key=key,
+                windows=windows,
+                top=top,
+                extra=extra,
+            )
+        engine.collect(
+            metrics=metrics, queries=queries, windows=windows, summaries=summaries
+        )
+    return metrics
 
-    return records
 
+def summarize_object(
+    s3_client=None, bucket=None, key=None, engine_name="local", projection=""
+):
+    """Summarize every record of the object `key` into partials.Partials."""
+    if engine_name == "projection":
+        records = execute_query_alb_log(
+            s3_client=s3_client, bucket=bucket, key=key, query=projection
+        )
+        return partials.summarize(logs.parse_projection(records))
+    records = logs.read_object(s3_client=s3_client, bucket=bucket, key=key)
+    if engine_name == "numpy":
+        return columnar.summarize_slots(records)
+    return partials.summarize(records)
+
+
+def run_tasks(tasks, workers=1):
+    """Run `tasks` and merge the metrics they return.
+
+    Results are merged in the order of `tasks` regardless of which worker
+    finishes first, so the posted values do not depend on scheduling.
+    """
+    metrics = metric.Metrics()
+    if workers <= 1:
+        for task in tasks:
+            metrics.merge(task())
+        return metrics
 
-def get_instance_private_ip(ec2_client=None, instance_id=""):
-    resp = ec2_client.describe_instances(InstanceIds=[instance_id])
-    return resp["Reservations"][-1]["Instances"][-1]["PrivateIpAddress"]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(task) for task in tasks]
+        for future in futures:
+            metrics.merge(future.result())
+    return metrics
 
 
-def main():
+def main(event=None):
+    """Aggregate the windows of the schedule, or the objects notified by `event`."""
     # Parse environment variable
     cli = Cli()
     if cli.verbose:
@@ -73,38 +313,129 @@ def main():
         logger.setLevel(INFO)
         getLogger("boto3").setLevel(INFO)
         getLogger("botocore").setLevel(INFO)
+    if cli.engine not in ENGINES:
+        logger.error("Aggregator does not support engine: " + cli.engine)
+        exit(1)
+    for name in cli.sinks:
+        if name not in sinks.SINKS:
+            logger.error("Aggregator does not support sink: " + name)
+            exit(1)
+    if cli.engine == "numpy" and not columnar.available():
+        logger.error("Engine `numpy` requires numpy to be installed")
+        exit(1)
+    for field in cli.topk_fields:
+        if field not in topk.FIELDS:
+            logger.error("Aggregator does not support top-K field: " + field)
+            exit(1)
+    metric_spec, err = spec.load(cli.metric_spec)
+    if err is not None:
+        logger.error("Aggregator failed to load the metric spec: " + err)
+        exit(1)
 
-    mkr = Client(mackerel_api_key=cli.mackerel_apikey)
+    if cli.windowing not in window.WINDOWINGS:
+        logger.error("Aggregator does not support windowing: " + cli.windowing)
+        exit(1)
+    if cli.windowing == "watermark" and cli.checkpoint == "":
+        logger.error("Windowing `watermark` requires a checkpoint")
+        exit(1)
+    if event is not None and cli.checkpoint == "":
+        logger.error("Aggregating notified objects requires a checkpoint")
+        exit(1)
 
     now = datetime.datetime.utcnow()
     # Cutting off secs. and microsecs.
     now = now - datetime.timedelta(seconds=now.second, microseconds=now.microsecond)
-    if now.minute % 5 != 1:
+    # The watermark decides which windows are complete, on any schedule
+    if event is None and cli.windowing == "schedule" and now.minute % 5 != 1:
         logger.error("Aggregator must be executed x1 or x6 minutes")
         exit(1)
-    sts = boto3.client("sts")
-    aws_account_id = sts.get_caller_identity()["Account"]
 
-    region = cli.region
-    load_balancer_name = cli.load_balancer_name
-    prefix = cli.prefix
-    duration = cli.duration
+    instrument.start(enabled=cli.instrument)
+    run(
+        cli=cli,
+        clients=create_clients(cli=cli),
+        now=now,
+        event=event,
+        metric_spec=metric_spec,
+    )
+    if cli.instrument:
+        instrument_logger.info(
+            json.dumps(
+                instrument.log_entry(
+                    load_balancer_names=cli.load_balancer_names,
+                    load_balancer_tags=cli.load_balancer_tags,
+                    engine=cli.engine,
+                    time=now.strftime(window.TIMESTAMP_FORMAT),
+                ),
+                sort_keys=True,
+            )
+        )
+
+
+def s3_client(region="", workers=1):
+    # Imported on first use, as the slowest part of a cold start
+    import boto3
+    from botocore.config import Config
+
+    # Every worker may hold an S3 connection while waiting on S3 Select
+    return boto3.client(
+        "s3",
+        region,
+        config=Config(
+            max_pool_connections=max(S3_MAX_POOL_CONNECTIONS, workers),
+            retries={"max_attempts": 5},
+        ),
+    )
+
+
+def create_clients(cli=None):
+    """Return the clients of `cli`, created once per container."""
+    # Shared by the load balancers aggregated concurrently
+    pool = cli.workers * cli.load_balancer_workers
+    key = (cli.mackerel_apikey, cli.region, pool)
+    if key not in _clients:
+        import boto3
+        from mackerel.clienthde import Client
+
+        _clients[key] = {
+            "mackerel": Client(mackerel_api_key=cli.mackerel_apikey),
+            "sts": boto3.client("sts"),
+            "s3": s3_client(region=cli.region, workers=pool),
+            "ec2": boto3.client("ec2", cli.region),
+            "elbv2": boto3.client("elbv2", cli.region),
+        }
+    return _clients[key]
+
+
+def summarizers(cli=None, queries=None, breakdowns=None):
+    """Return the `top` and `extra` factories summarizing each window for `queries`, or None."""
+    # Records are broken down by a new topk.Breakdown per window
+    top = None
+    if len(breakdowns or []) > 0:
+        top = functools.partial(
+            topk.Breakdown,
+            fields=breakdowns,
+            capacity=cli.topk_capacity,
+            patterns=topk.patterns(cli.topk_path_patterns or topk.PATH_PATTERNS),
+        )
+    # Series of the spec engine.Summary does not count, by a new spec.Extras per window
+    extra = None
+    if len(spec.extras(queries)) > 0:
+        extra = functools.partial(spec.Extras, series=spec.extras(queries))
+    return top, extra
 
-    s3 = boto3.client("s3", region)
-    ec2 = boto3.client("ec2", region)
-    elbv2 = boto3.client("elbv2", region)
 
-    # Get load balancer arn
-    load_balancer_arn = elbv2.describe_load_balancers(Names=[load_balancer_name])[
-        "LoadBalancers"
-    ][-1]["LoadBalancerArn"]
+def load_balancer(elbv2_client=None, name=""):
+    """Return the ARN, log bucket and log prefix of the load balancer `name`."""
+    arn = elbv2_client.describe_load_balancers(Names=[name])["LoadBalancers"][-1][
+        "LoadBalancerArn"
+    ]
 
-    # Get S3 Log bucket objects
     bucket = ""
-    bucket_prefix = ""
-    attributes = elbv2.describe_load_balancer_attributes(
-        LoadBalancerArn=load_balancer_arn
-    )["Attributes"]
+    log_prefix = ""
+    attributes = elbv2_client.describe_load_balancer_attributes(LoadBalancerArn=arn)[
+        "Attributes"
+    ]
     for attr in attributes:
         if attr["Key"] == "access_logs.s3.enabled":
             if not attr["Value"]:
@@ -113,150 +444,528 @@ def main():
         if attr["Key"] == "access_logs.s3.bucket":
             bucket = attr["Value"]
         if attr["Key"] == "access_logs.s3.prefix":
-            date = (now - datetime.timedelta(seconds=60)).strftime("%Y/%m/%d")
-            bucket_prefix = "{prefix}/AWSLogs/{aws_account_id}/elasticloadbalancing/{region}/{date}/".format(
-                prefix=attr["Value"],
-                aws_account_id=aws_account_id,
-                region=region,
-                date=date,
-            )
+            log_prefix = attr["Value"]
+    return arn, bucket, log_prefix
 
-    contents = []
-    objs = s3.list_objects_v2(Bucket=bucket, Prefix=bucket_prefix, MaxKeys=1000)
-    for content in objs["Contents"]:
-        contents.append(content)
-    while True:
-        if "NextContinuationToken" in objs:
-            token = objs["NextContinuationToken"]
-            objs = s3.list_objects_v2(
-                Bucket=bucket,
-                Prefix=bucket_prefix,
-                ContinuationToken=token,
-                MaxKeys=1000,
-            )
-            for content in objs["Contents"]:
-                contents.append(content)
-        else:
-            break
 
-    # Build targets list for constructing group by target query
-    targets = []
-    # ToDo(Very low priority): support marker args
-    target_groups = elbv2.describe_target_groups(LoadBalancerArn=load_balancer_arn)[
-        "TargetGroups"
-    ]
+def load_balancer_names(cli=None, elbv2_client=None):
+    """Names in `LOAD_BALANCER_NAME` followed by those selected by `LOAD_BALANCER_TAGS`."""
+    names = list(cli.load_balancer_names)
+    if len(cli.load_balancer_tags) > 0:
+        for name in resolver.load_balancers_by_tags(
+            elbv2_client=elbv2_client, tags=cli.load_balancer_tags, ttl=cli.cache_ttl
+        ):
+            if name not in names:
+                names.append(name)
+    return names
 
-    for target_group in target_groups:
-        # For instance based target group
-        if target_group["TargetType"] == "instance":
-            health_descriptions = elbv2.describe_target_health(
-                TargetGroupArn=target_group["TargetGroupArn"]
-            )
-            for health in health_descriptions["TargetHealthDescriptions"]:
-                target = "{host}:{port}".format(
-                    host=get_instance_private_ip(
-                        ec2_client=ec2, instance_id=health["Target"]["Id"]
-                    ),
-                    port=str(health["Target"]["Port"]),
-                )
-                targets.append(target)
-        # For ip based target group
-        elif target_groups["TargetType"] == "ip":
-            for target_group in target_groups:
-                health_descriptions = elbv2.describe_target_health(
-                    TargetGroupArn=target_group["TargetGroupArn"]
-                )
-                for health in health_descriptions["TargetHealthDescriptions"]:
-                    target = "{host}:{port}".format(
-                        host=health["Target"]["Id"], port=str(health["Target"]["Port"])
-                    )
-                    targets.append(target)
 
-    metrics = metric.Metrics()
+def list_objects(
+    cli=None, clients=None, name="", aws_account_id="", start=None, end=None
+):
+    """List the log objects of the load balancer `name` that can hold records between `start` and `end`.
 
-    builder = query.Builder(
-        mackerel_apikey=cli.mackerel_apikey,
-        mackerel_service=cli.mackerel_service,
-        mackerel_role=cli.mackerel_role,
+    Return the ARN of the load balancer, its log bucket and the objects.
+    """
+    # Get load balancer arn and its S3 log bucket
+    load_balancer_arn, bucket, log_prefix = load_balancer(
+        elbv2_client=clients["elbv2"], name=name
     )
 
-    # Create mackerel graph definition
-    builder.build(prefix=prefix, alb=load_balancer_name, targets=targets, between="")
-    params = metric.create_graph_definition_param(queries=builder.queries)
-    for param in params:
-        mkr.create_graph_definition(
-            name=param["name"],
-            display_name=param["name"],
-            unit=param["unit"],
-            metrics=param["metrics"],
+    lister = listing.Listing(
+        s3_client=clients["s3"],
+        bucket=bucket,
+        prefix=log_prefix,
+        aws_account_id=aws_account_id,
+        region=cli.region,
+        load_balancer_id=listing.load_balancer_id(arn=load_balancer_arn),
+    )
+    with instrument.timer("listing"):
+        contents = lister.list(start=start, end=end)
+    logger.info(
+        "{name}: Listed {listed} keys, skipped {skipped} keys outside of {lower} - {upper}".format(
+            name=name,
+            listed=lister.listed,
+            skipped=lister.skipped,
+            lower=start.strftime(window.TIMESTAMP_FORMAT),
+            upper=end.strftime(window.TIMESTAMP_FORMAT),
         )
+    )
+    return load_balancer_arn, bucket, contents
 
-    # Aggregate s3 access log
-    for content in contents:
-        # When `LastModified` is older than `RECORD_DELAY_SECONDS` seconds ago, loop continues
-        if content["LastModified"].replace(tzinfo=None) < now - (
-            datetime.timedelta(seconds=IGNORE_DELAY_BEFORE)
-        ):
+
+def notified_objects(cli=None, clients=None, names=None, objects=None):
+    """Group the notified `objects` by load balancer, as `list_objects` returns them.
+
+    Objects of load balancers not in `names` are ignored. Load balancers are
+    described once per `cli.cache_ttl` instead of on every notification.
+    """
+    # Load balancer name -> objects, the name being in the ID in the key
+    notified = {}
+    for content in objects:
+        node = listing.key_node(content["Key"])
+        if node is None or listing.key_timestamp(content["Key"]) is None:
+            logger.info("Ignored an object not of ALB logs: " + content["Key"])
             continue
+        notified.setdefault(node[0].split(".")[1], []).append(content)
 
-        for epoch in range(1, 6):
-            to_timestamp = now - datetime.timedelta(seconds=duration * (epoch - 1) + 60)
-            from_timestamp = now - datetime.timedelta(seconds=duration * epoch + 60)
-            between = "s._2 BETWEEN '{from_timestamp}' AND '{to_timestamp}'".format(
-                from_timestamp=from_timestamp.strftime("%Y-%m-%dT%H:%M:%SZ"),
-                to_timestamp=to_timestamp.strftime("%Y-%m-%dT%H:%M:%SZ"),
-            )
-            err = builder.build(
-                prefix=prefix, alb=load_balancer_name, targets=targets, between=between
+    listed = {}
+    for name in names:
+        if name not in notified:
+            continue
+        load_balancer_arn, bucket, _ = resolver.cached(
+            ("load_balancer", name),
+            lambda: load_balancer(elbv2_client=clients["elbv2"], name=name),
+            ttl=cli.cache_ttl,
+        )
+        load_balancer_id = listing.load_balancer_id(arn=load_balancer_arn)
+        listed[name] = (
+            load_balancer_arn,
+            bucket,
+            [
+                c
+                for c in notified[name]
+                if c["Bucket"] == bucket
+                and listing.key_node(c["Key"])[0] == load_balancer_id
+            ],
+        )
+    return listed
+
+
+def aggregate_load_balancer(
+    cli=None,
+    clients=None,
+    name="",
+    aws_account_id="",
+    windows=None,
+    ckpt=None,
+    cache=None,
+    listed=None,
+    targets_ttl=0,
+    metric_spec=None,
+    log_cache=None,
+):
+    """Aggregate the logs of the load balancer `name` into `windows`.
+
+    `listed` is what `list_objects` returned for a range covering `windows`,
+    the objects are listed again if it is None. The targets are discovered
+    again once they are older than `targets_ttl`. `metric_spec` holds the
+    metrics of `spec.load`, `spec.DEFAULT` if None. Objects are cached as
+    segments in `log_cache`, if not None. Return the metrics, the keys
+    aggregated into each window and the graph definition params of the load
+    balancer; no key is aggregated when the load balancer has no query.
+    """
+    mkr = clients["mackerel"]
+    s3 = clients["s3"]
+    elbv2 = clients["elbv2"]
+    prefix = cli.prefix
+    span = window.span(windows)
+
+    if listed is None:
+        load_balancer_arn, bucket, contents = list_objects(
+            cli=cli,
+            clients=clients,
+            name=name,
+            aws_account_id=aws_account_id,
+            start=span.start,
+            end=span.end,
+        )
+    else:
+        load_balancer_arn, bucket, contents = listed
+        contents = listing.select(contents=contents, start=span.start, end=span.end)
+
+    with instrument.timer("targets"):
+        # Build targets list for constructing group by target query
+        targets = resolver.cached(
+            ("targets", load_balancer_arn),
+            lambda: resolver.targets(
+                elbv2_client=elbv2,
+                ec2_client=clients["ec2"],
+                load_balancer_arn=load_balancer_arn,
+                ttl=cli.cache_ttl,
+            ),
+            ttl=targets_ttl,
+        )
+
+        # Mackerel hosts are shared by every load balancer through the resolver cache
+        builder = query.Builder(
+            mkr_client=mkr,
+            mackerel_service=cli.mackerel_service,
+            mackerel_role=cli.mackerel_role,
+            ttl=cli.cache_ttl,
+        )
+
+    # S3 Select aggregates no quantile, only the row based engines post percentiles
+    percentiles = cli.percentiles
+    breakdowns = cli.topk_fields
+    if cli.engine == "s3select":
+        percentiles = []
+        breakdowns = []
+    err = builder.build(
+        prefix=prefix,
+        alb=name,
+        targets=targets,
+        percentiles=percentiles,
+        breakdowns=breakdowns,
+        breakdown_size=cli.topk_size,
+        metrics=metric_spec,
+    )
+    if err is not None:
+        logger.error(
+            "Aggregator failed to build queries of {name}: {err}".format(
+                name=name, err=err
             )
-            if err is not None:
-                logger.error("Aggregator failed to build queries: " + err)
+        )
+        if len(builder.queries) == 0:
+            # Nothing to aggregate, the objects are left for a later run
+            return metric.Metrics(), {}, []
+    params = metric.create_graph_definition_param(queries=builder.queries)
 
-            for query_group in builder.queries:
-                host_id = ""
-                if "host_id" in query_group:
-                    host_id = query_group["host_id"]
-                for q in query_group["query"]:
+    top, extra = summarizers(cli=cli, queries=builder.queries, breakdowns=breakdowns)
 
-                    records = execute_query_alb_log(
+    # Aggregate s3 access log
+    projection = builder.projection(
+        between=span.between, columns=engine.columns(top=top, extra=extra)
+    )
+    if cache is not None:
+        # Partials cover the whole object, not only the windows of this run
+        projection = builder.projection(between="")
+    # Window end -> S3 Select queries of every series in the window
+    selects = {}
+    if cli.engine == "s3select":
+        for w in windows:
+            selects[w.end] = builder.selects(between=w.between)
+
+    tasks = []
+    # Window end -> keys aggregated into the window by this run
+    keys = {}
+    for content in contents:
+        if ckpt is not None:
+            pending = [
+                w
+                for w in windows
+                if checkpoint.may_contain(content, w)
+                and not ckpt.done(content["Key"], w)
+            ]
+        else:
+            pending = windows
+        for w in pending:
+            keys.setdefault(w.end, []).append(content["Key"])
+
+        if cli.engine != "s3select":
+            if len(pending) == 0:
+                continue
+            tasks.append(
+                functools.partial(
+                    aggregate_object,
+                    s3_client=s3,
+                    bucket=bucket,
+                    key=content["Key"],
+                    engine_name=cli.engine,
+                    queries=builder.queries,
+                    projection=projection,
+                    windows=pending,
+                    cache=cache,
+                    etag=content["ETag"],
+                    top=top,
+                    extra=extra,
+                    log_cache=log_cache,
+                )
+            )
+            continue
+
+        for w in pending:
+            for select, items in selects[w.end]:
+                tasks.append(
+                    functools.partial(
+                        aggregate_select,
                         s3_client=s3,
                         bucket=bucket,
                         key=content["Key"],
-                        query=q["query"],
+                        items=items,
+                        query=select,
+                        timestamp=w.end,
                     )
-                    for record in records:
-                        v = record.strip()
-                        if v != "":
-                            metrics.add(
-                                host_id=host_id,
-                                name=q["name"],
-                                timestamp=to_timestamp,
-                                value=float(v),
-                            )
-                        else:
-                            metrics.add(
-                                host_id=host_id,
-                                name=q["name"],
-                                timestamp=to_timestamp,
-                                value=float(0.0),
-                            )
-    data = []
-    for m in metrics.metrics:
-        v = {
-            "hostId": m["host_id"],
-            "name": m["name"],
-            "time": m["timestamp"] - 1,
-            "value": m["value"],
-        }
-        data.append(v)
+                )
+    with instrument.timer("aggregation"):
+        metrics = run_tasks(tasks, workers=cli.workers)
+    return metrics, keys, params
+
+
+def run(cli=None, clients=None, now=None, event=None, metric_spec=None):
+    """Aggregate the windows before `now` of every load balancer and post them.
+
+    `clients` holds the `mackerel`, `sts`, `s3`, `ec2` and `elbv2` clients,
+    shared by the load balancers aggregated concurrently. With `event`, only
+    the objects it notifies are aggregated into the windows they change.
+    `metric_spec` holds the metrics posted, `spec.DEFAULT` if None.
+    """
+    mkr = clients["mackerel"]
+    aws_account_id = resolver.account_id(sts_client=clients["sts"])
+    prefix = cli.prefix
+
+    names = load_balancer_names(cli=cli, elbv2_client=clients["elbv2"])
+    if len(names) == 0:
+        logger.error("Aggregator found no load balancer to aggregate")
+        exit(1)
+
+    # Fetch the Mackerel hosts once before the load balancers look them up
+    hosts = query.Builder(
+        mkr_client=mkr,
+        mackerel_service=cli.mackerel_service,
+        mackerel_role=cli.mackerel_role,
+        ttl=cli.cache_ttl,
+    )
+    ckpt = None
+    if cli.checkpoint != "":
+        ckpt = checkpoint.Checkpoint(
+            store=checkpoint.open_store(
+                location=cli.checkpoint, s3_client=clients["s3"]
+            )
+        )
+
+    # Load balancer name -> what `list_objects` returned
+    listed = {}
+    mark = None
+    if event is not None:
+        objects = events.objects(event)
+        instrument.count("events.objects", len(objects))
+        listed = notified_objects(
+            cli=cli, clients=clients, names=names, objects=objects
+        )
+        names = [name for name in names if name in listed]
+        times = [
+            listing.key_timestamp(c["Key"])
+            for _, _, contents in listed.values()
+            for c in contents
+        ]
+        if len(times) == 0:
+            logger.info("Aggregator was notified of no object to aggregate")
+            return
+        # Windows up to the latest object notified so far are open to corrections
+        mark = max(times)
+        if ckpt.watermark is not None and ckpt.watermark > mark:
+            mark = ckpt.watermark
+        windows = window.settled(
+            watermark=mark, duration=cli.duration, lateness=cli.lateness
+        )
+        span = window.span(windows)
+        for _, _, contents in listed.values():
+            for c in contents:
+                if listing.key_timestamp(c["Key"]) < span.start:
+                    logger.info("Ignored an object older than the windows: " + c["Key"])
+                elif any(ckpt.done(c["Key"], w) for w in windows):
+                    # Redelivered, the checkpoint skips it
+                    instrument.count("events.duplicates", key=c["Key"])
+    elif cli.windowing == "watermark":
+        # Listed back to the oldest window the watermark of this run can
+        # settle, the watermark being at least `now - window.IDLE`
+        floor = now - datetime.timedelta(seconds=window.IDLE)
+        if ckpt.watermark is not None and ckpt.watermark > floor:
+            floor = ckpt.watermark
+        start = floor - datetime.timedelta(seconds=cli.lateness + cli.duration)
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(min(cli.load_balancer_workers, len(names)), 1)
+        ) as executor:
+            for name, result in zip(
+                names,
+                executor.map(
+                    lambda name: list_objects(
+                        cli=cli,
+                        clients=clients,
+                        name=name,
+                        aws_account_id=aws_account_id,
+                        start=start,
+                        end=now,
+                    ),
+                    names,
+                ),
+            ):
+                listed[name] = result
+        mark = window.watermark(
+            keys=[c["Key"] for _, _, contents in listed.values() for c in contents],
+            now=now,
+            previous=ckpt.watermark,
+        )
+        windows = window.settled(
+            watermark=mark, duration=cli.duration, lateness=cli.lateness
+        )
+        logger.info(
+            "Watermark {mark}, previously {previous}".format(
+                mark=mark.strftime(window.TIMESTAMP_FORMAT),
+                previous=(
+                    ckpt.watermark.strftime(window.TIMESTAMP_FORMAT)
+                    if ckpt.watermark is not None
+                    else "none"
+                ),
+            )
+        )
+    else:
+        windows = window.windows(now=now, duration=cli.duration, epochs=cli.epochs)
+    span = window.span(windows)
+
+    cache = None
+    if cli.partial_cache != "":
+        if len(cli.topk_fields) > 0:
+            # Heavy hitters of minutes cannot be merged into those of a window exactly
+            logger.info("Partial aggregates are not cached with top-K breakdowns")
+        elif not spec.summarized(metric_spec or spec.DEFAULT):
+            logger.info(
+                "Partial aggregates are not cached with series engine.Summary does not count"
+            )
+        elif cli.engine != "s3select" and partials.aligned(windows=windows):
+            cache = partials.Cache(
+                store=partials.open_store(
+                    location=cli.partial_cache,
+                    s3_client=clients["s3"],
+                    max_bytes=cli.partial_cache_size,
+                )
+            )
+        else:
+            logger.info(
+                "Partial aggregates are not cached for engine `s3select` or windows off the minute"
+            )
+    log_cache = None
+    if cli.log_cache != "":
+        if cli.engine in ("local", "numpy"):
+            log_cache = segments.Cache(
+                directory=cli.log_cache, max_bytes=cli.log_cache_size
+            )
+        else:
+            logger.info("Logs are only cached by the `local` and `numpy` engines")
+
+    aggregate = functools.partial(
+        aggregate_load_balancer,
+        cli,
+        clients,
+        aws_account_id=aws_account_id,
+        windows=windows,
+        ckpt=ckpt,
+        cache=cache,
+        # Notifications come too often to discover the targets every time
+        targets_ttl=cli.cache_ttl if event is not None else 0,
+        metric_spec=metric_spec,
+        log_cache=log_cache,
+    )
+    metrics = metric.Metrics()
+    keys = {}
+    # Graph definition name -> param
+    params = {}
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=max(min(cli.load_balancer_workers, len(names)), 1)
+    ) as executor:
+        # Merged in the order of `names`, as `run_tasks` does
+        for m, k, p in executor.map(
+            lambda name: aggregate(name=name, listed=listed.get(name)), names
+        ):
+            metrics.merge(m)
+            for end, ks in k.items():
+                keys.setdefault(end, []).extend(ks)
+            for param in p:
+                params.setdefault(param["name"], param)
+    params = list(params.values())
+    if instrument.recorder.enabled:
+        params.extend(instrument.graph_definition_params(prefix=prefix))
+    if "mackerel" in cli.sinks:
+        with instrument.timer("graph_definitions"):
+            # Only definitions changed since the last run are created
+            created = poster.create_graph_definitions(
+                mkr_client=mkr,
+                params=params,
+                cache=ckpt.graph_definitions if ckpt is not None else None,
+            )
         logger.info(
-            "\t".join([str(m["timestamp"]), m["host_id"], m["name"], str(m["value"])])
+            "Created {created} of {total} graph definitions".format(
+                created=created, total=len(params)
+            )
+        )
+    # Checkpointed, while `metrics` becomes what is posted
+    whole = metrics
+    if ckpt is not None:
+        changed = metrics.timestamps()
+        whole = ckpt.metrics(windows=windows).merge(metrics)
+        if mark is None:
+            # Post the whole windows, not only the objects aggregated by this run
+            metrics = whole
+        else:
+            # Windows the watermark passed before are posted again only when
+            # late objects changed them, or their last post failed
+            emitted = []
+            for w in windows:
+                end = calendar.timegm(w.end.timetuple())
+                if ckpt.watermark is None or w.end > ckpt.watermark:
+                    emitted.append(w)
+                elif end in changed:
+                    instrument.count("windows.corrected")
+                    emitted.append(w)
+                elif end in ckpt.unposted:
+                    emitted.append(w)
+            instrument.count("windows.emitted", len(emitted))
+            metrics = ckpt.metrics(windows=emitted).merge(metrics)
+
+    # Posted but not checkpointed, as `metrics` may be the checkpointed `whole`
+    self_metrics = metric.Metrics()
+    if instrument.recorder.enabled:
+        # Stages up to here; `posting` of this run is only in the log line.
+        # Reported on the first load balancer registered to Mackerel, as there
+        # is one run for them all.
+        host_ids = [
+            hosts.alb_hosts.by_name[n] for n in names if n in hosts.alb_hosts.by_name
+        ]
+        if len(host_ids) > 0:
+            instrument.add_metrics(
+                metrics=self_metrics,
+                host_id=host_ids[0],
+                prefix=prefix,
+                timestamp=span.end,
+            )
+        else:
+            # Logged as an error, as warnings are hidden without VERBOSE
+            logger.error(
+                "Aggregator posts no self-metrics, as no load balancer is registered to Mackerel"
+            )
+
+    # One post for every load balancer
+    fanout = sinks.Fanout(
+        sinks=sinks.open_sinks(cli=cli, mkr_client=mkr),
+        queue_size=cli.sink_queue_size,
+    )
+    with instrument.timer("posting"):
+        for v in itertools.chain(metrics, self_metrics):
+            logger.info(
+                "\t".join([str(v["time"]), v["hostId"], v["name"], str(v["value"])])
+            )
+            fanout.put(v)
+        fanout.close()
+    # Ends of the windows with points failed to be written
+    unposted = set()
+    for sink in fanout.sinks:
+        instrument.count("points." + sink.name, sink.written)
+        instrument.count("points." + sink.name + "_failed", sink.failed_points)
+        for points, e in sink.failed:
+            logger.error(
+                "Aggregator failed to write {n} points to {sink}: {e}".format(
+                    n=len(points), sink=sink.name, e=e
+                )
+            )
+            # Posted points are stamped a second before the end of their window
+            unposted.update(p["time"] + 1 for p in points)
+
+    if ckpt is not None:
+        ckpt.update(
+            windows=windows,
+            metrics=whole,
+            keys=keys,
+            watermark=mark,
+            unposted=unposted,
         )
-    mkr.post_metrics(metrics=data)
 
 
 def lambda_handler(event, context):
-    main()
+    if events.notified(event):
+        main(event=event)
+    else:
+        main()
 
 
 if __name__ == "__main__":
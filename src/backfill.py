@@ -0,0 +1,423 @@
+#!/usr/bin/env python3
+import argparse
+import concurrent.futures
+import datetime
+import functools
+import os
+import threading
+import time
+from logging import getLogger, StreamHandler, INFO
+
+from cli import Cli
+import aggregator
+import checkpoint
+import columnar
+import engine
+import instrument
+import listing
+import metric
+import poster
+import query
+import resolver
+import sinks
+import spec
+import window
+
+__doc__ = "backfill.py aggregates ALB logs of a past time range into per-window points"
+
+handler = StreamHandler()
+handler.setLevel(INFO)
+
+logger = getLogger("alb-accesslog-aggregator.backfill")
+logger.setLevel(INFO)
+logger.addHandler(handler)
+logger.propagate = False
+
+ENGINES = ("projection", "local", "numpy")
+TIME_FORMAT = "%Y-%m-%dT%H:%M"
+
+# S3 client of each worker process, created by `_init_worker`
+_s3 = None
+
+
+class Shard:
+    """Shard is the windows of a slice of the range and the objects they need."""
+
+    def __init__(self, start=None, end=None, duration=60):
+        self.start = start
+        self.end = end
+        self.windows = window.cover(start=start, end=end, duration=duration)
+        self.keys = []
+
+    @property
+    def id(self):
+        return self.start.strftime(listing.KEY_TIMESTAMP_FORMAT)
+
+    def may_contain(self, key=""):
+        # The same range `listing.Listing.list` selects keys by
+        timestamp = listing.key_timestamp(key)
+        return (
+            timestamp is not None
+            and self.start <= timestamp
+            and timestamp
+            <= self.end + datetime.timedelta(seconds=listing.OBJECT_INTERVAL)
+        )
+
+
+def shards(start=None, end=None, minutes=60, duration=60):
+    """Split `start` - `end` into shards of `minutes`, oldest first.
+
+    Shards are whole windows of `duration`, `minutes` rounded down to them,
+    and the last one ends at `end`.
+    """
+    size = datetime.timedelta(seconds=max(minutes * 60 // duration, 1) * duration)
+    result = []
+    t = start
+    while t < end:
+        upper = min(t + size, end)
+        result.append(Shard(start=t, end=upper, duration=duration))
+        t = upper
+    return result
+
+
+def _init_worker(s3_factory):
+    global _s3
+    _s3 = s3_factory()
+
+
+def aggregate_shard(
+    bucket="",
+    keys=None,
+    engine_name="local",
+    queries=None,
+    projection="",
+    windows=None,
+    extra=None,
+):
+    """Aggregate `keys` into `windows` and return the metrics and counters."""
+    recorder = instrument.start(enabled=True)
+    metrics = metric.Metrics()
+    for key in keys:
+        metrics.merge(
+            aggregator.aggregate_object(
+                s3_client=_s3,
+                bucket=bucket,
+                key=key,
+                engine_name=engine_name,
+                queries=queries,
+                projection=projection,
+                windows=windows,
+                extra=extra,
+            )
+        )
+    counters = recorder.to_dict()["counters"]
+    instrument.start(enabled=False)
+    return metrics, counters
+
+
+class Progress:
+    """Progress keeps the shards already emitted, so a new run resumes after them."""
+
+    def __init__(
+        self, store=None, load_balancer_name="", start=None, end=None, shard_minutes=60
+    ):
+        self.store = store
+        self.lock = threading.Lock()
+        # Shards are only the same for the same range split the same way
+        self.range = {
+            "load_balancer_name": load_balancer_name,
+            "start": start.strftime(window.TIMESTAMP_FORMAT),
+            "end": end.strftime(window.TIMESTAMP_FORMAT),
+            "shard_minutes": shard_minutes,
+        }
+        state = store.load()
+        self.done = set()
+        if state.get("range") == self.range:
+            self.done = set(state["done"])
+        elif len(state) > 0:
+            logger.info("Progress of another range is discarded: " + str(state))
+
+    def add(self, shard):
+        with self.lock:
+            self.done.add(shard.id)
+            self.store.save({"range": self.range, "done": sorted(self.done)})
+
+
+def backfill(
+    cli=None,
+    clients=None,
+    s3_factory=None,
+    start=None,
+    end=None,
+    engine_name="local",
+    shard_minutes=60,
+    processes=1,
+    output="",
+    progress=None,
+    metric_spec=None,
+):
+    """Aggregate `start` - `end` shard by shard and emit the shards in order.
+
+    Shards are aggregated by `processes` worker processes, each creating its
+    S3 client with `s3_factory`. Points are written to the file `output` as
+    JSON lines, or to the sinks of `cli` when it is empty. A shard is done
+    once every sink wrote its points.
+
+    Return the objects and lines aggregated, the seconds taken and the IDs
+    of the shards failed to be written. `metric_spec` holds the metrics,
+    `spec.DEFAULT` if None.
+    """
+    mkr = clients["mackerel"]
+    elbv2 = clients["elbv2"]
+    aws_account_id = resolver.account_id(sts_client=clients["sts"])
+    load_balancer_arn, bucket, log_prefix = aggregator.load_balancer(
+        elbv2_client=elbv2, name=cli.load_balancer_name
+    )
+
+    targets = resolver.targets(
+        elbv2_client=elbv2,
+        ec2_client=clients["ec2"],
+        load_balancer_arn=load_balancer_arn,
+        ttl=cli.cache_ttl,
+    )
+    builder = query.Builder(
+        mkr_client=mkr,
+        mackerel_service=cli.mackerel_service,
+        mackerel_role=cli.mackerel_role,
+        ttl=cli.cache_ttl,
+    )
+    err = builder.build(
+        prefix=cli.prefix,
+        alb=cli.load_balancer_name,
+        targets=targets,
+        percentiles=cli.percentiles,
+        metrics=metric_spec,
+    )
+    if err is not None:
+        logger.error("Backfill failed to build queries: " + err)
+        exit(1)
+    extra = None
+    if len(spec.extras(builder.queries)) > 0:
+        extra = functools.partial(spec.Extras, series=spec.extras(builder.queries))
+    if output == "" and "mackerel" in cli.sinks:
+        poster.create_graph_definitions(
+            mkr_client=mkr,
+            params=metric.create_graph_definition_param(queries=builder.queries),
+        )
+
+    pending = [
+        s
+        for s in shards(
+            start=start, end=end, minutes=shard_minutes, duration=cli.duration
+        )
+        if progress is None or s.id not in progress.done
+    ]
+    if len(pending) == 0:
+        logger.info("Every shard is already done")
+        return
+    lister = listing.Listing(
+        s3_client=clients["s3"],
+        bucket=bucket,
+        prefix=log_prefix,
+        aws_account_id=aws_account_id,
+        region=cli.region,
+        load_balancer_id=listing.load_balancer_id(arn=load_balancer_arn),
+    )
+    for content in lister.list(start=pending[0].start, end=pending[-1].end):
+        for s in pending:
+            if s.may_contain(content["Key"]):
+                s.keys.append(content["Key"])
+
+    if output != "":
+        outputs = [sinks.JSONLinesSink(path=output)]
+    else:
+        outputs = sinks.open_sinks(cli=cli, mkr_client=mkr)
+    fanout = sinks.Fanout(sinks=outputs, queue_size=cli.sink_queue_size)
+    failed = []
+
+    def written(shard, ok):
+        if not ok:
+            failed.append(shard.id)
+            logger.error(
+                "Backfill failed to write shard {id}, run again to resume".format(
+                    id=shard.id
+                )
+            )
+        elif progress is not None:
+            progress.add(shard)
+
+    began = time.perf_counter()
+    objects = 0
+    lines = 0
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=max(processes, 1),
+        initializer=_init_worker,
+        initargs=(s3_factory,),
+    ) as executor:
+        futures = [
+            executor.submit(
+                aggregate_shard,
+                bucket=bucket,
+                keys=s.keys,
+                engine_name=engine_name,
+                queries=builder.queries,
+                projection=builder.projection(
+                    window.span(s.windows).between,
+                    columns=engine.columns(extra=extra),
+                ),
+                windows=s.windows,
+                extra=extra,
+            )
+            for s in pending
+        ]
+        # Shards are emitted in time order whichever process finishes first
+        for s, future in zip(pending, futures):
+            metrics, counters = future.result()
+            # Sinks write while the next shards are aggregated
+            for point in metrics:
+                fanout.put(point)
+            fanout.mark(functools.partial(written, s))
+
+            objects += len(s.keys)
+            lines += counters.get("records.read", 0) + counters.get(
+                "records.returned", 0
+            )
+            elapsed = time.perf_counter() - began
+            logger.info(
+                "Shard {id}: {keys} objects, {points} points; "
+                "{objects_per_second:.1f} objects/sec, {lines_per_second:.0f} lines/sec".format(
+                    id=s.id,
+                    keys=len(s.keys),
+                    points=len(metrics),
+                    objects_per_second=objects / elapsed,
+                    lines_per_second=lines / elapsed,
+                )
+            )
+    fanout.close()
+    return objects, lines, time.perf_counter() - began, failed
+
+
+def main():
+    description = __doc__
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        "--start",
+        metavar="YYYY-MM-DDTHH:MM",
+        action="store",
+        dest="start",
+        required=True,
+        help="UTC start of the range",
+    )
+    parser.add_argument(
+        "--end",
+        metavar="YYYY-MM-DDTHH:MM",
+        action="store",
+        dest="end",
+        required=True,
+        help="UTC end of the range",
+    )
+    parser.add_argument(
+        "--load-balancer-name",
+        metavar="NAME",
+        action="store",
+        dest="load_balancer_name",
+        default="",
+        help="ALB to backfill, LOAD_BALANCER_NAME by default",
+    )
+    parser.add_argument(
+        "--engine",
+        metavar="ENGINE",
+        action="store",
+        dest="engine",
+        default="local",
+        choices=ENGINES,
+    )
+    parser.add_argument(
+        "--shard-minutes",
+        metavar="MINUTES",
+        action="store",
+        dest="shard_minutes",
+        type=int,
+        default=60,
+    )
+    parser.add_argument(
+        "--processes",
+        metavar="PROCESSES",
+        action="store",
+        dest="processes",
+        type=int,
+        default=os.cpu_count() or 1,
+    )
+    parser.add_argument(
+        "--output",
+        metavar="FILE",
+        action="store",
+        dest="output",
+        default="",
+        help="Write the points to FILE as JSON lines instead of posting them",
+    )
+    parser.add_argument(
+        "--progress",
+        metavar="LOCATION",
+        action="store",
+        dest="progress",
+        default="backfill-progress.json",
+        help="File or `s3://<bucket>/<key>` keeping the shards done, to resume from",
+    )
+    args = parser.parse_args()
+
+    if args.load_balancer_name != "":
+        os.environ["LOAD_BALANCER_NAME"] = args.load_balancer_name
+    cli = Cli()
+    if len(cli.load_balancer_names) != 1:
+        logger.error("Backfill requires exactly one load balancer name")
+        exit(1)
+    if args.engine == "numpy" and not columnar.available():
+        logger.error("Engine `numpy` requires numpy to be installed")
+        exit(1)
+    metric_spec, err = spec.load(cli.metric_spec)
+    if err is not None:
+        logger.error("Backfill failed to load the metric spec: " + err)
+        exit(1)
+    start = datetime.datetime.strptime(args.start, TIME_FORMAT)
+    end = datetime.datetime.strptime(args.end, TIME_FORMAT)
+
+    clients = aggregator.create_clients(cli=cli)
+    progress = Progress(
+        store=checkpoint.open_store(location=args.progress, s3_client=clients["s3"]),
+        load_balancer_name=cli.load_balancer_name,
+        start=start,
+        end=end,
+        shard_minutes=args.shard_minutes,
+    )
+    result = backfill(
+        cli=cli,
+        clients=clients,
+        s3_factory=functools.partial(aggregator.s3_client, region=cli.region),
+        start=start,
+        end=end,
+        engine_name=args.engine,
+        shard_minutes=args.shard_minutes,
+        processes=args.processes,
+        output=args.output,
+        progress=progress,
+        metric_spec=metric_spec,
+    )
+    if result is not None:
+        objects, lines, elapsed, failed = result
+        logger.info(
+            "Backfilled {objects} objects, {lines} lines in {elapsed:.1f} sec.; "
+            "{objects_per_second:.1f} objects/sec, {lines_per_second:.0f} lines/sec".format(
+                objects=objects,
+                lines=lines,
+                elapsed=elapsed,
+                objects_per_second=objects / elapsed,
+                lines_per_second=lines / elapsed,
+            )
+        )
+        if len(failed) > 0:
+            exit(1)
+
+
+if __name__ == "__main__":
+    main()
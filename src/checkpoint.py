@@ -0,0 +1,183 @@
+import calendar
+import datetime
+import json
+import os
+
+import metric
+import sketch
+import topk
+
+
+class FileStore:
+    def __init__(self, path=""):
+        self.path = path
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, "r") as f:
+            return json.load(f)
+
+    def save(self, state):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, self.path)
+
+
+class S3Store:
+    def __init__(self, s3_client=None, bucket="", key=""):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+
+    def load(self):
+        try:
+            resp = self.s3_client.get_object(Bucket=self.bucket, Key=self.key)
+        except self.s3_client.exceptions.NoSuchKey:
+            return {}
+        return json.loads(resp["Body"].read().decode("utf-8"))
+
+    def save(self, state):
+        self.s3_client.put_object(
+            Bucket=self.bucket,
+            Key=self.key,
+            Body=json.dumps(state).encode("utf-8"),
+            ContentType="application/json",
+        )
+
+
+def open_store(location="", s3_client=None):
+    """Open the store at `location`, either `s3://<bucket>/<key>` or a file path."""
+    if location.startswith("s3://"):
+        _, _, bucket, key = location.split("/", 3)
+        return S3Store(s3_client=s3_client, bucket=bucket, key=key)
+    return FileStore(path=location)
+
+
+class Checkpoint:
+    """Checkpoint records which objects are already aggregated into each window.
+
+    The points aggregated so far are kept along with the object keys, so that a
+    window is completed by aggregating only the objects that arrived since the
+    last run and merging them with what was already posted.
+    """
+
+    def __init__(self, store=None):
+        self.store = store
+        state = store.load()
+        # Window end (UNIX time) -> {
+        #     "keys": [...],
+        #     "points": [[host_id, name, value], ...],
+        #     "distributions": [[host_id, name, statistics, sketch], ...],
+        #     "tops": [[host_id, name, size, space saving], ...],
+        # }
+        self.windows = state.get("windows", {})
+        # Graph definition name -> [digest, created time], see `poster`
+        self.graph_definitions = state.get("graph_definitions", {})
+        # Watermark of the last run (UNIX time), see `window.watermark`
+        self.watermark = None
+        if state.get("watermark") is not None:
+            self.watermark = datetime.datetime.utcfromtimestamp(state["watermark"])
+        # Ends (UNIX time) of the windows posted after the watermark passed them
+        # whose points failed to be written, posted again by the next run
+        self.unposted = set(state.get("unposted", []))
+
+    def done(self, key, w):
+        entry = self.windows.get(self._window_id(w))
+        return entry is not None and key in entry["keys"]
+
+    def metrics(self, windows=None):
+        metrics = metric.Metrics()
+        for w in windows:
+            entry = self.windows.get(self._window_id(w))
+            if entry is None:
+                continue
+            for host_id, name, value in entry["points"]:
+                metrics.add(host_id=host_id, name=name, timestamp=w.end, value=value)
+            for host_id, name, statistics, value in entry.get("distributions", []):
+                metrics.add_distribution(
+                    host_id=host_id,
+                    name=name,
+                    timestamp=w.end,
+                    value=sketch.Sketch.from_dict(value),
+                    statistics=statistics,
+                )
+            for host_id, name, size, value in entry.get("tops", []):
+                metrics.add_top(
+                    host_id=host_id,
+                    name=name,
+                    timestamp=w.end,
+                    value=topk.SpaceSaving.from_dict(value),
+                    size=size,
+                )
+        return metrics
+
+    def update(
+        self, windows=None, metrics=None, keys=None, watermark=None, unposted=None
+    ):
+        """Replace the state by `metrics` of `windows` built from `keys`.
+
+        `keys` maps a window end to the keys newly aggregated into it. Windows
+        not in `windows` are older than the aggregation range and are dropped.
+        The watermark is kept unless a new `watermark` is given, and so are
+        the unposted windows unless `unposted` is given.
+        """
+        state = {}
+        for w in windows:
+            window_id = self._window_id(w)
+            entry = self.windows.get(window_id, {"keys": [], "points": []})
+            state[window_id] = {
+                "keys": entry["keys"] + keys.get(w.end, []),
+                "points": [],
+                "distributions": [],
+                "tops": [],
+            }
+        for point in metrics.metrics.values():
+            window_id = str(point.timestamp)
+            if window_id in state:
+                state[window_id]["points"].append(
+                    [point.host_id, point.name, point.value]
+                )
+        for d in metrics.distributions.values():
+            window_id = str(d.timestamp)
+            if window_id in state:
+                state[window_id]["distributions"].append(
+                    [d.host_id, d.name, list(d.statistics), d.value.to_dict()]
+                )
+        for t in metrics.tops.values():
+            window_id = str(t.timestamp)
+            if window_id in state:
+                state[window_id]["tops"].append(
+                    [t.host_id, t.name, t.size, t.value.to_dict()]
+                )
+        self.windows = state
+        if watermark is not None:
+            self.watermark = watermark
+        if unposted is not None:
+            self.unposted = set(unposted)
+        self.unposted = {end for end in self.unposted if str(end) in state}
+        self.store.save(
+            {
+                "windows": state,
+                "graph_definitions": self.graph_definitions,
+                "watermark": (
+                    calendar.timegm(self.watermark.timetuple())
+                    if self.watermark is not None
+                    else None
+                ),
+                "unposted": sorted(self.unposted),
+            }
+        )
+
+    def _window_id(self, w):
+        return str(calendar.timegm(w.end.timetuple()))
+
+
+def may_contain(content, w):
+    """Whether the object of `content` can hold records of the window `w`.
+
+    ALB writes a record before it delivers the object, so an object last
+    modified before the window starts has no record of the window.
+    """
+    return content["LastModified"].replace(tzinfo=None) >= w.start
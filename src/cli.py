@@ -1,4 +1,6 @@
+import json
 import os
+import re
 
 
 class Cli:
@@ -7,8 +9,33 @@ class Cli:
 
         # S3 bucket region
         self.region = os.environ["REGION"]
-        # AWS application loadbalancer name
-        self.load_balancer_name = os.environ["LOAD_BALANCER_NAME"]
+        # AWS application loadbalancer names, comma separated
+        self.load_balancer_names = []
+        if "LOAD_BALANCER_NAME" in os.environ:
+            self.load_balancer_names = [
+                n
+                for n in os.environ["LOAD_BALANCER_NAME"]
+                .replace(" ", "")
+                .split(sep=",")
+                if n != ""
+            ]
+        # Also aggregate every ALB tagged with all of `<key>=<value>,...`
+        self.load_balancer_tags = {}
+        if "LOAD_BALANCER_TAGS" in os.environ:
+            for tag in os.environ["LOAD_BALANCER_TAGS"].split(sep=","):
+                if "=" in tag:
+                    key, value = tag.split("=", 1)
+                    self.load_balancer_tags[key.strip()] = value.strip()
+        if len(self.load_balancer_names) == 0 and len(self.load_balancer_tags) == 0:
+            raise KeyError("LOAD_BALANCER_NAME")
+        self.load_balancer_name = ""
+        if len(self.load_balancer_names) > 0:
+            self.load_balancer_name = self.load_balancer_names[0]
+        # Number of load balancers aggregated concurrently
+        if "LOAD_BALANCER_WORKERS" in os.environ:
+            self.load_balancer_workers = int(os.environ["LOAD_BALANCER_WORKERS"])
+        else:
+            self.load_balancer_workers = 4
         # Mackerel metric prefix
         if "PREFIX" in os.environ:
             self.prefix = os.environ["PREFIX"]
@@ -20,13 +47,232 @@ class Cli:
         else:
             self.duration = 60
 
+        # Number of windows of `duration` aggregated on each run
+        if "EPOCHS" in os.environ:
+            self.epochs = int(os.environ["EPOCHS"])
+        else:
+            self.epochs = 5
+        # `schedule` or `watermark`, see `window.WINDOWINGS`
+        if "WINDOWING" in os.environ:
+            self.windowing = os.environ["WINDOWING"]
+        else:
+            self.windowing = "schedule"
+        # Seconds behind the watermark windows are corrected by late objects
+        if "LATENESS" in os.environ:
+            self.lateness = int(os.environ["LATENESS"])
+        else:
+            self.lateness = 900
+
+        # Checkpoint location, `s3://<bucket>/<key>` or a file path.
+        # Objects already aggregated into a window are skipped when set.
+        if "CHECKPOINT" in os.environ:
+            self.checkpoint = os.environ["CHECKPOINT"]
+        else:
+            self.checkpoint = ""
+        # Per-object partial aggregates, `s3://<bucket>/<prefix>` or a directory such as `/tmp/partials`
+        if "PARTIAL_CACHE" in os.environ:
+            self.partial_cache = os.environ["PARTIAL_CACHE"]
+        else:
+            self.partial_cache = ""
+        # Bytes the partial aggregates may take in a directory
+        if "PARTIAL_CACHE_SIZE" in os.environ:
+            self.partial_cache_size = int(os.environ["PARTIAL_CACHE_SIZE"])
+        else:
+            self.partial_cache_size = 128 * 1024 * 1024
+        # Parsed logs kept as memory-mapped columnar segments, a directory such as `/tmp/segments`
+        if "LOG_CACHE" in os.environ:
+            self.log_cache = os.environ["LOG_CACHE"]
+        else:
+            self.log_cache = ""
+        # Bytes the segments may take
+        if "LOG_CACHE_SIZE" in os.environ:
+            self.log_cache_size = int(os.environ["LOG_CACHE_SIZE"])
+        else:
+            self.log_cache_size = 256 * 1024 * 1024
+
+        # Engine that aggregates ALB logs
+        #   s3select: one S3 Select query per object and window
+        #   projection: one S3 Select query per object, bucketed locally
+        #   local: download each object once and aggregate it in one pass
+        #   numpy: same as local, aggregated over NumPy arrays (requires numpy)
+        if "ENGINE" in os.environ:
+            self.engine = os.environ["ENGINE"]
+        else:
+            self.engine = "s3select"
+
+        # Percentiles of latency posted by the projection and local engines
+        if "PERCENTILES" in os.environ:
+            self.percentiles = [
+                p
+                for p in os.environ["PERCENTILES"].replace(" ", "").split(sep=",")
+                if p != ""
+            ]
+        else:
+            self.percentiles = ["50", "90", "99"]
+
+        # JSON or YAML file of the metrics posted, see `spec.DEFAULT` for the built-in ones
+        if "METRIC_SPEC" in os.environ:
+            self.metric_spec = os.environ["METRIC_SPEC"]
+        else:
+            self.metric_spec = ""
+
+        # Fields broken down into their heaviest items, any of
+        # `path`, `client`, `user_agent` and `elb_status_code`
+        if "TOPK_FIELDS" in os.environ:
+            self.topk_fields = [
+                f
+                for f in os.environ["TOPK_FIELDS"].replace(" ", "").split(sep=",")
+                if f != ""
+            ]
+        else:
+            self.topk_fields = []
+        # Number of the heaviest items posted per field and window
+        if "TOPK_SIZE" in os.environ:
+            self.topk_size = int(os.environ["TOPK_SIZE"])
+        else:
+            self.topk_size = 10
+        # Counters kept per field and window, more counters are more accurate
+        if "TOPK_CAPACITY" in os.environ:
+            self.topk_capacity = int(os.environ["TOPK_CAPACITY"])
+        else:
+            self.topk_capacity = 100
+        # JSON list of `[regex, replacement]` normalizing each segment of request paths
+        if "TOPK_PATH_PATTERNS" in os.environ:
+            self.topk_path_patterns = path_patterns(os.environ["TOPK_PATH_PATTERNS"])
+        else:
+            self.topk_path_patterns = None
+
+        # Number of threads that aggregate bucket objects concurrently
+        if "WORKERS" in os.environ:
+            self.workers = int(os.environ["WORKERS"])
+        else:
+            self.workers = 1
+
+        # Points per `post_metrics` request, requests sent concurrently and
+        # attempts of each request before its points are reported as failed
+        if "POST_BATCH_SIZE" in os.environ:
+            self.post_batch_size = int(os.environ["POST_BATCH_SIZE"])
+        else:
+            self.post_batch_size = 500
+        if "POST_WORKERS" in os.environ:
+            self.post_workers = int(os.environ["POST_WORKERS"])
+        else:
+            self.post_workers = 4
+        if "POST_ATTEMPTS" in os.environ:
+            self.post_attempts = int(os.environ["POST_ATTEMPTS"])
+        else:
+            self.post_attempts = 3
+
+        # Backends the points are written to, any of `mackerel`, `ganglia` and
+        # `openmetrics`. Each has its own queue of SINK_QUEUE_SIZE points and
+        # writes a batch when full or after its flush interval in seconds.
+        if "SINKS" in os.environ:
+            self.sinks = [
+                s
+                for s in os.environ["SINKS"].replace(" ", "").split(sep=",")
+                if s != ""
+            ]
+        else:
+            self.sinks = ["mackerel"]
+        if "SINK_QUEUE_SIZE" in os.environ:
+            self.sink_queue_size = int(os.environ["SINK_QUEUE_SIZE"])
+        else:
+            self.sink_queue_size = 10000
+        if "MACKEREL_FLUSH_INTERVAL" in os.environ:
+            self.mackerel_flush_interval = float(os.environ["MACKEREL_FLUSH_INTERVAL"])
+        else:
+            self.mackerel_flush_interval = 1.0
+
+        # gmond receiving gmetric UDP packets
+        if "GANGLIA_HOST" in os.environ:
+            self.ganglia_host = os.environ["GANGLIA_HOST"]
+        else:
+            self.ganglia_host = "localhost"
+        if "GANGLIA_PORT" in os.environ:
+            self.ganglia_port = int(os.environ["GANGLIA_PORT"])
+        else:
+            self.ganglia_port = 8649
+        if "GANGLIA_BATCH_SIZE" in os.environ:
+            self.ganglia_batch_size = int(os.environ["GANGLIA_BATCH_SIZE"])
+        else:
+            self.ganglia_batch_size = 100
+        if "GANGLIA_FLUSH_INTERVAL" in os.environ:
+            self.ganglia_flush_interval = float(os.environ["GANGLIA_FLUSH_INTERVAL"])
+        else:
+            self.ganglia_flush_interval = 1.0
+
+        # OpenMetrics text file keeping the latest value of each metric
+        if "OPENMETRICS_PATH" in os.environ:
+            self.openmetrics_path = os.environ["OPENMETRICS_PATH"]
+        else:
+            self.openmetrics_path = "/tmp/alb-accesslog-aggregator.prom"
+        if "OPENMETRICS_BATCH_SIZE" in os.environ:
+            self.openmetrics_batch_size = int(os.environ["OPENMETRICS_BATCH_SIZE"])
+        else:
+            self.openmetrics_batch_size = 10000
+        if "OPENMETRICS_FLUSH_INTERVAL" in os.environ:
+            self.openmetrics_flush_interval = float(
+                os.environ["OPENMETRICS_FLUSH_INTERVAL"]
+            )
+        else:
+            self.openmetrics_flush_interval = 5.0
+
         # Service that have ALB host and its targets host
         self.mackerel_service = os.environ["MACKEREL_SERVICE"]
         # Role is target hosts registered the ALB
         self.mackerel_role = os.environ["MACKEREL_ROLE"].replace(" ", "").split(sep=",")
 
+        # Seconds that warm containers reuse resolved targets and Mackerel hosts
+        if "CACHE_TTL" in os.environ:
+            self.cache_ttl = int(os.environ["CACHE_TTL"])
+        else:
+            self.cache_ttl = 300
+
+        # Post `custom.<prefix>.aggregator.*` metrics of the run and log it as JSON
+        self.instrument = False
+        if "INSTRUMENT" in os.environ:
+            if os.environ["INSTRUMENT"] != "0":
+                self.instrument = True
+
         # Logging verbosity
         self.verbose = False
         if "VERBOSE" in os.environ:
             if os.environ["VERBOSE"] != "0":
                 self.verbose = True
+
+
+def path_patterns(value=""):
+    """Parse the JSON list of `[regex, replacement]` of TOPK_PATH_PATTERNS.
+
+    ValueError naming the variable is raised for a value of another form, or
+    holding a regex or replacement `re` cannot use.
+    """
+    try:
+        pairs = json.loads(value)
+    except ValueError as e:
+        raise ValueError("TOPK_PATH_PATTERNS is not valid JSON: {e}".format(e=e))
+    if not isinstance(pairs, list):
+        raise ValueError(
+            "TOPK_PATH_PATTERNS is not a JSON list: {value}".format(value=value)
+        )
+    for pair in pairs:
+        if not (
+            isinstance(pair, list)
+            and len(pair) == 2
+            and all(isinstance(p, str) for p in pair)
+        ):
+            raise ValueError(
+                "TOPK_PATH_PATTERNS has an entry other than `[regex, replacement]`: {pair}".format(
+                    pair=pair
+                )
+            )
+        try:
+            # The replacement is parsed even without a match
+            re.compile(pair[0]).sub(pair[1], "")
+        except re.error as e:
+            raise ValueError(
+                "TOPK_PATH_PATTERNS has an invalid pattern {pair}: {e}".format(
+                    pair=pair, e=e
+                )
+            )
+    return pairs
@@ -0,0 +1,252 @@
+import calendar
+
+import engine
+import logs
+import partials
+import sketch
+
+# numpy is imported by `available`, only when the engine is used
+np = None
+
+# Status class of `target_status_code` as a small int; `-` (no response) is 0.
+# Any other first character is counted as the last class and never posted.
+STATUS_CLASSES = "-123456789?"
+_status_class = {c: i for i, c in enumerate(STATUS_CLASSES[:-1])}
+
+
+class Columns:
+    """Columns holds records as NumPy arrays, one element per record."""
+
+    def __init__(self, records=None):
+        if not available():
+            raise ImportError("numpy is not installed")
+        columns = list(zip(*records))
+        if len(columns) == 0:
+            columns = [()] * len(logs.COLUMNS)
+        # Fields of `topk.Breakdown` and `spec.Extras` after `logs.COLUMNS` are left out
+        time, target, request_time, target_time, response_time, status = columns[
+            : len(logs.COLUMNS)
+        ]
+
+        # Seconds since the epoch, dropping the microseconds of `YYYY-MM-DDTHH:MM:SS.ffffffZ`
+        self.time = np.array([t[:19] for t in time], dtype="datetime64[s]").astype(
+            np.int64
+        )
+        # Targets are dictionary encoded, `self.targets[self.target[i]]` is the target of record `i`
+        index = {}
+        self.target = np.fromiter(
+            (index.setdefault(t, len(index)) for t in target),
+            dtype=np.int64,
+            count=len(target),
+        )
+        self.targets = list(index)
+        self.status = np.array(
+            [_status_class.get(s[:1], len(STATUS_CLASSES) - 1) for s in status],
+            dtype=np.int8,
+        )
+        self.request_time = np.array(request_time, dtype=np.float64)
+        self.target_time = np.array(target_time, dtype=np.float64)
+        self.response_time = np.array(response_time, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.time)
+
+
+def _latency(latency, group, groups):
+    """Build a latency sketch per group with vectorized group-bys."""
+    count = np.bincount(group, minlength=groups)
+    total = np.bincount(group, weights=latency, minlength=groups)
+    minimum = np.full(groups, np.inf)
+    np.minimum.at(minimum, group, latency)
+    maximum = np.full(groups, -np.inf)
+    np.maximum.at(maximum, group, latency)
+
+    zero = latency <= sketch.MIN_VALUE
+    zero_count = np.bincount(group[zero], minlength=groups)
+    index = np.ceil(np.log(latency[~zero]) / sketch.Sketch().log_gamma).astype(np.int64)
+    buckets = {}
+    if len(index) > 0:
+        # Group by (group, bucket index) as one integer key
+        lowest = int(index.min())
+        width = int(index.max()) - lowest + 1
+        keys, counts = np.unique(
+            group[~zero] * width + (index - lowest), return_counts=True
+        )
+        for key, c in zip(keys.tolist(), counts.tolist()):
+            g, i = divmod(key, width)
+            buckets.setdefault(g, {})[i + lowest] = c
+
+    result = {}
+    for g in np.nonzero(count)[0].tolist():
+        result[g] = sketch.Sketch.from_summary(
+            count=int(count[g]),
+            total=float(total[g]),
+            minimum=float(minimum[g]),
+            maximum=float(maximum[g]),
+            buckets=buckets.get(g, {}),
+            zero_count=int(zero_count[g]),
+        )
+    return result
+
+
+def summarize(records, windows, top=None, extra=None):
+    """Same as `engine.summarize`, computed over NumPy arrays.
+
+    Every aggregate is a group-by over (window, target, status class) keys
+    combined into one integer and counted with `bincount`. Breakdowns by
+    `top` and series of `extra` are counted record by record, the same as
+    `engine.summarize`.
+    """
+    if top is not None or extra is not None:
+        # Iterated again for the breakdowns and series
+        records = list(records)
+    columns = Columns(records=records)
+    if len(columns) == 0:
+        return [
+            engine.Summary(
+                top=top() if top is not None else None,
+                extra=extra() if extra is not None else None,
+            )
+            for _ in windows
+        ]
+
+    # Window index of each record, -1 for none. ALB logs microseconds, so
+    # `lower <= time <= upper` as strings is `lower < time <= upper` in seconds.
+    win = np.full(len(columns), -1, dtype=np.int64)
+    for i, w in enumerate(windows):
+        lower = calendar.timegm(w.start.timetuple())
+        upper = calendar.timegm(w.end.timetuple())
+        win[(columns.time > lower) & (columns.time <= upper)] = i
+    summaries = _summarize(columns, win, len(windows))
+    if top is not None:
+        for summary in summaries:
+            summary.top = top()
+        latency = columns.request_time + columns.target_time + columns.response_time
+        no_dispatch = (
+            (columns.request_time == -1)
+            | (columns.target_time == -1)
+            | (columns.response_time == -1)
+        )
+        for i, record, value, skipped in zip(
+            win.tolist(), records, latency.tolist(), no_dispatch.tolist()
+        ):
+            if i >= 0:
+                summaries[i].top.add(record, None if skipped else value)
+    if extra is not None:
+        for summary in summaries:
+            summary.extra = extra()
+        for i, record in zip(win.tolist(), records):
+            if i >= 0:
+                summaries[i].extra.add(record)
+    return summaries
+
+
+def summarize_segment(segment, lo=0, hi=None):
+    """Summarize the records `[lo, hi)` of a `segments.Segment` over its mapped columns.
+
+    The arrays are views of the mapped file, only the status classes and the
+    keys of the group-bys are computed.
+    """
+    if not available():
+        raise ImportError("numpy is not installed")
+    if hi is None:
+        hi = segment.rows
+    c = segment.columns
+    columns = Columns.__new__(Columns)
+    columns.time = np.frombuffer(c["time"], dtype=np.int64)[lo:hi]
+    columns.target = np.frombuffer(c["target"], dtype=np.uint32)[lo:hi].astype(np.int64)
+    columns.targets = segment.dictionaries["target"]
+    classes = np.array(
+        [
+            _status_class.get(s[:1], len(STATUS_CLASSES) - 1)
+            for s in segment.dictionaries["status"]
+        ],
+        dtype=np.int8,
+    )
+    columns.status = classes[np.frombuffer(c["status"], dtype=np.uint32)[lo:hi]]
+    columns.request_time = np.frombuffer(c["request_time"], dtype=np.float64)[lo:hi]
+    columns.target_time = np.frombuffer(c["target_time"], dtype=np.float64)[lo:hi]
+    columns.response_time = np.frombuffer(c["response_time"], dtype=np.float64)[lo:hi]
+    return _summarize(columns, np.zeros(hi - lo, dtype=np.int64), 1)[0]
+
+
+def summarize_slots(records):
+    """Same as `partials.summarize`, computed over NumPy arrays."""
+    columns = Columns(records=records)
+    if len(columns) == 0:
+        return partials.Partials()
+    # The slot of a record ends at its time rounded up to the slot
+    ends, win = np.unique(
+        -(-columns.time // partials.SLOT) * partials.SLOT, return_inverse=True
+    )
+    summaries = _summarize(columns, win, len(ends))
+    return partials.Partials(slots=dict(zip(ends.tolist(), summaries)))
+
+
+def _summarize(columns, win, n_windows):
+    """Summarize the records of `columns` into the window of index `win`, if not -1."""
+    summaries = [engine.Summary() for _ in range(n_windows)]
+    targets = columns.targets
+    n_targets = len(targets)
+    n_status = len(STATUS_CLASSES)
+
+    selected = win >= 0
+    win = win[selected]
+    target = columns.target[selected]
+    status = columns.status[selected].astype(np.int64)
+    request_time = columns.request_time[selected]
+    target_time = columns.target_time[selected]
+    response_time = columns.response_time[selected]
+
+    status_count = np.bincount(win * n_status + status, minlength=n_windows * n_status)
+    for key in np.nonzero(status_count)[0].tolist():
+        i, c = divmod(key, n_status)
+        if c < n_status - 1:
+            summaries[i].status[STATUS_CLASSES[c]] = int(status_count[key])
+
+    target_status = np.bincount(
+        (win * n_targets + target) * n_status + status,
+        minlength=n_windows * n_targets * n_status,
+    )
+    for key in np.nonzero(target_status)[0].tolist():
+        group, c = divmod(key, n_status)
+        i, t = divmod(group, n_targets)
+        if c < n_status - 1:
+            summaries[i].target_status[(targets[t], STATUS_CLASSES[c])] = int(
+                target_status[key]
+            )
+
+    no_dispatch = (request_time == -1) | (target_time == -1) | (response_time == -1)
+    for i, c in enumerate(np.bincount(win[no_dispatch], minlength=n_windows).tolist()):
+        summaries[i].no_dispatch = c
+
+    dispatched = ~no_dispatch
+    latency = (request_time + target_time + response_time)[dispatched]
+    group = (win * n_targets + target)[dispatched]
+    for key, value in _latency(latency, group, n_windows * n_targets).items():
+        i, t = divmod(key, n_targets)
+        summaries[i].latency[targets[t]] = value
+    return summaries
+
+
+def aggregate_numpy(
+    s3_client=None, bucket=None, key=None, windows=None, top=None, extra=None
+):
+    records = logs.read_object(
+        s3_client=s3_client,
+        bucket=bucket,
+        key=key,
+        columns=engine.columns(top=top, extra=extra),
+    )
+    return summarize(records, windows, top=top, extra=extra)
+
+
+def available():
+    global np
+    if np is None:
+        try:
+            import numpy
+        except ImportError:
+            return False
+        np = numpy
+    return True
@@ -0,0 +1,198 @@
+import bisect
+
+import logs
+import sketch
+import topk
+
+
+class Summary:
+    """Summary holds the aggregates of the log records in one window."""
+
+    __slots__ = ("status", "target_status", "no_dispatch", "latency", "top", "extra")
+
+    def __init__(self, top=None, extra=None):
+        # Status class (first character of `target_status_code`) -> count
+        self.status = {}
+        # (target, status class) -> count
+        self.target_status = {}
+        self.no_dispatch = 0
+        # target -> sketch.Sketch of latency of dispatched requests
+        self.latency = {}
+        # topk.Breakdown of the records, when they have its fields
+        self.top = top
+        # spec.Extras of the records, when they have its fields
+        self.extra = extra
+
+    def add(self, record):
+        target = record[1]
+        request_time = record[2]
+        target_time = record[3]
+        response_time = record[4]
+        status_class = record[5][:1]
+        if self.extra is not None:
+            self.extra.add(record)
+
+        self.status[status_class] = self.status.get(status_class, 0) + 1
+        key = (target, status_class)
+        self.target_status[key] = self.target_status.get(key, 0) + 1
+
+        if request_time == "-1" or target_time == "-1" or response_time == "-1":
+            self.no_dispatch += 1
+            if self.top is not None:
+                self.top.add(record)
+            return
+
+        latency = float(request_time) + float(target_time) + float(response_time)
+        if target not in self.latency:
+            self.latency[target] = sketch.Sketch()
+        self.latency[target].add(latency)
+        if self.top is not None:
+            self.top.add(record, latency)
+
+    def merge(self, other):
+        """Add the records of `other` into this summary, leaving `other` unchanged."""
+        for status_class, count in other.status.items():
+            self.status[status_class] = self.status.get(status_class, 0) + count
+        for key, count in other.target_status.items():
+            self.target_status[key] = self.target_status.get(key, 0) + count
+        self.no_dispatch += other.no_dispatch
+        for target, latency in other.latency.items():
+            if target in self.latency:
+                self.latency[target].merge(latency)
+            else:
+                self.latency[target] = latency.copy()
+        if other.top is not None:
+            if self.top is None:
+                self.top = other.top.copy()
+            else:
+                self.top.merge(other.top)
+        if other.extra is not None:
+            if self.extra is None:
+                self.extra = other.extra.copy()
+            else:
+                self.extra.merge(other.extra)
+        return self
+
+    def value(self, query):
+        """Evaluate a query item built by `query.Builder` against this summary."""
+        if "extra" in query:
+            if self.extra is None:
+                raise ValueError("summary has no series of the metric spec")
+            return self.extra.value(query["extra"])
+        target = query["target"]
+        if query["aggregate"] == "count":
+            match = query["match"]
+            if match == "no_dispatch":
+                return float(self.no_dispatch)
+            if target is None:
+                return float(self.status.get(match, 0))
+            return float(self.target_status.get((target, match), 0))
+        if query["aggregate"] == "distribution":
+            latency = self.latency.get(target)
+            if latency is None:
+                return sketch.Sketch()
+            return latency
+        if query["aggregate"] == "top":
+            if (
+                self.top is None
+                or (query["field"], query["kind"]) not in self.top.hitters
+            ):
+                return topk.SpaceSaving()
+            return self.top.hitters[(query["field"], query["kind"])]
+        raise ValueError("unknown aggregate: " + query["aggregate"])
+
+
+def columns(top=None, extra=None):
+    """Return the fields of the records the summaries of `top` and `extra` read."""
+    result = logs.COLUMNS
+    if top is not None:
+        result = result + logs.BREAKDOWN_COLUMNS
+    if extra is not None:
+        result = result + logs.SPEC_COLUMNS
+    return result
+
+
+def summarize(records, windows, top=None, extra=None):
+    """Summarize `records` into `windows`, with a new `top()` and `extra()` each when given."""
+    summaries = [
+        Summary(
+            top=top() if top is not None else None,
+            extra=extra() if extra is not None else None,
+        )
+        for _ in windows
+    ]
+    bounds = sorted(
+        ((w.lower, w.upper, s) for w, s in zip(windows, summaries)),
+        key=lambda b: b[0],
+    )
+    lowers = [b[0] for b in bounds]
+    uppers = [b[1] for b in bounds]
+    lowest = min(lowers)
+    highest = max(uppers)
+    if uppers != sorted(uppers):
+        # Windows of different durations, test every window
+        for record in records:
+            timestamp = record[0]
+            if timestamp < lowest or timestamp > highest:
+                continue
+            for lower, upper, summary in bounds:
+                if lower <= timestamp <= upper:
+                    summary.add(record)
+        return summaries
+
+    # Windows sorted by both ends: those containing a timestamp are the run
+    # ending at the last window starting at or before it.
+    for record in records:
+        timestamp = record[0]
+        if timestamp < lowest or timestamp > highest:
+            continue
+        i = bisect.bisect_right(lowers, timestamp) - 1
+        while i >= 0 and uppers[i] >= timestamp:
+            bounds[i][2].add(record)
+            i -= 1
+    return summaries
+
+
+def aggregate_local(
+    s3_client=None, bucket=None, key=None, windows=None, top=None, extra=None
+):
+    records = logs.read_object(
+        s3_client=s3_client,
+        bucket=bucket,
+        key=key,
+        columns=columns(top=top, extra=extra),
+    )
+    return summarize(records, windows, top=top, extra=extra)
+
+
+def collect(metrics=None, queries=None, windows=None, summaries=None):
+    for w, summary in zip(windows, summaries):
+        for query_group in queries:
+            host_id = ""
+            if "host_id" in query_group:
+                host_id = query_group["host_id"]
+            for q in query_group["query"]:
+                if q["aggregate"] == "top":
+                    metrics.add_top(
+                        host_id=host_id,
+                        name=q["name"],
+                        timestamp=w.end,
+                        value=summary.value(q),
+                        size=q["size"],
+                    )
+                    continue
+                if q["aggregate"] == "distribution":
+                    metrics.add_distribution(
+                        host_id=host_id,
+                        name=q["name"],
+                        timestamp=w.end,
+                        value=summary.value(q),
+                        statistics=q["statistics"],
+                    )
+                    continue
+                metrics.add(
+                    host_id=host_id,
+                    name=q["name"],
+                    timestamp=w.end,
+                    value=summary.value(q),
+                )
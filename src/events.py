@@ -0,0 +1,66 @@
+import datetime
+import json
+import urllib.parse
+
+EVENT_TIME_FORMATS = ("%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%SZ")
+
+
+def notified(event=None):
+    """Whether `event` holds notifications rather than being a scheduled event."""
+    return isinstance(event, dict) and len(event.get("Records", [])) > 0
+
+
+def _records(event=None):
+    """Yield the S3 records of `event`, unwrapping SQS messages and SNS notifications."""
+    for record in event.get("Records", []):
+        if record.get("eventSource") == "aws:s3":
+            yield record
+        elif record.get("eventSource") == "aws:sqs":
+            body = json.loads(record["body"])
+            # Notifications delivered to SQS through an SNS topic
+            if body.get("Type") == "Notification" and "Message" in body:
+                body = json.loads(body["Message"])
+            for r in _records(body):
+                yield r
+        elif "Sns" in record:
+            for r in _records(json.loads(record["Sns"]["Message"])):
+                yield r
+
+
+def _event_time(value=""):
+    for f in EVENT_TIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, f)
+        except ValueError:
+            continue
+    return datetime.datetime.utcnow()
+
+
+def objects(event=None):
+    """Return the objects created according to the S3 notifications in `event`.
+
+    Objects are dicts like the contents of `list_objects_v2`, with `Bucket`
+    added. Each key is returned once, however many times it is notified, and
+    test events and other kinds of notifications are ignored.
+    """
+    result = []
+    seen = set()
+    for record in _records(event):
+        if not record.get("eventName", "").startswith("ObjectCreated:"):
+            continue
+        s3 = record["s3"]
+        key = urllib.parse.unquote_plus(s3["object"]["key"])
+        if key in seen:
+            continue
+        seen.add(key)
+        result.append(
+            {
+                "Bucket": s3["bucket"]["name"],
+                "Key": key,
+                "ETag": '"{etag}"'.format(etag=s3["object"].get("eTag", "")),
+                "Size": s3["object"].get("size", 0),
+                # ALB writes a record before it delivers the object
+                "LastModified": _event_time(record.get("eventTime", "")),
+            }
+        )
+    return result
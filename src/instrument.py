@@ -0,0 +1,205 @@
+import threading
+import time
+
+# Units of the self-metrics graphs, keyed by the first part of the metric name
+UNITS = {
+    "seconds": "float",
+    "calls": "integer",
+    "bytes": "bytes",
+    "records": "integer",
+    "points": "integer",
+    "partials": "integer",
+    "segments": "integer",
+    "windows": "integer",
+    "events": "integer",
+}
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    __slots__ = ("recorder", "name", "start")
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.recorder.add_time(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class Recorder:
+    """Recorder accumulates the wall time spent in each named stage and counters."""
+
+    enabled = True
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # name -> [seconds, calls]
+        self.timers = {}
+        # name -> value
+        self.counters = {}
+        # object key -> {name -> value}
+        self.objects = {}
+
+    def timer(self, name):
+        return _Timer(self, name)
+
+    def count(self, name, value=1, key=None):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+            if key is not None:
+                counters = self.objects.setdefault(key, {})
+                counters[name] = counters.get(name, 0) + value
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            if name in self.timers:
+                self.timers[name][0] += seconds
+                self.timers[name][1] += 1
+            else:
+                self.timers[name] = [seconds, 1]
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "timers": {
+                    name: {"seconds": seconds, "calls": calls}
+                    for name, (seconds, calls) in self.timers.items()
+                },
+                "counters": dict(self.counters),
+                "objects": {key: dict(c) for key, c in self.objects.items()},
+            }
+
+
+class NullRecorder:
+    """NullRecorder records nothing, so instrumented code costs almost nothing."""
+
+    enabled = False
+
+    def timer(self, name):
+        return _NULL_TIMER
+
+    def add_time(self, name, seconds):
+        pass
+
+    def count(self, name, value=1, key=None):
+        pass
+
+    def to_dict(self):
+        return {"timers": {}, "counters": {}, "objects": {}}
+
+
+recorder = NullRecorder()
+
+
+def start(enabled=True):
+    """Replace the recorder of this process for a new run and return it."""
+    global recorder
+    if enabled:
+        recorder = Recorder()
+    else:
+        recorder = NullRecorder()
+    return recorder
+
+
+def timer(name):
+    return recorder.timer(name)
+
+
+def count(name, value=1, key=None):
+    recorder.count(name, value=value, key=key)
+
+
+def counted(records, name, key=None):
+    """Yield `records`, counting them as `name` once exhausted or closed."""
+    n = 0
+    try:
+        for n, record in enumerate(records, 1):
+            yield record
+    finally:
+        recorder.count(name, value=n, key=key)
+
+
+def add_metrics(metrics=None, host_id="", prefix="", timestamp=None):
+    """Add what the recorder holds to `metrics` as `custom.<prefix>.aggregator.*`."""
+    name = "custom.{prefix}.aggregator".format(prefix=prefix)
+    result = recorder.to_dict()
+    for stage, timer in result["timers"].items():
+        for field in ("seconds", "calls"):
+            metrics.add(
+                host_id=host_id,
+                name="{name}.{field}.{stage}".format(
+                    name=name, field=field, stage=stage
+                ),
+                timestamp=timestamp,
+                value=float(timer[field]),
+            )
+    for counter, value in result["counters"].items():
+        metrics.add(
+            host_id=host_id,
+            name="{name}.{counter}".format(name=name, counter=counter),
+            timestamp=timestamp,
+            value=float(value),
+        )
+    return metrics
+
+
+def graph_definition_params(prefix=""):
+    """Graph definitions of the self-metrics, one per entry of `UNITS`."""
+    name = "custom.{prefix}.aggregator".format(prefix=prefix)
+    return [
+        {
+            "name": "{name}.{group}".format(name=name, group=group),
+            "unit": unit,
+            "metrics": [
+                {
+                    "name": "{name}.{group}.*".format(name=name, group=group),
+                    "isStacked": False,
+                }
+            ],
+        }
+        for group, unit in UNITS.items()
+    ]
+
+
+def log_entry(**fields):
+    """Return a JSON serializable summary of the run, `fields` included."""
+    entry = dict(fields)
+    entry.update(recorder.to_dict())
+    return entry
+
+
+def timed(items, name, seconds=0.0):
+    """Yield `items`, timing the waits for them as one call of `name` once exhausted or closed.
+
+    `seconds` already spent on the call, such as sending the request the
+    items stream in response to, are added to them.
+    """
+    iterator = iter(items)
+    try:
+        while True:
+            began = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                seconds += time.perf_counter() - began
+            yield item
+    finally:
+        recorder.add_time(name, seconds)
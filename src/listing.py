@@ -0,0 +1,131 @@
+import datetime
+
+KEY_TIMESTAMP_FORMAT = "%Y%m%dT%H%MZ"
+OBJECT_INTERVAL = 300  # ALB delivers a log object every 5 Min.
+
+
+def load_balancer_id(arn=""):
+    """Convert a load balancer ARN to the ID used in its log object keys.
+
+    `arn:aws:elasticloadbalancing:<region>:<account>:loadbalancer/app/<name>/<id>`
+    is logged as `app.<name>.<id>`.
+    """
+    return arn.split(":loadbalancer/", 1)[-1].replace("/", ".")
+
+
+def key_timestamp(key=""):
+    """Parse the end time of the logging interval from an object key.
+
+    Keys are `<account>_elasticloadbalancing_<region>_<load balancer id>_<end time>_<ip>_<random>.log.gz`.
+    None is returned for keys not in this format.
+    """
+    fields = key.rsplit("/", 1)[-1].split("_")
+    if len(fields) < 7:
+        return None
+    try:
+        return datetime.datetime.strptime(fields[4], KEY_TIMESTAMP_FORMAT)
+    except ValueError:
+        return None
+
+
+def key_node(key=""):
+    """Return `(load balancer id, ip)` of the node that delivered the object, see `key_timestamp`.
+
+    None is returned for keys not in the format.
+    """
+    fields = key.rsplit("/", 1)[-1].split("_")
+    if len(fields) < 7:
+        return None
+    return fields[3], fields[5]
+
+
+def key_load_balancer(key=""):
+    """Return `(account ID, region, name)` of the load balancer that delivered the object, see `key_timestamp`.
+
+    None is returned for keys not in the format.
+    """
+    fields = key.rsplit("/", 1)[-1].split("_")
+    if len(fields) < 7:
+        return None
+    # `app.<name>.<id>`
+    parts = fields[3].split(".")
+    if len(parts) < 3:
+        return None
+    return fields[0], fields[2], parts[1]
+
+
+def select(contents=None, start=None, end=None):
+    """Select the objects of `contents` that can hold records between `start` and `end`, as `Listing.list` does."""
+    start = start.replace(second=0, microsecond=0)
+    last = end + datetime.timedelta(seconds=OBJECT_INTERVAL)
+    result = []
+    for content in contents:
+        timestamp = key_timestamp(content["Key"])
+        if timestamp is not None and start <= timestamp <= last:
+            result.append(content)
+    return result
+
+
+class Listing:
+    def __init__(
+        self,
+        s3_client=None,
+        bucket="",
+        prefix="",
+        aws_account_id="",
+        region="",
+        load_balancer_id="",
+    ):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.aws_account_id = aws_account_id
+        self.region = region
+        self.load_balancer_id = load_balancer_id
+
+        # Number of keys returned by `list_objects_v2`
+        self.listed = 0
+        # Number of keys listed but outside of the aggregation range
+        self.skipped = 0
+
+    def key_prefix(self, date):
+        return "{prefix}AWSLogs/{aws_account_id}/elasticloadbalancing/{region}/{date}/{aws_account_id}_elasticloadbalancing_{region}_{load_balancer_id}_".format(  # noqa: E501
+            prefix=self.prefix + "/" if self.prefix != "" else "",
+            aws_account_id=self.aws_account_id,
+            region=self.region,
+            date=date.strftime("%Y/%m/%d"),
+            load_balancer_id=self.load_balancer_id,
+        )
+
+    def list(self, start=None, end=None):
+        """List objects that can hold records between `start` and `end`.
+
+        An object holds the records of the 5 minutes up to the end time in its
+        key. Keys sort by that time under the day prefix, so listing starts
+        after the first interval that overlaps `start` and every day prefix
+        the range crosses is listed.
+        """
+        start = start.replace(second=0, microsecond=0)
+        last = end + datetime.timedelta(seconds=OBJECT_INTERVAL)
+
+        contents = []
+        date = start.date()
+        while date <= last.date():
+            key_prefix = self.key_prefix(date)
+            params = {"Bucket": self.bucket, "Prefix": key_prefix, "MaxKeys": 1000}
+            if date == start.date():
+                params["StartAfter"] = key_prefix + start.strftime(KEY_TIMESTAMP_FORMAT)
+            while True:
+                objs = self.s3_client.list_objects_v2(**params)
+                for content in objs.get("Contents", []):
+                    self.listed += 1
+                    timestamp = key_timestamp(content["Key"])
+                    if timestamp is None or timestamp < start or timestamp > last:
+                        self.skipped += 1
+                        continue
+                    contents.append(content)
+                if "NextContinuationToken" not in objs:
+                    break
+                params["ContinuationToken"] = objs["NextContinuationToken"]
+            date = date + datetime.timedelta(days=1)
+        return contents
@@ -2,30 +2,179 @@ import datetime
 import calendar
 
 
+class Point:
+    __slots__ = ("host_id", "name", "timestamp", "value")
+
+    def __init__(self, host_id="", name="", timestamp=0, value=0.0):
+        self.host_id = host_id
+        self.name = name
+        self.timestamp = timestamp
+        self.value = value
+
+
+class Distribution:
+    __slots__ = ("host_id", "name", "timestamp", "value", "statistics")
+
+    def __init__(self, host_id="", name="", timestamp=0, value=None, statistics=()):
+        self.host_id = host_id
+        self.name = name
+        self.timestamp = timestamp
+        # sketch.Sketch of the values
+        self.value = value
+        self.statistics = statistics
+
+
+class Top:
+    __slots__ = ("host_id", "name", "timestamp", "value", "size")
+
+    def __init__(self, host_id="", name="", timestamp=0, value=None, size=10):
+        self.host_id = host_id
+        self.name = name
+        self.timestamp = timestamp
+        # topk.SpaceSaving of the items
+        self.value = value
+        # Number of the heaviest items posted
+        self.size = size
+
+
 class Metrics:
     def __init__(self):
-        self.metrics = []
+        # (host_id, name, fixed_timestamp) -> Point
+        self.metrics = {}
+        # (host_id, name, fixed_timestamp) -> Distribution
+        self.distributions = {}
+        # (host_id, name, fixed_timestamp) -> Top
+        self.tops = {}
+
+    def __len__(self):
+        return (
+            len(self.metrics)
+            + sum(len(d.statistics) for d in self.distributions.values())
+            + sum(min(len(t.value.counts), t.size) for t in self.tops.values())
+        )
+
+    def __iter__(self):
+        """Yield the points as the payload of Mackerel `post_metrics`."""
+        for point in self.metrics.values():
+            yield {
+                "hostId": point.host_id,
+                "name": point.name,
+                "time": point.timestamp - 1,
+                "value": point.value,
+            }
+        # A distribution is posted as one metric per statistic
+        for d in self.distributions.values():
+            for statistic in d.statistics:
+                yield {
+                    "hostId": d.host_id,
+                    "name": "{name}.{statistic}".format(
+                        name=d.name, statistic=statistic
+                    ),
+                    "time": d.timestamp - 1,
+                    "value": d.value.statistic(statistic),
+                }
+        # The heaviest items are posted as one metric each
+        for t in self.tops.values():
+            for item, count, _ in t.value.top(t.size):
+                yield {
+                    "hostId": t.host_id,
+                    "name": "{name}.{item}".format(name=t.name, item=item),
+                    "time": t.timestamp - 1,
+                    "value": count,
+                }
 
     def add(self, host_id="", name="", timestamp=None, value=0.0):
-        fixed_timestamp = self.fix_timestamp(timestamp)
-
-        for metric in self.metrics:
-            if (
-                metric["host_id"] == host_id
-                and metric["name"] == name
-                and metric["fixed_timestamp"] == fixed_timestamp
-            ):
-                metric["value"] = metric["value"] + value
-                return
-
-        metric = {
-            "host_id": host_id,
-            "timestamp": calendar.timegm(timestamp.timetuple()),
-            "fixed_timestamp": fixed_timestamp,
-            "name": name,
-            "value": value,
-        }
-        self.metrics.append(metric)
+        key = (host_id, name, self.fix_timestamp(timestamp))
+        point = self.metrics.get(key)
+        if point is not None:
+            point.value = point.value + value
+            return
+
+        self.metrics[key] = Point(
+            host_id=host_id,
+            name=name,
+            timestamp=calendar.timegm(timestamp.timetuple()),
+            value=value,
+        )
+
+    def add_distribution(
+        self, host_id="", name="", timestamp=None, value=None, statistics=()
+    ):
+        key = (host_id, name, self.fix_timestamp(timestamp))
+        d = self.distributions.get(key)
+        if d is not None:
+            d.value.merge(value)
+            return
+
+        self.distributions[key] = Distribution(
+            host_id=host_id,
+            name=name,
+            timestamp=calendar.timegm(timestamp.timetuple()),
+            value=value.copy(),
+            statistics=tuple(statistics),
+        )
+
+    def add_top(self, host_id="", name="", timestamp=None, value=None, size=10):
+        key = (host_id, name, self.fix_timestamp(timestamp))
+        t = self.tops.get(key)
+        if t is not None:
+            t.value.merge(value)
+            return
+
+        self.tops[key] = Top(
+            host_id=host_id,
+            name=name,
+            timestamp=calendar.timegm(timestamp.timetuple()),
+            value=value.copy(),
+            size=size,
+        )
+
+    def merge(self, other):
+        """Add the points of `other` into this metrics and return itself."""
+        for key, point in other.metrics.items():
+            current = self.metrics.get(key)
+            if current is not None:
+                current.value = current.value + point.value
+                continue
+            self.metrics[key] = Point(
+                host_id=point.host_id,
+                name=point.name,
+                timestamp=point.timestamp,
+                value=point.value,
+            )
+        for key, d in other.distributions.items():
+            current = self.distributions.get(key)
+            if current is not None:
+                current.value.merge(d.value)
+                continue
+            self.distributions[key] = Distribution(
+                host_id=d.host_id,
+                name=d.name,
+                timestamp=d.timestamp,
+                value=d.value.copy(),
+                statistics=d.statistics,
+            )
+        for key, t in other.tops.items():
+            current = self.tops.get(key)
+            if current is not None:
+                current.value.merge(t.value)
+                continue
+            self.tops[key] = Top(
+                host_id=t.host_id,
+                name=t.name,
+                timestamp=t.timestamp,
+                value=t.value.copy(),
+                size=t.size,
+            )
+        return self
+
+    def timestamps(self):
+        """Return the UNIX times of every point."""
+        result = set()
+        for values in (self.metrics, self.distributions, self.tops):
+            for v in values.values():
+                result.add(v.timestamp)
+        return result
 
     def fix_timestamp(self, timestamp):
         return timestamp - datetime.timedelta(seconds=timestamp.second)
@@ -36,6 +185,21 @@ def create_graph_definition_param(queries={}):
     for group in queries:
         metrics = []
         for query in group["query"]:
+            if query.get("aggregate") == "top":
+                # One metric for each of the heaviest items
+                metrics.append({"name": query["name"] + ".*", "isStacked": False})
+                continue
+            if "statistics" in query:
+                for statistic in query["statistics"]:
+                    metrics.append(
+                        {
+                            "name": "{name}.{statistic}".format(
+                                name=query["name"], statistic=statistic
+                            ),
+                            "isStacked": False,
+                        }
+                    )
+                continue
             metrics.append({"name": query["name"], "isStacked": False})
         params = {"name": group["name"], "unit": group["unit"], "metrics": metrics}
         graph_definition.append(params)
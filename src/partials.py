@@ -0,0 +1,317 @@
+import calendar
+import collections
+import datetime
+import hashlib
+import math
+import os
+import struct
+import threading
+
+import engine
+import instrument
+import sketch
+
+# Partial aggregates are kept per minute, so they make any window whose ends
+# are on the minute.
+SLOT = 60
+CACHE_SIZE = 128 * 1024 * 1024
+
+MAGIC = b"ALP1"
+_header = struct.Struct(">4sdII")
+_string = struct.Struct(">H")
+_slot = struct.Struct(">qIIII")
+_status = struct.Struct(">II")
+_target_status = struct.Struct(">III")
+_latency = struct.Struct(">IIdddII")
+_bucket = struct.Struct(">iI")
+
+
+class Partials:
+    """Partials holds the summaries of the records of an object, one per minute."""
+
+    def __init__(self, slots=None):
+        # Slot end (UNIX time) -> engine.Summary of the records in (end - SLOT, end]
+        self.slots = slots if slots is not None else {}
+
+    def window(self, w):
+        """Merge the slots of the window `w` into a new summary."""
+        lower = calendar.timegm(w.start.timetuple())
+        upper = calendar.timegm(w.end.timetuple())
+        summary = engine.Summary()
+        for end, s in self.slots.items():
+            if lower < end <= upper:
+                summary.merge(s)
+        return summary
+
+
+def aligned(windows=None):
+    """Whether every window of `windows` is made of whole slots."""
+    return all(
+        calendar.timegm(w.start.timetuple()) % SLOT == 0
+        and calendar.timegm(w.end.timetuple()) % SLOT == 0
+        for w in windows
+    )
+
+
+def summarize(records):
+    """Summarize `records` per slot, the same as `engine.summarize` does per window."""
+    # (minute, on the minute) -> Summary; `lower < time <= upper` in seconds puts
+    # `HH:MM:00.xxxxxx` into the slot ending at HH:MM and the rest of the minute
+    # into the next one.
+    summaries = {}
+    for record in records:
+        timestamp = record[0]
+        key = (timestamp[:16], timestamp[17:19] == "00")
+        summary = summaries.get(key)
+        if summary is None:
+            summary = summaries[key] = engine.Summary()
+        summary.add(record)
+
+    slots = {}
+    for (minute, on_minute), summary in summaries.items():
+        end = calendar.timegm(
+            datetime.datetime.strptime(minute, "%Y-%m-%dT%H:%M").timetuple()
+        )
+        if not on_minute:
+            end += SLOT
+        if end in slots:
+            slots[end].merge(summary)
+        else:
+            slots[end] = summary
+    return Partials(slots=slots)
+
+
+def encode(partials):
+    """Encode `partials` in a compact binary format, see `decode`."""
+    # Targets and status classes are written once and referred to by index
+    strings = {}
+
+    def index(s):
+        return strings.setdefault(s, len(strings))
+
+    body = []
+    for end in sorted(partials.slots):
+        s = partials.slots[end]
+        body.append(
+            _slot.pack(
+                end,
+                s.no_dispatch,
+                len(s.status),
+                len(s.target_status),
+                len(s.latency),
+            )
+        )
+        for status_class, count in s.status.items():
+            body.append(_status.pack(index(status_class), count))
+        for (target, status_class), count in s.target_status.items():
+            body.append(_target_status.pack(index(target), index(status_class), count))
+        for target, latency in s.latency.items():
+            body.append(
+                _latency.pack(
+                    index(target),
+                    latency.count,
+                    latency.sum,
+                    latency.min if latency.min is not None else math.nan,
+                    latency.max if latency.max is not None else math.nan,
+                    latency.zero_count,
+                    len(latency.buckets),
+                )
+            )
+            for i, count in latency.buckets.items():
+                body.append(_bucket.pack(i, count))
+
+    head = [
+        _header.pack(MAGIC, sketch.RELATIVE_ACCURACY, len(strings), len(partials.slots))
+    ]
+    for s in strings:
+        data = s.encode("utf-8")
+        head.append(_string.pack(len(data)) + data)
+    return b"".join(head + body)
+
+
+def decode(data):
+    """Decode what `encode` returned, or return None if it is of another format."""
+    if len(data) < _header.size:
+        return None
+    magic, relative_accuracy, n_strings, n_slots = _header.unpack_from(data, 0)
+    if magic != MAGIC or relative_accuracy != sketch.RELATIVE_ACCURACY:
+        return None
+    offset = _header.size
+
+    strings = []
+    for _ in range(n_strings):
+        (n,) = _string.unpack_from(data, offset)
+        offset += _string.size
+        strings.append(data[offset : offset + n].decode("utf-8"))  # noqa: E203
+        offset += n
+
+    slots = {}
+    for _ in range(n_slots):
+        end, no_dispatch, n_status, n_target_status, n_latency = _slot.unpack_from(
+            data, offset
+        )
+        offset += _slot.size
+        s = engine.Summary()
+        s.no_dispatch = no_dispatch
+        for _ in range(n_status):
+            i, count = _status.unpack_from(data, offset)
+            offset += _status.size
+            s.status[strings[i]] = count
+        for _ in range(n_target_status):
+            t, i, count = _target_status.unpack_from(data, offset)
+            offset += _target_status.size
+            s.target_status[(strings[t], strings[i])] = count
+        for _ in range(n_latency):
+            t, count, total, minimum, maximum, zero_count, n_buckets = (
+                _latency.unpack_from(data, offset)
+            )
+            offset += _latency.size
+            buckets = {}
+            for _ in range(n_buckets):
+                i, c = _bucket.unpack_from(data, offset)
+                offset += _bucket.size
+                buckets[i] = c
+            s.latency[strings[t]] = sketch.Sketch.from_summary(
+                count=count,
+                total=total,
+                minimum=None if math.isnan(minimum) else minimum,
+                maximum=None if math.isnan(maximum) else maximum,
+                buckets=buckets,
+                zero_count=zero_count,
+            )
+        slots[end] = s
+    return Partials(slots=slots)
+
+
+def _name(key="", etag=""):
+    # An object is only replaced under the same key with another ETag
+    return hashlib.sha256((key + "\0" + etag).encode("utf-8")).hexdigest()
+
+
+class DiskStore:
+    """DiskStore keeps entries as files in `directory`, up to `max_bytes` in total.
+
+    The least recently used entries are removed first. Files are touched when
+    read, so the order survives warm Lambda containers and restarts.
+    """
+
+    def __init__(self, directory="", max_bytes=CACHE_SIZE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        # name -> size, least recently used first
+        self.entries = collections.OrderedDict()
+        files = []
+        for name in os.listdir(directory):
+            if name.endswith(".tmp"):
+                continue
+            st = os.stat(os.path.join(directory, name))
+            files.append((st.st_mtime, name, st.st_size))
+        for _, name, size in sorted(files):
+            self.entries[name] = size
+        self.size = sum(self.entries.values())
+
+    def get(self, name):
+        path = os.path.join(self.directory, name)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            return None
+        with self.lock:
+            if name in self.entries:
+                self.entries.move_to_end(name)
+        return data
+
+    def path(self, name):
+        """Return the path of the entry `name`, touched as `get` does, or None."""
+        path = os.path.join(self.directory, name)
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        with self.lock:
+            if name in self.entries:
+                self.entries.move_to_end(name)
+        return path
+
+    def put(self, name, data):
+        path = os.path.join(self.directory, name)
+        tmp = "{path}.{thread}.tmp".format(path=path, thread=threading.get_ident())
+        try:
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError:
+            # Out of space, the entry is computed again next time
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return
+        with self.lock:
+            self.size += len(data) - self.entries.pop(name, 0)
+            self.entries[name] = len(data)
+            evicted = []
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                oldest, size = self.entries.popitem(last=False)
+                self.size -= size
+                evicted.append(oldest)
+        for oldest in evicted:
+            try:
+                os.remove(os.path.join(self.directory, oldest))
+            except OSError:
+                pass
+
+
+class S3Store:
+    """S3Store keeps entries as objects under `prefix`.
+
+    Nothing is evicted, expire the objects with a lifecycle rule of the bucket.
+    """
+
+    def __init__(self, s3_client=None, bucket="", prefix=""):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def get(self, name):
+        try:
+            resp = self.s3_client.get_object(Bucket=self.bucket, Key=self.prefix + name)
+        except self.s3_client.exceptions.NoSuchKey:
+            return None
+        return resp["Body"].read()
+
+    def put(self, name, data):
+        self.s3_client.put_object(Bucket=self.bucket, Key=self.prefix + name, Body=data)
+
+
+def open_store(location="", s3_client=None, max_bytes=CACHE_SIZE):
+    """Open the store at `location`, either `s3://<bucket>/<prefix>` or a directory."""
+    if location.startswith("s3://"):
+        bucket, _, prefix = location[len("s3://") :].partition("/")  # noqa: E203
+        if prefix != "" and not prefix.endswith("/"):
+            prefix = prefix + "/"
+        return S3Store(s3_client=s3_client, bucket=bucket, prefix=prefix)
+    return DiskStore(directory=location, max_bytes=max_bytes)
+
+
+class Cache:
+    """Cache keeps the Partials of objects, keyed by object key and ETag."""
+
+    def __init__(self, store=None):
+        self.store = store
+
+    def get(self, key="", etag=""):
+        data = self.store.get(_name(key=key, etag=etag))
+        partials = decode(data) if data is not None else None
+        if partials is None:
+            instrument.count("partials.misses", key=key)
+            return None
+        instrument.count("partials.hits", key=key)
+        return partials
+
+    def put(self, key="", etag="", partials=None):
+        data = encode(partials)
+        self.store.put(_name(key=key, etag=etag), data)
+        instrument.count("bytes.cached", len(data), key=key)
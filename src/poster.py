@@ -0,0 +1,124 @@
+import concurrent.futures
+import hashlib
+import json
+import random
+import time
+
+# Points of one `post_metrics` request and its approximate body size
+BATCH_SIZE = 500
+MAX_BATCH_BYTES = 512 * 1024
+ATTEMPTS = 3
+BACKOFF_SECONDS = 0.5
+# Unchanged graph definitions are created again after this, in case they
+# were deleted or edited on Mackerel.
+GRAPH_DEFINITION_TTL = 24 * 60 * 60
+
+# Kept in module scope, so warm Lambda containers skip unchanged definitions.
+# name -> [digest, created time]
+_graph_definitions = {}
+
+
+class Result:
+    """Result of posting, with the points of the batches that failed."""
+
+    def __init__(self):
+        self.batches = 0
+        self.posted = 0
+        # [(points, exception), ...]
+        self.failed = []
+
+    @property
+    def failed_points(self):
+        return sum(len(points) for points, _ in self.failed)
+
+
+def retry(call, attempts=ATTEMPTS, backoff=BACKOFF_SECONDS, sleep=time.sleep):
+    """Call `call` until it succeeds, sleeping with exponential backoff between attempts."""
+    for attempt in range(attempts):
+        try:
+            return call()
+        except Exception:
+            if attempt == attempts - 1:
+                raise
+            # Full jitter, so concurrent batches do not retry in lockstep
+            sleep(random.uniform(0, backoff * 2**attempt))
+
+
+def digest(param):
+    return hashlib.sha256(json.dumps(param, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def create_graph_definitions(
+    mkr_client=None, params=None, cache=None, ttl=GRAPH_DEFINITION_TTL
+):
+    """Create the graph definitions of `params` that changed since last created.
+
+    `cache` maps a definition name to its digest and creation time, the
+    module cache when None. Return the number of definitions created.
+    """
+    if cache is None:
+        cache = _graph_definitions
+    now = time.time()
+    created = 0
+    for param in params:
+        d = digest(param)
+        entry = cache.get(param["name"])
+        if entry is not None and entry[0] == d and now - entry[1] < ttl:
+            continue
+        retry(
+            lambda: mkr_client.create_graph_definition(
+                name=param["name"],
+                display_name=param["name"],
+                unit=param["unit"],
+                metrics=param["metrics"],
+            )
+        )
+        cache[param["name"]] = [d, now]
+        created += 1
+    return created
+
+
+def batches(data, size=BATCH_SIZE, max_bytes=MAX_BATCH_BYTES):
+    """Split `data` into lists of at most `size` points and about `max_bytes`."""
+    batch = []
+    length = 0
+    for point in data:
+        n = len(json.dumps(point)) + 2
+        if len(batch) > 0 and (len(batch) >= size or length + n > max_bytes):
+            yield batch
+            batch = []
+            length = 0
+        batch.append(point)
+        length += n
+    if len(batch) > 0:
+        yield batch
+
+
+def post(
+    mkr_client=None,
+    data=None,
+    size=BATCH_SIZE,
+    workers=1,
+    attempts=ATTEMPTS,
+    backoff=BACKOFF_SECONDS,
+):
+    """Post `data` in batches, retrying each batch, and return the Result.
+
+    A batch failing all of its attempts does not stop the others.
+    """
+    result = Result()
+
+    def send(batch):
+        retry(lambda: mkr_client.post_metrics(metrics=batch), attempts, backoff)
+
+    chunks = list(batches(data, size=size))
+    result.batches = len(chunks)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        futures = [executor.submit(send, batch) for batch in chunks]
+        for batch, future in zip(chunks, futures):
+            try:
+                future.result()
+                result.posted += len(batch)
+            except Exception as e:
+                result.failed.append((batch, e))
+    return result
@@ -1,20 +1,43 @@
-from mackerel.clienthde import Client
+import logs
+import resolver
+import spec
+import topk
 
 
 class Builder:
-    def __init__(self, mackerel_apikey, mackerel_service, mackerel_role):
-        self.target_hosts = {}
+    def __init__(
+        self,
+        mkr_client=None,
+        mackerel_service="",
+        mackerel_role=None,
+        ttl=resolver.CACHE_TTL,
+    ):
         self.queries = []
 
-        mkr = Client(mackerel_api_key=mackerel_apikey)
-        self.target_hosts = mkr.get_hosts(service=mackerel_service, role=mackerel_role)
-        self.alb_hosts = mkr.get_hosts(service=mackerel_service, role="alb")
+        # Hosts are looked up with the Mackerel client points are posted with
+        self.target_hosts = resolver.host_index(
+            mkr_client=mkr_client,
+            service=mackerel_service,
+            role=mackerel_role,
+            ttl=ttl,
+        )
+        self.alb_hosts = resolver.host_index(
+            mkr_client=mkr_client, service=mackerel_service, role="alb", ttl=ttl
+        )
 
-    def build(self, prefix="alb", alb="", targets=None, between=""):
+    def build(
+        self,
+        prefix="alb",
+        alb="",
+        targets=None,
+        percentiles=None,
+        breakdowns=None,
+        breakdown_size=topk.SIZE,
+        metrics=None,
+    ):
+        """Build the query groups of the metric spec `metrics`, spec.DEFAULT if None."""
         self.queries = []
 
-        if prefix != "" and prefix is not None:
-            prefix = prefix + "."
         if alb == "":
             return "`alb` args is null string"
         alb_host_id = self._alb_to_host_id(name=alb)
@@ -23,152 +46,77 @@ class Builder:
         if targets is None:
             return "`targets` args is None"
 
-        # Build basic query
-        self.queries = [
-            {
-                "name": "custom.{prefix}target_status_code.all".format(prefix=prefix),
-                "unit": "integer",
-                "host_id": alb_host_id,
-                "query": [
-                    {
-                        "name": "custom.{prefix}target_status_code.all.2xx".format(
-                            prefix=prefix
-                        ),
-                        "query": "SELECT COUNT(*) FROM S3Object s WHERE s._10 LIKE '2%' AND {between}".format(
-                            between=between
-                        ),
-                    },
-                    {
-                        "name": "custom.{prefix}target_status_code.all.3xx".format(
-                            prefix=prefix
-                        ),
-                        "query": "SELECT COUNT(*) FROM S3Object s WHERE s._10 LIKE '3%' AND {between}".format(
-                            between=between
-                        ),
-                    },
-                    {
-                        "name": "custom.{prefix}target_status_code.all.4xx".format(
-                            prefix=prefix
-                        ),
-                        "query": "SELECT COUNT(*) FROM S3Object s WHERE s._10 LIKE '4%' AND {between}".format(
-                            between=between
-                        ),
-                    },
-                    {
-                        "name": "custom.{prefix}target_status_code.all.5xx".format(
-                            prefix=prefix
-                        ),
-                        "query": "SELECT COUNT(*) FROM S3Object s WHERE s._10 LIKE '5%' AND {between}".format(
-                            between=between
-                        ),
-                    },
-                ],
-            },
-            {
-                "name": "custom.{prefix}no_dispatch.all".format(prefix=prefix),
-                "unit": "integer",
-                "host_id": alb_host_id,
-                "query": [
-                    {
-                        "name": "custom.{prefix}no_dispatch.all.count".format(
-                            prefix=prefix
-                        ),
-                        "query": "SELECT COUNT(*) FROM S3Object s WHERE (s._6 = -1 OR s._7 = -1 OR s._8 = -1) AND {between}".format(
-                            between=between
-                        ),
-                    }
-                ],
-            },
-            {
-                "name": "custom.{prefix}no_target_response.all".format(prefix=prefix),
-                "unit": "integer",
-                "host_id": alb_host_id,
-                "query": [
-                    {
-                        "name": "custom.{prefix}no_target_response.all.count".format(
-                            prefix=prefix
-                        ),
-                        "query": "SELECT COUNT(*) FROM S3Object s WHERE s._10 = '-' AND {between}".format(
-                            between=between
-                        ),
-                    }
-                ],
-            },
-        ]
-
-        # Build query by target
+        # Series of the targets registered in Mackerel are built anyway
+        err = None
+        target_host_ids = {}
         for target in targets:
             host_id = self._target_to_host_id(target=target)
             if host_id == "":
-                return "`host_id` is not registerd in mackerel"
+                err = "`host_id` is not registerd in mackerel"
+                continue
+            target_host_ids[target] = host_id
 
-            # count status code
-            query = {
-                "name": "custom.{prefix}target_status_code".format(prefix=prefix),
-                "unit": "integer",
-                "host_id": host_id,
-                "query": [
-                    {
-                        "name": "custom.{prefix}target_status_code.2xx".format(
-                            prefix=prefix
-                        ),
-                        "query": "SELECT COUNT(*) FROM S3Object s WHERE s._5 LIKE '{target}' AND s._10 LIKE '2%' AND {between}".format(
-                            target=target, between=between
-                        ),
-                    },
-                    {
-                        "name": "custom.{prefix}target_status_code.3xx".format(
-                            prefix=prefix
-                        ),
-                        "query": "SELECT COUNT(*) FROM S3Object s WHERE s._5 LIKE '{target}' AND s._10 LIKE '3%' AND {between}".format(
-                            target=target, between=between
-                        ),
-                    },
-                    {
-                        "name": "custom.{prefix}target_status_code.4xx".format(
-                            prefix=prefix
-                        ),
-                        "query": "SELECT COUNT(*) FROM S3Object s WHERE s._5 LIKE '{target}' AND s._10 LIKE '4%' AND {between}".format(
-                            target=target, between=between
-                        ),
-                    },
-                    {
-                        "name": "custom.{prefix}target_status_code.5xx".format(
-                            prefix=prefix
-                        ),
-                        "query": "SELECT COUNT(*) FROM S3Object s WHERE s._5 LIKE '{target}' AND s._10 LIKE '5%' AND {between}".format(
-                            target=target, between=between
-                        ),
-                    },
-                ],
-            }
-            self.queries.append(query)
-            # average latency
-            query = {
-                "name": "custom.{prefix}latency.".format(prefix=prefix),
-                "unit": "float",
-                "host_id": host_id,
-                "query": [
+        self.queries = spec.plan(
+            metrics=metrics if metrics is not None else spec.DEFAULT,
+            prefix=prefix,
+            alb_host_id=alb_host_id,
+            targets=[t for t in targets if t in target_host_ids],
+            target_host_ids=target_host_ids,
+            percentiles=percentiles,
+        )
+
+        if prefix != "" and prefix is not None:
+            prefix = prefix + "."
+        # Heaviest items of each field, evaluated by the row based engines only
+        for field in breakdowns or []:
+            for kind in topk.KINDS:
+                name = "custom.{prefix}top.{field}.{kind}".format(
+                    prefix=prefix, field=field, kind=kind
+                )
+                self.queries.append(
                     {
-                        "name": "custom.{prefix}latency.average".format(prefix=prefix),
-                        "query": "SELECT AVG(CAST(s._6 AS FLOAT) + CAST(s._7 AS FLOAT) + CAST(s._8 AS FLOAT)) FROM S3Object s WHERE s._5 LIKE '{target}' AND {between}".format(
-                            target=target, between=between
-                        ),
+                        "name": name,
+                        "unit": topk.UNITS[kind],
+                        "host_id": alb_host_id,
+                        "query": [
+                            {
+                                "name": name,
+                                "target": None,
+                                "match": None,
+                                "aggregate": "top",
+                                "field": field,
+                                "kind": kind,
+                                "size": breakdown_size,
+                            }
+                        ],
                     }
-                ],
-            }
-            self.queries.append(query)
-        return None
+                )
+        return err
+
+    def projection(self, between="", columns=logs.COLUMNS):
+        """Build a query returning the fields of every record in `between`, or all.
+
+        Unlike the queries of `selects`, the records are returned and bucketed
+        by window, target and status class locally.
+        """
+        columns = ", ".join(logs.column(field) for field in columns)
+        if between == "":
+            return "SELECT {columns} FROM S3Object s".format(columns=columns)
+        return "SELECT {columns} FROM S3Object s WHERE {between}".format(
+            columns=columns, between=between
+        )
+
+    def selects(self, between=""):
+        """Build the S3 Select queries aggregating every series built in `between`.
+
+        Return `(query, [(host_id, query item), ...])` of each query, whose
+        columns are the aggregates of the items in order.
+        """
+        return spec.selects(queries=self.queries, between=between)
 
     def _alb_to_host_id(self, name):
-        for host in self.alb_hosts:
-            if host.name == name:
-                return host.id
-        return ""
+        return self.alb_hosts.by_name.get(name, "")
 
     def _target_to_host_id(self, target):
         ipaddr = target.split(sep=":")[0]
-        for host in self.target_hosts:
-            if ipaddr == host.interfaces[0]["ipAddress"]:
-                return host.id
-        return ""
+        return self.target_hosts.by_ip.get(ipaddr, "")
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+import argparse
+import datetime
+import os
+from logging import getLogger, StreamHandler, INFO
+
+from cli import Cli
+import aggregator
+import columnar
+import engine
+import listing
+import metric
+import poster
+import query
+import resolver
+import segments
+import sinks
+import spec
+import window
+
+__doc__ = (
+    "reaggregate.py aggregates a past time range from the log cache, without reading S3"
+)
+
+handler = StreamHandler()
+handler.setLevel(INFO)
+
+logger = getLogger("alb-accesslog-aggregator.reaggregate")
+logger.setLevel(INFO)
+logger.addHandler(handler)
+logger.propagate = False
+
+ENGINES = ("local", "numpy")
+TIME_FORMAT = "%Y-%m-%dT%H:%M"
+
+
+def reaggregate(
+    cli=None,
+    mkr_client=None,
+    cache=None,
+    start=None,
+    end=None,
+    engine_name="local",
+    metric_spec=None,
+    account_id="",
+):
+    """Aggregate the segments of `cache` holding records of `start` - `end`.
+
+    Only the segments of the load balancer of `cli` in `account_id` and the
+    region of `cli` are read, and its targets are those logged in them.
+    Return the metrics and the graph definition params, or None when no
+    segment is found.
+    """
+    name = cli.load_balancer_name
+    windows = window.cover(start=start, end=end, duration=cli.duration)
+    found = []
+    targets = set()
+    for path in cache.segments(start=start, end=end):
+        try:
+            segment = segments.Segment(path)
+        except (OSError, ValueError):
+            continue
+        # Load balancers of the same name may log to the cache from other
+        # accounts or regions
+        if listing.key_load_balancer(segment.key) != (account_id, cli.region, name):
+            segment.close()
+            continue
+        found.append(segment)
+        targets.update(segment.dictionaries["target"])
+    if len(found) == 0:
+        return None
+    targets.discard("-")
+
+    builder = query.Builder(
+        mkr_client=mkr_client,
+        mackerel_service=cli.mackerel_service,
+        mackerel_role=cli.mackerel_role,
+        ttl=cli.cache_ttl,
+    )
+    err = builder.build(
+        prefix=cli.prefix,
+        alb=name,
+        targets=sorted(targets),
+        percentiles=cli.percentiles,
+        breakdowns=cli.topk_fields,
+        breakdown_size=cli.topk_size,
+        metrics=metric_spec,
+    )
+    if err is not None:
+        logger.error("Reaggregate failed to build queries: " + err)
+    top, extra = aggregator.summarizers(
+        cli=cli, queries=builder.queries, breakdowns=cli.topk_fields
+    )
+
+    metrics = metric.Metrics()
+    for segment in found:
+        with segment:
+            summaries = segments.summarize(
+                segment, windows, engine_name=engine_name, top=top, extra=extra
+            )
+            m = metric.Metrics()
+            engine.collect(
+                metrics=m, queries=builder.queries, windows=windows, summaries=summaries
+            )
+            metrics.merge(m)
+    logger.info(
+        "Reaggregated {segments} segments into {windows} windows".format(
+            segments=len(found), windows=len(windows)
+        )
+    )
+    return metrics, metric.create_graph_definition_param(queries=builder.queries)
+
+
+def main():
+    description = __doc__
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        "--start",
+        metavar="YYYY-MM-DDTHH:MM",
+        action="store",
+        dest="start",
+        required=True,
+        help="UTC start of the range",
+    )
+    parser.add_argument(
+        "--end",
+        metavar="YYYY-MM-DDTHH:MM",
+        action="store",
+        dest="end",
+        required=True,
+        help="UTC end of the range",
+    )
+    parser.add_argument(
+        "--load-balancer-name",
+        metavar="NAME",
+        action="store",
+        dest="load_balancer_name",
+        default="",
+        help="ALB to reaggregate, LOAD_BALANCER_NAME by default",
+    )
+    parser.add_argument(
+        "--cache",
+        metavar="DIRECTORY",
+        action="store",
+        dest="cache",
+        default="",
+        help="Directory of the segments, LOG_CACHE by default",
+    )
+    parser.add_argument(
+        "--account-id",
+        metavar="ID",
+        action="store",
+        dest="account_id",
+        default="",
+        help="AWS account of the ALB, that of the caller by default",
+    )
+    parser.add_argument(
+        "--engine",
+        metavar="ENGINE",
+        action="store",
+        dest="engine",
+        default="local",
+        choices=ENGINES,
+    )
+    parser.add_argument(
+        "--output",
+        metavar="FILE",
+        action="store",
+        dest="output",
+        default="",
+        help="Write the points to FILE as JSON lines instead of posting them",
+    )
+    args = parser.parse_args()
+
+    if args.load_balancer_name != "":
+        os.environ["LOAD_BALANCER_NAME"] = args.load_balancer_name
+    cli = Cli()
+    if len(cli.load_balancer_names) != 1:
+        logger.error("Reaggregate requires exactly one load balancer name")
+        exit(1)
+    directory = args.cache or cli.log_cache
+    if directory == "" or not os.path.isdir(directory):
+        logger.error("Reaggregate requires the directory of the log cache")
+        exit(1)
+    if args.engine == "numpy" and not columnar.available():
+        logger.error("Engine `numpy` requires numpy to be installed")
+        exit(1)
+    metric_spec, err = spec.load(cli.metric_spec)
+    if err is not None:
+        logger.error("Reaggregate failed to load the metric spec: " + err)
+        exit(1)
+    start = datetime.datetime.strptime(args.start, TIME_FORMAT)
+    end = datetime.datetime.strptime(args.end, TIME_FORMAT)
+
+    account_id = args.account_id
+    if account_id == "":
+        import boto3
+
+        account_id = resolver.account_id(sts_client=boto3.client("sts"))
+
+    from mackerel.clienthde import Client
+
+    mkr = Client(mackerel_api_key=cli.mackerel_apikey)
+    result = reaggregate(
+        cli=cli,
+        mkr_client=mkr,
+        cache=segments.Cache(directory=directory, max_bytes=cli.log_cache_size),
+        start=start,
+        end=end,
+        engine_name=args.engine,
+        metric_spec=metric_spec,
+        account_id=account_id,
+    )
+    if result is None:
+        logger.info("No segment holds records of the range")
+        return
+    metrics, params = result
+
+    if args.output != "":
+        outputs = [sinks.JSONLinesSink(path=args.output)]
+    else:
+        if "mackerel" in cli.sinks:
+            poster.create_graph_definitions(mkr_client=mkr, params=params)
+        outputs = sinks.open_sinks(cli=cli, mkr_client=mkr)
+    fanout = sinks.Fanout(sinks=outputs, queue_size=cli.sink_queue_size)
+    ok = []
+    for point in metrics:
+        fanout.put(point)
+    fanout.mark(ok.append)
+    fanout.close()
+    if not all(ok):
+        logger.error("Reaggregate failed to write the points")
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+import time
+
+CACHE_TTL = 300  # 5 Min.
+# `describe_instances` accepts up to 200 values in a filter
+DESCRIBE_INSTANCES_BATCH = 200
+# `describe_tags` accepts up to 20 resource ARNs
+DESCRIBE_TAGS_BATCH = 20
+
+# Kept in module scope, so warm Lambda containers reuse what the previous
+# invocations resolved. key -> (fetched time, value)
+_cache = {}
+
+
+def cached(key, fetch, ttl=CACHE_TTL):
+    entry = _cache.get(key)
+    now = time.time()
+    if entry is not None and now - entry[0] < ttl:
+        return entry[1]
+    value = fetch()
+    _cache[key] = (now, value)
+    return value
+
+
+def clear():
+    _cache.clear()
+
+
+def account_id(sts_client=None):
+    """Return the AWS account ID of the caller, asked once per container."""
+    return cached(
+        ("account_id",),
+        lambda: sts_client.get_caller_identity()["Account"],
+        ttl=float("inf"),
+    )
+
+
+class HostIndex:
+    """HostIndex looks up Mackerel hosts by name and by IP address."""
+
+    def __init__(self, hosts=None):
+        self.by_name = {}
+        self.by_ip = {}
+        for host in hosts or []:
+            self.by_name.setdefault(host.name, host.id)
+            if len(host.interfaces) > 0:
+                self.by_ip.setdefault(host.interfaces[0]["ipAddress"], host.id)
+
+
+def host_index(mkr_client=None, service="", role=None, ttl=CACHE_TTL):
+    if isinstance(role, list):
+        key = ("hosts", service, tuple(role))
+    else:
+        key = ("hosts", service, role)
+    return cached(
+        key,
+        lambda: HostIndex(hosts=mkr_client.get_hosts(service=service, role=role)),
+        ttl=ttl,
+    )
+
+
+def instance_private_ips(ec2_client=None, instance_ids=None, ttl=CACHE_TTL):
+    """Resolve instance IDs to private IP addresses with batched requests."""
+    now = time.time()
+    ips = {}
+    missing = []
+    for instance_id in instance_ids:
+        entry = _cache.get(("instance", instance_id))
+        if entry is not None and now - entry[0] < ttl:
+            ips[instance_id] = entry[1]
+        elif instance_id not in ips:
+            ips[instance_id] = None
+            missing.append(instance_id)
+
+    for i in range(0, len(missing), DESCRIBE_INSTANCES_BATCH):
+        params = {
+            "Filters": [
+                {
+                    "Name": "instance-id",
+                    "Values": missing[i : i + DESCRIBE_INSTANCES_BATCH],  # noqa: E203
+                }
+            ]
+        }
+        while True:
+            resp = ec2_client.describe_instances(**params)
+            for reservation in resp["Reservations"]:
+                for instance in reservation["Instances"]:
+                    if "PrivateIpAddress" not in instance:
+                        continue
+                    ips[instance["InstanceId"]] = instance["PrivateIpAddress"]
+                    _cache[("instance", instance["InstanceId"])] = (
+                        now,
+                        instance["PrivateIpAddress"],
+                    )
+            if "NextToken" not in resp:
+                break
+            params["NextToken"] = resp["NextToken"]
+    # Terminated instances have no private IP address
+    return {k: v for k, v in ips.items() if v is not None}
+
+
+def targets(elbv2_client=None, ec2_client=None, load_balancer_arn="", ttl=CACHE_TTL):
+    """List `<ip>:<port>` of every target registered to the load balancer."""
+    # (instance ID or IP address, port, whether the target is an instance)
+    registered = []
+    # ToDo(Very low priority): support marker args
+    target_groups = elbv2_client.describe_target_groups(
+        LoadBalancerArn=load_balancer_arn
+    )["TargetGroups"]
+    for target_group in target_groups:
+        # Only instance and ip based target groups log `<ip>:<port>`
+        if target_group["TargetType"] not in ("instance", "ip"):
+            continue
+        health_descriptions = elbv2_client.describe_target_health(
+            TargetGroupArn=target_group["TargetGroupArn"]
+        )
+        for health in health_descriptions["TargetHealthDescriptions"]:
+            registered.append(
+                (
+                    health["Target"]["Id"],
+                    health["Target"]["Port"],
+                    target_group["TargetType"] == "instance",
+                )
+            )
+
+    ips = instance_private_ips(
+        ec2_client=ec2_client,
+        instance_ids=[host for host, _, instance in registered if instance],
+        ttl=ttl,
+    )
+    result = []
+    for host, port, instance in registered:
+        if instance:
+            if host not in ips:
+                continue
+            host = ips[host]
+        result.append("{host}:{port}".format(host=host, port=str(port)))
+    return result
+
+
+def load_balancers_by_tags(elbv2_client=None, tags=None, ttl=CACHE_TTL):
+    """List the names of the application load balancers having all of `tags`."""
+
+    def fetch():
+        # ARN -> name
+        names = {}
+        params = {}
+        while True:
+            resp = elbv2_client.describe_load_balancers(**params)
+            for lb in resp["LoadBalancers"]:
+                if lb.get("Type", "application") == "application":
+                    names[lb["LoadBalancerArn"]] = lb["LoadBalancerName"]
+            if "NextMarker" not in resp:
+                break
+            params["Marker"] = resp["NextMarker"]
+
+        arns = list(names)
+        result = []
+        for i in range(0, len(arns), DESCRIBE_TAGS_BATCH):
+            resp = elbv2_client.describe_tags(
+                ResourceArns=arns[i : i + DESCRIBE_TAGS_BATCH]  # noqa: E203
+            )
+            for description in resp["TagDescriptions"]:
+                values = {t["Key"]: t["Value"] for t in description["Tags"]}
+                if all(values.get(k) == v for k, v in tags.items()):
+                    result.append(names[description["ResourceArn"]])
+        return sorted(result)
+
+    return cached(("load_balancers", tuple(sorted(tags.items()))), fetch, ttl=ttl)
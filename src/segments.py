@@ -0,0 +1,385 @@
+import array
+import bisect
+import calendar
+import datetime
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+
+import columnar
+import engine
+import instrument
+import logs
+import partials
+import sketch
+
+# Fields a segment keeps, every field `engine.columns` may read
+COLUMNS = logs.COLUMNS + (
+    logs.CLIENT,
+    logs.ELB_STATUS_CODE,
+    logs.REQUEST,
+    logs.USER_AGENT,
+    logs.RECEIVED_BYTES,
+    logs.SENT_BYTES,
+)
+# Column of each field of `COLUMNS` and its type code of `array`. Strings are
+# dictionary encoded, `I` columns are indexes into the dictionary of the column.
+_COLUMNS = (
+    ("time", "q"),
+    ("target", "I"),
+    ("request_time", "d"),
+    ("target_time", "d"),
+    ("response_time", "d"),
+    ("status", "I"),
+    ("client", "I"),
+    ("elb_status", "I"),
+    ("request", "I"),
+    ("user_agent", "I"),
+    ("received_bytes", "q"),
+    ("sent_bytes", "q"),
+)
+_DICTIONARIES = ("target", "status", "client", "elb_status", "request", "user_agent")
+# Column of each field of a record of `engine.columns`
+_FIELDS = {
+    logs.TIME: "time",
+    logs.TARGET: "target",
+    logs.REQUEST_PROCESSING_TIME: "request_time",
+    logs.TARGET_PROCESSING_TIME: "target_time",
+    logs.RESPONSE_PROCESSING_TIME: "response_time",
+    logs.TARGET_STATUS_CODE: "status",
+    logs.CLIENT: "client",
+    logs.ELB_STATUS_CODE: "elb_status",
+    logs.REQUEST: "request",
+    logs.USER_AGENT: "user_agent",
+    logs.RECEIVED_BYTES: "received_bytes",
+    logs.SENT_BYTES: "sent_bytes",
+}
+
+MAGIC = b"ALS1"
+# Magic, length of the JSON metadata, time of the first and last record in
+# microseconds since the epoch, and number of records
+_header = struct.Struct("<4sIqqQ")
+ALIGNMENT = 8
+
+
+def _microseconds(timestamps):
+    """Convert ALB timestamps `YYYY-MM-DDTHH:MM:SS.ffffffZ` to microseconds since the epoch."""
+    # Records of an object fall in a few hundred seconds
+    seconds = {}
+    result = array.array("q")
+    for t in timestamps:
+        s = seconds.get(t[:19])
+        if s is None:
+            s = seconds[t[:19]] = calendar.timegm(
+                datetime.datetime.strptime(t[:19], "%Y-%m-%dT%H:%M:%S").timetuple()
+            )
+        result.append(s * 1000000 + int(t[20:26] or 0))
+    return result
+
+
+def encode(records, key="", etag=""):
+    """Encode `records` of `COLUMNS` as a segment, sorted by time."""
+    records = sorted(records, key=lambda r: r[0])
+    fields = list(zip(*records)) or [()] * len(COLUMNS)
+    columns = []
+    dictionaries = {}
+    for (name, typecode), values in zip(_COLUMNS, fields):
+        if name == "time":
+            columns.append(_microseconds(values))
+        elif name in _DICTIONARIES:
+            index = {}
+            columns.append(
+                array.array("I", (index.setdefault(v, len(index)) for v in values))
+            )
+            dictionaries[name] = list(index)
+        elif typecode == "d":
+            columns.append(array.array("d", (float(v) for v in values)))
+        else:
+            # `-` for no value is kept as -1
+            columns.append(
+                array.array("q", (int(v) if v != "-" else -1 for v in values))
+            )
+
+    # Columns follow the metadata from the first aligned offset, each aligned
+    # for its type as every type is at most 8 bytes
+    layout = []
+    offset = 0
+    for (name, typecode), column in zip(_COLUMNS, columns):
+        layout.append([name, typecode, offset])
+        offset += -(-len(column) * column.itemsize // ALIGNMENT) * ALIGNMENT
+    meta = json.dumps(
+        {
+            "key": key,
+            "etag": etag,
+            "byteorder": sys.byteorder,
+            "columns": layout,
+            "dictionaries": dictionaries,
+        },
+        separators=(",", ":"),
+    ).encode("utf-8")
+    start = _start(len(meta))
+
+    times = columns[0]
+    head = _header.pack(
+        MAGIC,
+        len(meta),
+        times[0] if len(times) > 0 else 0,
+        times[-1] if len(times) > 0 else 0,
+        len(times),
+    )
+    body = [head, meta, b"\0" * (start - len(head) - len(meta))]
+    for column in columns:
+        data = column.tobytes()
+        body.append(data)
+        body.append(b"\0" * (-len(data) % ALIGNMENT))
+    return b"".join(body)
+
+
+def _start(length):
+    """Return the offset of the columns after metadata of `length` bytes."""
+    return -(-(_header.size + length) // ALIGNMENT) * ALIGNMENT
+
+
+def read_header(path=""):
+    """Return the first and last time and the records of the segment at `path`, or None."""
+    try:
+        with open(path, "rb") as f:
+            data = f.read(_header.size)
+    except OSError:
+        return None
+    if len(data) < _header.size:
+        return None
+    magic, _, first, last, rows = _header.unpack(data)
+    if magic != MAGIC:
+        return None
+    return first, last, rows
+
+
+class Segment:
+    """Segment maps the records of an object, as written by `encode`, into memory.
+
+    Columns are memoryviews of the mapped file, so records are read without
+    being copied or parsed. The file is closed by `close`.
+    """
+
+    def __init__(self, path=""):
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, length, self.first, self.last, self.rows = _header.unpack_from(
+            self.mm, 0
+        )
+        if magic != MAGIC:
+            self.mm.close()
+            raise ValueError("not a segment: " + path)
+        metadata = json.loads(
+            self.mm[_header.size : _header.size + length].decode("utf-8")  # noqa: E203
+        )
+        if metadata["byteorder"] != sys.byteorder:
+            self.mm.close()
+            raise ValueError("segment of another byte order: " + path)
+        self.key = metadata["key"]
+        self.etag = metadata["etag"]
+        self.dictionaries = metadata["dictionaries"]
+        view = memoryview(self.mm)
+        start = _start(length)
+        # Column name -> memoryview of `rows` items
+        self.columns = {}
+        for name, typecode, offset in metadata["columns"]:
+            offset += start
+            end = offset + self.rows * array.array(typecode).itemsize
+            self.columns[name] = view[offset:end].cast(typecode)
+        view.release()
+
+    def range(self, w):
+        """Return the indexes `[lo, hi)` of the records in the window `w`.
+
+        A record is in `w` when its time truncated to the second is in
+        `(w.start, w.end]`, as `w.lower <= time <= w.upper` is for strings.
+        """
+        times = self.columns["time"]
+        lower = (calendar.timegm(w.start.timetuple()) + 1) * 1000000
+        upper = (calendar.timegm(w.end.timetuple()) + 1) * 1000000
+        return bisect.bisect_left(times, lower), bisect.bisect_left(times, upper)
+
+    def records(self, lo=0, hi=None, columns=logs.COLUMNS):
+        """Yield records of `columns` from `lo` up to `hi`, the time in microseconds.
+
+        The times are the fields `engine.Summary` reads as strings, `-1` for
+        a request not dispatched.
+        """
+        if hi is None:
+            hi = self.rows
+        getters = []
+        for field in columns:
+            name = _FIELDS[field]
+            values = self.columns[name][lo:hi]
+            if name in self.dictionaries:
+                getters.append(map(self.dictionaries[name].__getitem__, values))
+            elif name.endswith("_time"):
+                getters.append(map(_time, values))
+            elif name.endswith("_bytes"):
+                getters.append(map(_bytes, values))
+            else:
+                getters.append(iter(values))
+        return zip(*getters)
+
+    def close(self):
+        for column in self.columns.values():
+            column.release()
+        self.columns = {}
+        self.mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _time(value):
+    return "-1" if value == -1 else repr(value)
+
+
+def _bytes(value):
+    return "-" if value == -1 else str(value)
+
+
+def _summarize(segment, lo, hi):
+    """Summarize the records `[lo, hi)` of `segment` without building them."""
+    summary = engine.Summary()
+    c = segment.columns
+    targets = segment.dictionaries["target"]
+    classes = [s[:1] for s in segment.dictionaries["status"]]
+    # (target index, status index) -> count, target index -> latency sketch
+    counts = {}
+    latency = {}
+    for target, status, request_time, target_time, response_time in zip(
+        c["target"][lo:hi],
+        c["status"][lo:hi],
+        c["request_time"][lo:hi],
+        c["target_time"][lo:hi],
+        c["response_time"][lo:hi],
+    ):
+        key = (target, status)
+        counts[key] = counts.get(key, 0) + 1
+        if request_time == -1 or target_time == -1 or response_time == -1:
+            summary.no_dispatch += 1
+            continue
+        if target not in latency:
+            latency[target] = sketch.Sketch()
+        latency[target].add(request_time + target_time + response_time)
+
+    for (target, status), count in counts.items():
+        status_class = classes[status]
+        summary.status[status_class] = summary.status.get(status_class, 0) + count
+        key = (targets[target], status_class)
+        summary.target_status[key] = summary.target_status.get(key, 0) + count
+    for target, value in latency.items():
+        summary.latency[targets[target]] = value
+    return summary
+
+
+def summarize(segment, windows, engine_name="local", top=None, extra=None):
+    """Summarize the records of `segment` into `windows`, as `engine.summarize` does.
+
+    Only the records of each window are read, located by their sorted times.
+    The `numpy` engine reads the columns as arrays over the mapped file.
+    """
+    summaries = []
+    columns = engine.columns(top=top, extra=extra)
+    for w in windows:
+        lo, hi = segment.range(w)
+        if engine_name == "numpy":
+            summary = columnar.summarize_segment(segment, lo, hi)
+        elif top is None and extra is None:
+            summary = _summarize(segment, lo, hi)
+        else:
+            summary = engine.Summary(
+                top=top() if top is not None else None,
+                extra=extra() if extra is not None else None,
+            )
+            for record in segment.records(lo, hi, columns=columns):
+                summary.add(record)
+            summaries.append(summary)
+            continue
+        if top is not None or extra is not None:
+            summary.top = top() if top is not None else None
+            summary.extra = extra() if extra is not None else None
+            for record in segment.records(lo, hi, columns=columns):
+                if summary.extra is not None:
+                    summary.extra.add(record)
+                if summary.top is None:
+                    continue
+                if "-1" in (record[2], record[3], record[4]):
+                    summary.top.add(record)
+                else:
+                    summary.top.add(
+                        record, float(record[2]) + float(record[3]) + float(record[4])
+                    )
+        summaries.append(summary)
+    return summaries
+
+
+def _name(key="", etag=""):
+    return hashlib.sha256((key + "\0" + etag).encode("utf-8")).hexdigest() + ".seg"
+
+
+class Cache:
+    """Cache keeps the records of objects as segments in `directory`, keyed by key and ETag.
+
+    Segments take up to `max_bytes`, the least recently used being removed
+    first, as `partials.DiskStore` does.
+    """
+
+    def __init__(self, directory="", max_bytes=partials.CACHE_SIZE):
+        self.store = partials.DiskStore(directory=directory, max_bytes=max_bytes)
+
+    def get(self, key="", etag=""):
+        """Return the Segment of the object, or None."""
+        path = self.store.path(_name(key=key, etag=etag))
+        segment = None
+        if path is not None:
+            try:
+                segment = Segment(path)
+            except (OSError, ValueError):
+                segment = None
+        if segment is None:
+            instrument.count("segments.misses", key=key)
+            return None
+        instrument.count("segments.hits", key=key)
+        return segment
+
+    def put(self, key="", etag="", records=None):
+        """Write `records` of `COLUMNS` as the segment of the object and return it."""
+        data = encode(records, key=key, etag=etag)
+        name = _name(key=key, etag=etag)
+        self.store.put(name, data)
+        instrument.count("bytes.segments", len(data), key=key)
+        path = self.store.path(name)
+        if path is None:
+            # Not written, out of space
+            return None
+        return Segment(path)
+
+    def segments(self, start=None, end=None):
+        """Return the paths of the segments with records in `(start, end]`, oldest first.
+
+        Only the header of each segment is read.
+        """
+        lower = (calendar.timegm(start.timetuple()) + 1) * 1000000
+        upper = (calendar.timegm(end.timetuple()) + 1) * 1000000
+        found = []
+        for name in sorted(os.listdir(self.store.directory)):
+            if not name.endswith(".seg"):
+                continue
+            path = os.path.join(self.store.directory, name)
+            header = read_header(path)
+            if header is None:
+                continue
+            first, last, rows = header
+            if rows > 0 and first < upper and last >= lower:
+                found.append((first, path))
+        return [path for _, path in sorted(found)]
@@ -0,0 +1,388 @@
+import json
+import math
+import os
+import queue
+import re
+import socket
+import struct
+import threading
+import time
+
+import poster
+
+SINKS = ("mackerel", "ganglia", "openmetrics")
+# Points waiting for each sink. `Fanout.put` blocks while a queue is full.
+QUEUE_SIZE = 10000
+FLUSH_INTERVAL = 1.0
+
+GANGLIA_PORT = 8649
+GANGLIA_TMAX = 60
+OPENMETRICS_PATH = "/tmp/alb-accesslog-aggregator.prom"
+
+
+class Sink:
+    """Sink writes points to a backend, in batches of up to `batch_size`.
+
+    A batch is written when it is full or `flush_interval` seconds after the
+    last write, whichever comes first.
+    """
+
+    name = ""
+
+    def __init__(self, batch_size=500, flush_interval=FLUSH_INTERVAL):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.written = 0
+        # [(points, exception), ...]
+        self.failed = []
+
+    @property
+    def failed_points(self):
+        return sum(len(points) for points, _ in self.failed)
+
+    def write(self, points):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class MackerelSink(Sink):
+    """MackerelSink posts points in requests of `batch_size`, `workers` at a time.
+
+    A write takes up to `workers` requests, so they are posted concurrently.
+    """
+
+    name = "mackerel"
+
+    def __init__(
+        self,
+        mkr_client=None,
+        workers=1,
+        attempts=poster.ATTEMPTS,
+        batch_size=poster.BATCH_SIZE,
+        **kwargs
+    ):
+        super().__init__(batch_size=batch_size * max(workers, 1), **kwargs)
+        self.mkr_client = mkr_client
+        self.workers = workers
+        self.attempts = attempts
+        # Points of one request
+        self.post_size = batch_size
+
+    def write(self, points):
+        result = poster.post(
+            mkr_client=self.mkr_client,
+            data=points,
+            size=self.post_size,
+            workers=self.workers,
+            attempts=self.attempts,
+        )
+        self.written += result.posted
+        self.failed.extend(result.failed)
+
+
+def _xdr_int(value):
+    return struct.pack(">i", value)
+
+
+def _xdr_uint(value):
+    return struct.pack(">I", value)
+
+
+def _xdr_string(value):
+    data = value.encode("utf-8")
+    return struct.pack(">I", len(data)) + data + b"\0" * (-len(data) % 4)
+
+
+class GangliaSink(Sink):
+    """GangliaSink sends points to gmond as gmetric UDP packets (Ganglia 3.1+).
+
+    Each point is reported for its Mackerel host ID as a spoofed host and its
+    name without the leading `custom.`. Ganglia has no timestamp, so the value
+    is taken as current when received.
+    """
+
+    name = "ganglia"
+    # Message IDs of `Ganglia_msg_formats`
+    METADATA_FULL = 128
+    VALUE_STRING = 133
+    SLOPE_BOTH = 3
+
+    def __init__(
+        self, host="localhost", port=GANGLIA_PORT, group="", tmax=GANGLIA_TMAX, **kwargs
+    ):
+        super().__init__(**kwargs)
+        self.address = (host, port)
+        self.group = group
+        self.tmax = tmax
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def metadata(self, host="", name=""):
+        return b"".join(
+            [
+                _xdr_uint(self.METADATA_FULL),
+                _xdr_string(host),
+                _xdr_string(name),
+                _xdr_int(1),  # spoofed host
+                _xdr_string("double"),
+                _xdr_string(name),
+                _xdr_string(""),  # units
+                _xdr_uint(self.SLOPE_BOTH),
+                _xdr_uint(self.tmax),
+                _xdr_uint(0),  # dmax, never deleted
+                _xdr_uint(2),
+                _xdr_string("GROUP"),
+                _xdr_string(self.group),
+                _xdr_string("SPOOF_HOST"),
+                _xdr_string(host),
+            ]
+        )
+
+    def value(self, host="", name="", value=0.0):
+        return b"".join(
+            [
+                _xdr_uint(self.VALUE_STRING),
+                _xdr_string(host),
+                _xdr_string(name),
+                _xdr_int(1),
+                _xdr_string("%s"),
+                _xdr_string(repr(float(value))),
+            ]
+        )
+
+    def write(self, points):
+        for point in points:
+            # gmond keys spoofed hosts by `<ip>:<name>`
+            host = "{id}:{id}".format(id=point["hostId"])
+            name = point["name"]
+            if name.startswith("custom."):
+                name = name[len("custom.") :]  # noqa: E203
+            try:
+                # Metadata is resent with every value, gmond may have restarted
+                self.socket.sendto(self.metadata(host=host, name=name), self.address)
+                self.socket.sendto(
+                    self.value(host=host, name=name, value=point["value"]),
+                    self.address,
+                )
+            except OSError as e:
+                self.failed.append(([point], e))
+                continue
+            self.written += 1
+
+    def close(self):
+        self.socket.close()
+
+
+class OpenMetricsSink(Sink):
+    """OpenMetricsSink keeps the latest point of each series in an OpenMetrics text file.
+
+    The file is replaced atomically on every write, so a collector such as the
+    node_exporter textfile collector never reads a partial file. Samples carry
+    no timestamp, as that collector rejects them.
+    """
+
+    name = "openmetrics"
+
+    def __init__(self, path=OPENMETRICS_PATH, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        # (name, host ID) -> point
+        self.series = {}
+
+    def write(self, points):
+        for point in points:
+            key = (point["name"], point["hostId"])
+            current = self.series.get(key)
+            if current is None or current["time"] <= point["time"]:
+                self.series[key] = point
+        try:
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as f:
+                f.write(self.render())
+            os.replace(tmp, self.path)
+        except OSError as e:
+            self.failed.append((points, e))
+            return
+        self.written += len(points)
+
+    def render(self):
+        # Names are sanitized before grouped into families, where the latest
+        # point of names sanitized the same is kept
+        series = {}
+        for (name, host_id), point in self.series.items():
+            key = (re.sub(r"[^a-zA-Z0-9_:]", "_", name), host_id)
+            current = series.get(key)
+            if current is None or current["time"] <= point["time"]:
+                series[key] = point
+        lines = []
+        family = None
+        for metric, host_id in sorted(series):
+            if metric != family:
+                lines.append("# TYPE {metric} gauge".format(metric=metric))
+                family = metric
+            value = float(series[(metric, host_id)]["value"])
+            lines.append(
+                '{metric}{{host_id="{host_id}"}} {value}'.format(
+                    metric=metric,
+                    host_id=host_id.replace("\\", "\\\\").replace('"', '\\"'),
+                    value="NaN" if math.isnan(value) else repr(value),
+                )
+            )
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+class JSONLinesSink(Sink):
+    """JSONLinesSink appends the points to a file, one Mackerel payload per line."""
+
+    name = "jsonlines"
+
+    def __init__(self, path="", **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+
+    def write(self, points):
+        try:
+            with open(self.path, "a") as f:
+                for point in points:
+                    f.write(json.dumps(point, sort_keys=True) + "\n")
+        except OSError as e:
+            self.failed.append((points, e))
+            return
+        self.written += len(points)
+
+
+class _Marker:
+    """_Marker calls `callback` once every sink wrote the points put before it."""
+
+    def __init__(self, callback=None, sinks=0):
+        self.callback = callback
+        self.remaining = sinks
+        self.ok = True
+        self.lock = threading.Lock()
+
+    def reached(self, ok):
+        with self.lock:
+            self.ok = self.ok and ok
+            self.remaining -= 1
+            if self.remaining > 0:
+                return
+        self.callback(self.ok)
+
+
+_CLOSE = object()
+
+
+class Fanout:
+    """Fanout feeds every sink from its own bounded queue and thread.
+
+    Points are aggregated once and put to every sink, so a slow sink neither
+    delays the others nor the aggregation until its queue is full.
+    """
+
+    def __init__(self, sinks=None, queue_size=QUEUE_SIZE):
+        self.sinks = sinks
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in sinks]
+        self.threads = [
+            threading.Thread(target=self._run, args=(sink, q))
+            for sink, q in zip(sinks, self.queues)
+        ]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def put(self, point):
+        for q in self.queues:
+            q.put(point)
+
+    def mark(self, callback):
+        """Call `callback(ok)` once the points put so far are written by every sink.
+
+        `ok` is False when any sink failed to write a point since the last mark.
+        """
+        if len(self.queues) == 0:
+            callback(True)
+            return
+        marker = _Marker(callback=callback, sinks=len(self.queues))
+        for q in self.queues:
+            q.put(marker)
+
+    def close(self):
+        """Write every point put and close the sinks."""
+        for q in self.queues:
+            q.put(_CLOSE)
+        for thread in self.threads:
+            thread.join()
+        for sink in self.sinks:
+            sink.close()
+
+    def _run(self, sink, q):
+        batch = []
+        failed = len(sink.failed)
+        deadline = time.monotonic() + sink.flush_interval
+        while True:
+            try:
+                item = q.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                item = None
+            if (
+                item is not None
+                and not isinstance(item, _Marker)
+                and item is not _CLOSE
+            ):
+                batch.append(item)
+                if len(batch) < sink.batch_size and time.monotonic() < deadline:
+                    continue
+            if len(batch) > 0:
+                self._write(sink, batch)
+                batch = []
+            deadline = time.monotonic() + sink.flush_interval
+            if isinstance(item, _Marker):
+                item.reached(len(sink.failed) == failed)
+                failed = len(sink.failed)
+            elif item is _CLOSE:
+                return
+
+    def _write(self, sink, batch):
+        try:
+            sink.write(batch)
+        except Exception as e:
+            sink.failed.append((batch, e))
+
+
+def open_sinks(cli=None, mkr_client=None):
+    """Create the sinks named in `cli.sinks` with their settings."""
+    result = []
+    for name in cli.sinks:
+        if name == "mackerel":
+            result.append(
+                MackerelSink(
+                    mkr_client=mkr_client,
+                    workers=cli.post_workers,
+                    attempts=cli.post_attempts,
+                    batch_size=cli.post_batch_size,
+                    flush_interval=cli.mackerel_flush_interval,
+                )
+            )
+        elif name == "ganglia":
+            result.append(
+                GangliaSink(
+                    host=cli.ganglia_host,
+                    port=cli.ganglia_port,
+                    group=cli.prefix,
+                    batch_size=cli.ganglia_batch_size,
+                    flush_interval=cli.ganglia_flush_interval,
+                )
+            )
+        elif name == "openmetrics":
+            result.append(
+                OpenMetricsSink(
+                    path=cli.openmetrics_path,
+                    batch_size=cli.openmetrics_batch_size,
+                    flush_interval=cli.openmetrics_flush_interval,
+                )
+            )
+        else:
+            raise ValueError("unknown sink: " + name)
+    return result
@@ -0,0 +1,178 @@
+import math
+
+RELATIVE_ACCURACY = 0.01
+MAX_BUCKETS = 2048
+# Values at or below this (1 microsec.) are counted as zero
+MIN_VALUE = 1e-6
+
+
+class Sketch:
+    """Sketch is a mergeable quantile sketch of non-negative values.
+
+    Values are counted in buckets growing geometrically by `gamma`, the same
+    as DDSketch, so any quantile is estimated within `relative_accuracy` of
+    the exact value while memory is bounded by `max_buckets`. Count, sum,
+    minimum and maximum are kept exactly.
+    """
+
+    __slots__ = (
+        "relative_accuracy",
+        "max_buckets",
+        "log_gamma",
+        "buckets",
+        "zero_count",
+        "count",
+        "sum",
+        "min",
+        "max",
+    )
+
+    def __init__(self, relative_accuracy=RELATIVE_ACCURACY, max_buckets=MAX_BUCKETS):
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(gamma)
+        # Bucket index -> count. Bucket `i` holds values in (gamma^(i-1), gamma^i].
+        self.buckets = {}
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    @classmethod
+    def from_summary(
+        cls, count=0, total=0.0, minimum=None, maximum=None, buckets=None, zero_count=0
+    ):
+        """Build a sketch from exact aggregates and, optionally, bucket counts.
+
+        Without buckets the sketch answers `average`, `max` and `min` but no quantile.
+        """
+        sketch = cls()
+        sketch.count = count
+        sketch.sum = total
+        sketch.min = minimum
+        sketch.max = maximum
+        if buckets is not None:
+            sketch.buckets = buckets
+            sketch.zero_count = zero_count
+            if len(sketch.buckets) > sketch.max_buckets:
+                sketch._collapse()
+        return sketch
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+        if value <= MIN_VALUE:
+            self.zero_count += 1
+            return
+        index = int(math.ceil(math.log(value) / self.log_gamma))
+        if index in self.buckets:
+            self.buckets[index] += 1
+            return
+        self.buckets[index] = 1
+        if len(self.buckets) > self.max_buckets:
+            self._collapse()
+
+    def merge(self, other):
+        """Add the values of `other` into this sketch and return itself."""
+        if other.count == 0:
+            return self
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError(
+                "sketches of different relative accuracy can not be merged"
+            )
+        self.count += other.count
+        self.sum += other.sum
+        if self.min is None or (other.min is not None and other.min < self.min):
+            self.min = other.min
+        if self.max is None or (other.max is not None and other.max > self.max):
+            self.max = other.max
+        self.zero_count += other.zero_count
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        if len(self.buckets) > self.max_buckets:
+            self._collapse()
+        return self
+
+    def copy(self):
+        sketch = Sketch(
+            relative_accuracy=self.relative_accuracy, max_buckets=self.max_buckets
+        )
+        return sketch.merge(self)
+
+    def quantile(self, q):
+        bucketed = self.zero_count + sum(self.buckets.values())
+        if bucketed == 0:
+            return None
+        rank = q * (bucketed - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        gamma = math.exp(self.log_gamma)
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if rank < seen:
+                value = 2 * math.exp(index * self.log_gamma) / (gamma + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def statistic(self, name):
+        """Return the statistic named by `statistics`, or 0.0 for no value."""
+        if self.count == 0:
+            return 0.0
+        if name == "average":
+            return self.sum / self.count
+        if name == "max":
+            return self.max
+        if name == "min":
+            return self.min
+        if name.startswith("p"):
+            value = self.quantile(float(name[1:].replace("_", ".")) / 100)
+            if value is None:
+                return 0.0
+            return value
+        raise ValueError("unknown statistic: " + name)
+
+    def to_dict(self):
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "buckets": [[index, count] for index, count in self.buckets.items()],
+            "zero_count": self.zero_count,
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min,
+            "max": self.max,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        sketch = cls(relative_accuracy=d["relative_accuracy"])
+        sketch.buckets = {index: count for index, count in d["buckets"]}
+        sketch.zero_count = d["zero_count"]
+        sketch.count = d["count"]
+        sketch.sum = d["sum"]
+        sketch.min = d["min"]
+        sketch.max = d["max"]
+        return sketch
+
+    def _collapse(self):
+        # Fold the lowest buckets into one, losing accuracy only on the low end
+        indexes = sorted(self.buckets)
+        excess = len(indexes) - self.max_buckets
+        target = indexes[excess]
+        for index in indexes[:excess]:
+            self.buckets[target] += self.buckets.pop(index)
+
+
+def statistics(percentiles=None):
+    """Return the statistic names emitted for a latency distribution."""
+    names = ["average", "max"]
+    for percentile in percentiles or []:
+        names.append("p" + str(percentile).replace(".", "_"))
+    return names
@@ -0,0 +1,486 @@
+import json
+import string
+
+import sketch
+
+AGGREGATES = ("count", "sum", "distribution")
+# Fields records are filtered and grouped by
+KEYS = ("target", "status_class", "elb_status_class", "dispatched")
+# Fields summed or distributed, and their S3 Select expression
+VALUES = {
+    "latency": "CAST(s._6 AS FLOAT) + CAST(s._7 AS FLOAT) + CAST(s._8 AS FLOAT)",
+    "request_processing_time": "CAST(s._6 AS FLOAT)",
+    "target_processing_time": "CAST(s._7 AS FLOAT)",
+    "response_processing_time": "CAST(s._8 AS FLOAT)",
+    "received_bytes": "CAST(s._11 AS INT)",
+    "sent_bytes": "CAST(s._12 AS INT)",
+}
+# Fields of the timings, which requests never dispatched have none of
+TIMINGS = (
+    "latency",
+    "request_processing_time",
+    "target_processing_time",
+    "response_processing_time",
+)
+# Characters of an S3 Select expression, at most 256 KiB
+MAX_EXPRESSION = 256 * 1024
+
+# The metrics posted unless `METRIC_SPEC` gives others. `name` may refer to
+# the value of each `group_by` key but `target`, whose series are posted to
+# the Mackerel host of the target instead of the load balancer host.
+DEFAULT = [
+    {
+        "graph": "target_status_code.all",
+        "name": "target_status_code.all.{status_class}xx",
+        "unit": "integer",
+        "aggregate": "count",
+        "filter": {"status_class": ["2", "3", "4", "5"]},
+        "group_by": ["status_class"],
+    },
+    {
+        "graph": "no_dispatch.all",
+        "name": "no_dispatch.all.count",
+        "unit": "integer",
+        "aggregate": "count",
+        "filter": {"dispatched": [False]},
+    },
+    {
+        "graph": "no_target_response.all",
+        "name": "no_target_response.all.count",
+        "unit": "integer",
+        "aggregate": "count",
+        "filter": {"status_class": ["-"]},
+    },
+    {
+        "graph": "target_status_code",
+        "name": "target_status_code.{status_class}xx",
+        "unit": "integer",
+        "aggregate": "count",
+        "filter": {"status_class": ["2", "3", "4", "5"]},
+        "group_by": ["target", "status_class"],
+    },
+    {
+        "graph": "latency.",
+        "name": "latency",
+        "unit": "float",
+        "aggregate": "distribution",
+        "field": "latency",
+        "filter": {"dispatched": [True]},
+        "group_by": ["target"],
+    },
+]
+
+
+def load(path=""):
+    """Load the metric spec of the JSON or YAML file at `path`, or DEFAULT if it is empty.
+
+    Return the metrics and an error, one of which is None.
+    """
+    if path == "":
+        return DEFAULT, None
+    try:
+        with open(path, "r") as f:
+            if path.endswith(".yaml") or path.endswith(".yml"):
+                try:
+                    import yaml
+                except ImportError:
+                    return None, "YAML metric spec requires PyYAML to be installed"
+                try:
+                    document = yaml.safe_load(f)
+                except yaml.YAMLError as e:
+                    return None, "metric spec is not valid YAML: {e}".format(e=e)
+            else:
+                document = json.load(f)
+    except OSError as e:
+        return None, "metric spec could not be read: {e}".format(e=e)
+    except ValueError as e:
+        return None, "metric spec is not valid JSON: {e}".format(e=e)
+    metrics = document.get("metrics") if isinstance(document, dict) else document
+    err = validate(metrics)
+    if err is not None:
+        return None, err
+    return metrics, None
+
+
+def validate(metrics=None):
+    """Return why `metrics` is not a valid spec, or None."""
+    if not isinstance(metrics, list) or len(metrics) == 0:
+        return "metric spec has no metric"
+    for m in metrics:
+        if not isinstance(m, dict):
+            return "metric spec has a metric that is not a mapping: {m}".format(m=m)
+        for attr in ("graph", "name", "unit", "aggregate"):
+            if attr not in m:
+                return "metric spec lacks `{attr}`: {m}".format(attr=attr, m=m)
+        if m["aggregate"] not in AGGREGATES:
+            return "metric spec has unknown aggregate: " + m["aggregate"]
+        if m["aggregate"] != "count" and m.get("field") not in VALUES:
+            return "metric spec has unknown field: {field}".format(field=m.get("field"))
+        if not isinstance(m.get("filter", {}), dict):
+            return "metric spec has a `filter` that is not a mapping: {m}".format(m=m)
+        if not isinstance(m.get("group_by", []), list):
+            return "metric spec has a `group_by` that is not a list: {m}".format(m=m)
+        filters = _filters(m)
+        # `name` is formatted with the values of the `group_by` keys but `target`
+        try:
+            placeholders = [
+                field
+                for _, field, _, _ in string.Formatter().parse(m["name"])
+                if field is not None
+            ]
+        except ValueError:
+            return "metric spec has an invalid name: " + m["name"]
+        for field in placeholders:
+            if field == "target" or field not in m.get("group_by", []):
+                return "metric spec names a series by `{field}`, not a `group_by` key but `target`: {name}".format(
+                    field=field, name=m["name"]
+                )
+        for key in filters:
+            if key not in KEYS:
+                return "metric spec has unknown filter: " + key
+        # A string such as "false" would be taken as true
+        for value in filters.get("dispatched", []):
+            if not isinstance(value, bool):
+                return "metric spec filters `dispatched` by a value other than true or false: {value!r}".format(
+                    value=value
+                )
+        for key in m.get("group_by", []):
+            if key not in KEYS:
+                return "metric spec has unknown group_by: " + key
+            if key == "target":
+                continue
+            # Every series is known before aggregating, to define its graph
+            if key not in filters:
+                return "metric spec groups by `{key}` without listing its values in `filter`".format(
+                    key=key
+                )
+            if "{" + key + "}" not in m["name"]:
+                return (
+                    "metric spec names the series of `{key}` the same: {name}".format(
+                        key=key, name=m["name"]
+                    )
+                )
+    return None
+
+
+def _filters(m):
+    """Return `filter` of the metric `m` with every value a list, status classes as strings."""
+    filters = {}
+    for key, values in m.get("filter", {}).items():
+        if not isinstance(values, list):
+            values = [values]
+        if key in ("status_class", "elb_status_class"):
+            values = [str(v) for v in values]
+        filters[key] = values
+    return filters
+
+
+def _predicate(key, value):
+    """Return the S3 Select condition of `key` being `value`."""
+    if key == "target":
+        return "s._5 LIKE '{target}'".format(target=value)
+    if key == "dispatched":
+        if value:
+            return "s._6 <> '-1' AND s._7 <> '-1' AND s._8 <> '-1'"
+        return "(s._6 = '-1' OR s._7 = '-1' OR s._8 = '-1')"
+    field = "s._10" if key == "status_class" else "s._9"
+    if value == "-":
+        return "{field} = '-'".format(field=field)
+    return "{field} LIKE '{value}%'".format(field=field, value=value)
+
+
+def _condition(filters, group, target=""):
+    """Return the S3 Select condition of the series `group` of a metric filtered by `filters`."""
+    conditions = []
+    if target != "":
+        conditions.append(_predicate("target", target))
+    for key, values in sorted(filters.items()):
+        if key in group:
+            values = [group[key]]
+        if len(values) == 1:
+            conditions.append(_predicate(key, values[0]))
+        else:
+            conditions.append(
+                "(" + " OR ".join("(" + _predicate(key, v) + ")" for v in values) + ")"
+            )
+    if len(conditions) == 0:
+        return "TRUE"
+    return " AND ".join(conditions)
+
+
+def _select(aggregate="count", field="", condition="TRUE"):
+    """Return the S3 Select aggregates of a series, one per column it reads."""
+    if aggregate == "count":
+        return ["SUM(CASE WHEN {c} THEN 1 ELSE 0 END)".format(c=condition)]
+    value = VALUES[field]
+    if field in TIMINGS and condition != _predicate("dispatched", True):
+        condition = "({c}) AND {d}".format(
+            c=condition, d=_predicate("dispatched", True)
+        )
+    if aggregate == "sum":
+        return ["SUM(CASE WHEN {c} THEN {v} ELSE 0 END)".format(c=condition, v=value)]
+    # SUM, COUNT, MIN and MAX, empty but COUNT for no record
+    return [
+        "SUM(CASE WHEN {c} THEN {v} END)".format(c=condition, v=value),
+        "SUM(CASE WHEN {c} THEN 1 ELSE 0 END)".format(c=condition),
+        "MIN(CASE WHEN {c} THEN {v} END)".format(c=condition, v=value),
+        "MAX(CASE WHEN {c} THEN {v} END)".format(c=condition, v=value),
+    ]
+
+
+def _native(m, filters, group_by):
+    """Whether `engine.Summary` counts the series of the metric `m` itself."""
+    if m["aggregate"] == "distribution":
+        return (
+            m["field"] == "latency"
+            and filters == {"dispatched": [True]}
+            and group_by == ["target"]
+        )
+    if m["aggregate"] != "count":
+        return False
+    if filters == {"dispatched": [False]} and group_by == []:
+        return True
+    if set(filters) != {"status_class"} or not set(group_by) <= {
+        "target",
+        "status_class",
+    }:
+        return False
+    return "status_class" in group_by or len(filters["status_class"]) == 1
+
+
+def summarized(metrics=None):
+    """Whether `engine.Summary` counts every series of `metrics`, as partials keep only those."""
+    return all(_native(m, _filters(m), list(m.get("group_by", []))) for m in metrics)
+
+
+def _match(filters, group):
+    """Return `match` of a series of a count `engine.Summary` answers."""
+    if "dispatched" in filters:
+        return "no_dispatch"
+    return group.get("status_class", filters["status_class"][0])
+
+
+def _groups(filters, group_by):
+    """Return every series of a metric as the values of its `group_by` keys but `target`."""
+    groups = [{}]
+    for key in group_by:
+        if key == "target":
+            continue
+        groups = [dict(g, **{key: v}) for g in groups for v in filters[key]]
+    return groups
+
+
+def plan(
+    metrics=None,
+    prefix="",
+    alb_host_id="",
+    targets=None,
+    target_host_ids=None,
+    percentiles=None,
+):
+    """Plan `metrics` as the query groups of `query.Builder`.
+
+    Query groups are those of the load balancer host in the order of
+    `metrics`, then those of each target. Each series carries its S3 Select
+    aggregates in `select`, and either the `match` and `target` answered by
+    `engine.Summary` or the `extra` series evaluated by `Extras`.
+    """
+    if prefix != "" and prefix is not None:
+        prefix = prefix + "."
+    alb_groups = []
+    # Target index -> query groups of the target
+    target_groups = [[] for _ in targets]
+    for m in metrics:
+        filters = _filters(m)
+        group_by = list(m.get("group_by", []))
+        native = _native(m, filters, group_by)
+        hosts = [("", alb_host_id)]
+        if "target" in group_by:
+            hosts = [(t, target_host_ids[t]) for t in targets]
+        for target, host_id in hosts:
+            group = {
+                "name": "custom.{prefix}{graph}".format(
+                    prefix=prefix, graph=m["graph"]
+                ),
+                "unit": m["unit"],
+                "host_id": host_id,
+                "query": [],
+            }
+            for values in _groups(filters, group_by):
+                q = {
+                    "name": "custom.{prefix}{name}".format(
+                        prefix=prefix, name=m["name"].format(**values)
+                    ),
+                    "select": _select(
+                        aggregate=m["aggregate"],
+                        field=m.get("field", ""),
+                        condition=_condition(filters, values, target=target),
+                    ),
+                    "target": target if target != "" else None,
+                    "match": None,
+                    "aggregate": m["aggregate"],
+                }
+                if not native:
+                    q["extra"] = {
+                        "filter": {
+                            key: [values[key]] if key in values else v
+                            for key, v in filters.items()
+                        },
+                        "target": target,
+                        "aggregate": m["aggregate"],
+                        "field": m.get("field", ""),
+                    }
+                elif m["aggregate"] == "count":
+                    q["match"] = _match(filters, values)
+                if m["aggregate"] == "distribution":
+                    q["statistics"] = sketch.statistics(percentiles=percentiles)
+                group["query"].append(q)
+            if target == "":
+                alb_groups.append(group)
+            else:
+                target_groups[targets.index(target)].append(group)
+
+    queries = alb_groups + [g for groups in target_groups for g in groups]
+    # `Extras` keeps the value of each series at its index
+    for i, extra in enumerate(extras(queries)):
+        extra["index"] = i
+    return queries
+
+
+def extras(queries=None):
+    """Return the `extra` series of `queries`, in order."""
+    return [q["extra"] for group in queries for q in group["query"] if "extra" in q]
+
+
+def selects(queries=None, between=""):
+    """Return S3 Select queries reading every series of `queries` in `between`.
+
+    Series are read by as few queries as fit in the S3 Select expression
+    limit, each returned with the `(host_id, query item)` of its columns.
+    """
+    result = []
+    columns = []
+    items = []
+    length = len(_query([], between))
+    for group in queries:
+        for q in group["query"]:
+            if "select" not in q:
+                continue
+            added = sum(len(c) + len(", ") for c in q["select"])
+            if len(items) > 0 and length + added > MAX_EXPRESSION:
+                result.append((_query(columns, between), items))
+                columns = []
+                items = []
+                length = len(_query([], between))
+            columns.extend(q["select"])
+            items.append((group.get("host_id", ""), q))
+            length += added
+    if len(items) > 0:
+        result.append((_query(columns, between), items))
+    return result
+
+
+def _query(columns, between=""):
+    if between == "":
+        return "SELECT {columns} FROM S3Object s".format(columns=", ".join(columns))
+    return "SELECT {columns} FROM S3Object s WHERE {between}".format(
+        columns=", ".join(columns), between=between
+    )
+
+
+class Extras:
+    """Extras evaluates the series `engine.Summary` does not count itself.
+
+    Records end with the fields of `logs.SPEC_COLUMNS`. The keys of a record
+    are derived once, however many series are filtered by them.
+    """
+
+    __slots__ = ("series", "values")
+
+    def __init__(self, series=()):
+        self.series = [
+            (
+                {key: set(values) for key, values in s["filter"].items()},
+                s["target"],
+                s["aggregate"],
+                s["field"],
+            )
+            for s in series
+        ]
+        # Series index -> count, sum or sketch.Sketch
+        self.values = {}
+
+    def add(self, record):
+        target = record[1]
+        dispatched = record[2] != "-1" and record[3] != "-1" and record[4] != "-1"
+        keys = {
+            "target": target,
+            "status_class": record[5][:1],
+            "elb_status_class": record[-3][:1],
+            "dispatched": dispatched,
+        }
+        # Field -> value of the record, parsed for the first series reading it
+        numbers = {}
+        for i, (filters, series_target, aggregate, field) in enumerate(self.series):
+            if series_target != "" and series_target != target:
+                continue
+            if not all(keys[key] in values for key, values in filters.items()):
+                continue
+            if aggregate == "count":
+                self.values[i] = self.values.get(i, 0.0) + 1
+                continue
+            if field not in numbers:
+                numbers[field] = _number(field, record, dispatched)
+            value = numbers[field]
+            if value is None:
+                continue
+            if aggregate == "sum":
+                self.values[i] = self.values.get(i, 0.0) + value
+            else:
+                if i not in self.values:
+                    self.values[i] = sketch.Sketch()
+                self.values[i].add(value)
+
+    def value(self, extra):
+        if extra["index"] in self.values:
+            return self.values[extra["index"]]
+        if extra["aggregate"] == "distribution":
+            return sketch.Sketch()
+        return 0.0
+
+    def merge(self, other):
+        """Add the values of `other` into these, leaving `other` unchanged."""
+        for i, value in other.values.items():
+            if i not in self.values:
+                self.values[i] = (
+                    value.copy() if isinstance(value, sketch.Sketch) else value
+                )
+            elif isinstance(value, sketch.Sketch):
+                self.values[i].merge(value)
+            else:
+                self.values[i] += value
+        return self
+
+    def copy(self):
+        extras = Extras()
+        extras.series = self.series
+        return extras.merge(self)
+
+
+def _number(field, record, dispatched):
+    """Return the value of `field` in `record`, or None if it has none."""
+    if field in TIMINGS and not dispatched:
+        # `-1` for requests never dispatched, not a time
+        return None
+    if field == "latency":
+        return float(record[2]) + float(record[3]) + float(record[4])
+    if field == "request_processing_time":
+        return float(record[2])
+    if field == "target_processing_time":
+        return float(record[3])
+    if field == "response_processing_time":
+        return float(record[4])
+    value = record[-2] if field == "received_bytes" else record[-1]
+    if value == "-":
+        return None
+    return float(value)
@@ -0,0 +1,237 @@
+import heapq
+import re
+
+import logs
+
+# Fields records can be broken down by, and the value of each record counted
+FIELDS = ("path", "client", "user_agent", "elb_status_code")
+KINDS = ("requests", "5xx", "latency")
+UNITS = {"requests": "integer", "5xx": "integer", "latency": "float"}
+
+SIZE = 10
+CAPACITY = 100
+# Request paths are normalized by the first of these patterns matching each segment
+PATH_PATTERNS = (
+    (
+        r"^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$",
+        ":uuid",
+    ),
+    (r"^[0-9]+$", ":id"),
+    (r"^[0-9a-fA-F]{16,}$", ":hex"),
+)
+# Items are part of metric names, so longer items are cut
+MAX_ITEM = 64
+# Items kept by `Breakdown`, cleared once full
+ITEM_CACHE = 10000
+
+# (field, value, path patterns) -> item
+_items = {}
+
+
+class SpaceSaving:
+    """SpaceSaving estimates the heaviest items of a stream with `capacity` counters.
+
+    Once every counter is taken, a new item replaces the item of the smallest
+    count and starts from that count, so an estimate exceeds the true count by
+    at most its `error` and every item heavier than the total / `capacity` is
+    kept. Weights may be fractional, such as seconds of latency.
+    """
+
+    __slots__ = ("capacity", "counts", "errors", "heap")
+
+    def __init__(self, capacity=CAPACITY):
+        self.capacity = capacity
+        # item -> estimated count
+        self.counts = {}
+        # item -> overestimation bound of the count
+        self.errors = {}
+        # [(count, item), ...], a count may be lower than the current one
+        self.heap = []
+
+    def add(self, item, weight=1):
+        counts = self.counts
+        if item in counts:
+            counts[item] += weight
+            return
+        if len(counts) < self.capacity:
+            counts[item] = weight
+            self.errors[item] = 0
+            heapq.heappush(self.heap, (weight, item))
+            return
+
+        # The item of the smallest count, refreshing the entries of items
+        # counted since they were pushed
+        heap = self.heap
+        while heap[0][0] != counts[heap[0][1]]:
+            heapq.heapreplace(heap, (counts[heap[0][1]], heap[0][1]))
+        minimum, victim = heapq.heapreplace(heap, (heap[0][0] + weight, item))
+        del counts[victim]
+        del self.errors[victim]
+        counts[item] = minimum + weight
+        self.errors[item] = minimum
+
+    def minimum(self):
+        """Count any item not kept may have."""
+        if len(self.counts) < self.capacity:
+            return 0
+        return min(self.counts.values())
+
+    def merge(self, other):
+        """Add the items of `other` into this summary and return itself."""
+        if len(other.counts) == 0:
+            return self
+        floor = self.minimum()
+        other_floor = other.minimum()
+        counts = {}
+        errors = {}
+        for item in set(self.counts) | set(other.counts):
+            counts[item] = self.counts.get(item, floor) + other.counts.get(
+                item, other_floor
+            )
+            errors[item] = self.errors.get(item, floor) + other.errors.get(
+                item, other_floor
+            )
+        self.capacity = max(self.capacity, other.capacity)
+        kept = heapq.nlargest(self.capacity, counts, key=lambda i: (counts[i], i))
+        self.counts = {item: counts[item] for item in kept}
+        self.errors = {item: errors[item] for item in kept}
+        self.heap = [(count, item) for item, count in self.counts.items()]
+        heapq.heapify(self.heap)
+        return self
+
+    def copy(self):
+        return SpaceSaving(capacity=self.capacity).merge(self)
+
+    def top(self, k=SIZE):
+        """Return the `k` heaviest `(item, count, error)`, heaviest first."""
+        items = heapq.nlargest(k, self.counts, key=lambda i: (self.counts[i], i))
+        return [(item, self.counts[item], self.errors[item]) for item in items]
+
+    def to_dict(self):
+        return {
+            "capacity": self.capacity,
+            "counts": [
+                [item, count, self.errors[item]] for item, count in self.counts.items()
+            ],
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        summary = cls(capacity=d["capacity"])
+        for item, count, error in d["counts"]:
+            summary.counts[item] = count
+            summary.errors[item] = error
+        summary.heap = [(count, item) for item, count in summary.counts.items()]
+        heapq.heapify(summary.heap)
+        return summary
+
+
+def patterns(pairs=PATH_PATTERNS):
+    """Compile `(regex, replacement)` pairs for `normalize_path`."""
+    return tuple((re.compile(regex), replacement) for regex, replacement in pairs)
+
+
+def normalize_path(request="", patterns=()):
+    """Return the path of the `request` line with its variable segments replaced.
+
+    `GET http://example.com:80/users/42?a=b HTTP/1.1` is `/users/:id`.
+    """
+    parts = request.split(" ")
+    url = parts[1] if len(parts) > 1 else request
+    if "://" in url:
+        url = url.split("://", 1)[1]
+        url = "/" + url.split("/", 1)[1] if "/" in url else "/"
+    url = url.split("?", 1)[0]
+    segments = []
+    for segment in url.split("/"):
+        for regex, replacement in patterns:
+            if regex.match(segment):
+                segment = replacement
+                break
+        segments.append(segment)
+    return "/".join(segments)
+
+
+def item(value=""):
+    """Make `value` one part of a Mackerel metric name."""
+    return re.sub(r"[^a-zA-Z0-9_-]", "_", value)[:MAX_ITEM] or "_"
+
+
+# Position of the breakdown fields in a record, after `logs.COLUMNS`
+_CLIENT = len(logs.COLUMNS) + logs.BREAKDOWN_COLUMNS.index(logs.CLIENT)
+_ELB_STATUS_CODE = len(logs.COLUMNS) + logs.BREAKDOWN_COLUMNS.index(
+    logs.ELB_STATUS_CODE
+)
+_REQUEST = len(logs.COLUMNS) + logs.BREAKDOWN_COLUMNS.index(logs.REQUEST)
+_USER_AGENT = len(logs.COLUMNS) + logs.BREAKDOWN_COLUMNS.index(logs.USER_AGENT)
+
+
+class Breakdown:
+    """Breakdown holds the heaviest items of each field in the records of a window.
+
+    Its memory is bounded by `capacity` counters per field and kind, whatever
+    the number of distinct items.
+    """
+
+    __slots__ = ("fields", "patterns", "hitters")
+
+    def __init__(self, fields=(), capacity=CAPACITY, patterns=()):
+        self.fields = tuple(fields)
+        self.patterns = patterns
+        # (field, kind) -> SpaceSaving
+        self.hitters = {
+            (field, kind): SpaceSaving(capacity=capacity)
+            for field in self.fields
+            for kind in KINDS
+        }
+
+    def add(self, record, latency=None):
+        """Count `record`, with the latency of a request dispatched to a target."""
+        error = record[_ELB_STATUS_CODE][:1] == "5"
+        hitters = self.hitters
+        for field in self.fields:
+            value = self.item(field, record)
+            hitters[(field, "requests")].add(value)
+            if error:
+                hitters[(field, "5xx")].add(value)
+            if latency is not None:
+                hitters[(field, "latency")].add(value, latency)
+
+    def item(self, field, record):
+        if field == "path":
+            value = record[_REQUEST]
+        elif field == "client":
+            value = record[_CLIENT]
+        elif field == "user_agent":
+            value = record[_USER_AGENT]
+        else:
+            value = record[_ELB_STATUS_CODE]
+        key = (field, value, self.patterns)
+        result = _items.get(key)
+        if result is not None:
+            return result
+
+        if field == "path":
+            result = item(normalize_path(value, self.patterns))
+        elif field == "client":
+            # Without the port, which differs by connection
+            result = item(value.rsplit(":", 1)[0])
+        else:
+            result = item(value)
+        if len(_items) >= ITEM_CACHE:
+            _items.clear()
+        _items[key] = result
+        return result
+
+    def merge(self, other):
+        for key, hitters in other.hitters.items():
+            if key in self.hitters:
+                self.hitters[key].merge(hitters)
+            else:
+                self.hitters[key] = hitters.copy()
+        return self
+
+    def copy(self):
+        breakdown = Breakdown(patterns=self.patterns)
+        breakdown.fields = self.fields
+        return breakdown.merge(self)
@@ -0,0 +1,102 @@
+import calendar
+import datetime
+
+import listing
+
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+# `schedule` aggregates the windows before the time of the run, which has to be
+# x1 or x6 minutes; `watermark` aggregates the windows logs are delivered for.
+WINDOWINGS = ("schedule", "watermark")
+# Nodes without a new object for longer are taken as idle or scaled in
+IDLE = 2 * listing.OBJECT_INTERVAL
+# Windows are corrected by late objects up to this long behind the watermark
+LATENESS = 900
+
+
+class Window:
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        # ALB log timestamps are compared as strings, the same as S3 Select does
+        # for `s._2 BETWEEN '...' AND '...'`.
+        self.lower = start.strftime(TIMESTAMP_FORMAT)
+        self.upper = end.strftime(TIMESTAMP_FORMAT)
+        self.between = "s._2 BETWEEN '{lower}' AND '{upper}'".format(
+            lower=self.lower, upper=self.upper
+        )
+
+    def contains(self, timestamp):
+        return self.lower <= timestamp <= self.upper
+
+
+def windows(now=None, duration=60, epochs=5):
+    result = []
+    for epoch in range(1, epochs + 1):
+        end = now - datetime.timedelta(seconds=duration * (epoch - 1) + 60)
+        start = now - datetime.timedelta(seconds=duration * epoch + 60)
+        result.append(Window(start, end))
+    return result
+
+
+def span(windows):
+    """Return the window covering all of `windows`."""
+    return Window(min(w.start for w in windows), max(w.end for w in windows))
+
+
+def cover(start=None, end=None, duration=60):
+    """Return the windows of `duration` from `start` up to `end`, oldest first.
+
+    The last window is cut at `end`, so windows of adjacent ranges never overlap.
+    """
+    result = []
+    t = start
+    while t < end:
+        upper = min(t + datetime.timedelta(seconds=duration), end)
+        result.append(Window(t, upper))
+        t = upper
+    return result
+
+
+def watermark(keys=None, now=None, idle=IDLE, previous=None):
+    """Return the time up to which the objects of every node are delivered.
+
+    A node of a load balancer delivers its records up to the end time in the
+    key of its latest object, so the watermark is the earliest of those among
+    the nodes that delivered an object in the last `idle` seconds before `now`.
+    Without such nodes, nothing is on its way and the watermark is `now - idle`.
+    It never goes back from `previous`.
+    """
+    # (load balancer id, ip) -> end time of the latest object
+    latest = {}
+    for key in keys:
+        node = listing.key_node(key)
+        timestamp = listing.key_timestamp(key)
+        if node is None or timestamp is None:
+            continue
+        if node not in latest or latest[node] < timestamp:
+            latest[node] = timestamp
+
+    floor = now - datetime.timedelta(seconds=idle)
+    active = [t for t in latest.values() if floor <= t]
+    result = min(min(active), now) if len(active) > 0 else floor
+    if previous is not None and result < previous:
+        return previous
+    return result
+
+
+def settled(watermark=None, duration=60, lateness=LATENESS):
+    """Return the windows ending by `watermark`, back to `lateness` before it, oldest first.
+
+    Window ends are multiples of `duration` in UNIX time, so every run agrees
+    on them whatever its schedule.
+    """
+    upper = calendar.timegm(watermark.timetuple())
+    upper -= upper % duration
+    lower = upper - lateness
+    lower -= lower % duration
+    return cover(
+        start=datetime.datetime.utcfromtimestamp(lower),
+        end=datetime.datetime.utcfromtimestamp(upper),
+        duration=duration,
+    )
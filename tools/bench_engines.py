@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+import argparse
+import datetime
+import os
+import random
+import sys
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
+
+import columnar  # noqa: E402
+import engine  # noqa: E402
+import logs  # noqa: E402
+import window  # noqa: E402
+
+__doc__ = "bench_engines.py compares rows/sec of the pure Python and NumPy aggregation"
+
+LINE = (
+    "https {time} app/my-lb/50dc6c495c0c9188 192.168.131.39:2817 {target} "
+    "{request_time} {target_time} {response_time} {status} {status} 34 366 "
+    '"GET http://www.example.com:80/ HTTP/1.1" "curl/7.46.0" - - '
+    "arn:aws:elasticloadbalancing:us-east-2:123456789012:targetgroup/my-targets/73e2d6bc24d8a067 "
+    '"Root=1-58337262-36d228ad5d99923122bbe354" "-" "-" 0 {time} "forward" "-" "-"'
+)
+
+
+def generate(rows, targets, now):
+    r = random.Random(0)
+    hosts = ["10.0.{a}.{b}:80".format(a=i // 250, b=i % 250) for i in range(targets)]
+    lines = []
+    for _ in range(rows):
+        t = now - datetime.timedelta(seconds=r.uniform(60, 360))
+        lines.append(
+            LINE.format(
+                time=t.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+                target=r.choice(hosts),
+                request_time="{:.3f}".format(r.expovariate(1000)),
+                target_time="{:.3f}".format(r.expovariate(20)),
+                response_time="{:.3f}".format(r.expovariate(5000)),
+                status=r.choice(["200", "200", "200", "301", "404", "503"]),
+            )
+        )
+    return lines
+
+
+if __name__ == "__main__":
+    description = __doc__
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        "--rows",
+        metavar="ROWS",
+        action="store",
+        dest="rows",
+        default="10000,100000,300000",
+        help="Comma separated number of log lines",
+    )
+    parser.add_argument(
+        "--targets",
+        metavar="TARGETS",
+        action="store",
+        dest="targets",
+        type=int,
+        default=40,
+        help="Number of targets",
+    )
+    args = parser.parse_args()
+
+    now = datetime.datetime(2018, 7, 2, 22, 31)
+    windows = window.windows(now=now, duration=60)
+    engines = [("python", engine.summarize)]
+    if columnar.available():
+        engines.append(("numpy", columnar.summarize))
+
+    print("\t".join(["engine", "rows", "parse_s", "aggregate_s", "rows_per_s"]))
+    for rows in [int(n) for n in args.rows.split(",")]:
+        lines = generate(rows, args.targets, now)
+        for name, summarize in engines:
+            start = time.perf_counter()
+            records = list(logs.parse(lines))
+            parsed = time.perf_counter()
+            summarize(records, windows)
+            aggregated = time.perf_counter()
+            print(
+                "\t".join(
+                    [
+                        name,
+                        str(rows),
+                        "{:.3f}".format(parsed - start),
+                        "{:.3f}".format(aggregated - parsed),
+                        "{:.0f}".format(rows / (aggregated - start)),
+                    ]
+                )
+            )
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+import argparse
+import datetime
+import os
+import sys
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
+
+import metric  # noqa: E402
+
+__doc__ = "bench_metrics.py measures metric.Metrics add/merge cost per point"
+
+
+def fill(n, hosts=40, names=8):
+    now = datetime.datetime(2018, 7, 2, 22, 31)
+    metrics = metric.Metrics()
+    start = time.perf_counter()
+    for i in range(n):
+        metrics.add(
+            host_id="host-{i}".format(i=i % hosts),
+            name="custom.alb.metric.{i}".format(i=(i // hosts) % names),
+            timestamp=now - datetime.timedelta(minutes=i // (hosts * names)),
+            value=1.0,
+        )
+    return metrics, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    description = __doc__
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        "--sizes",
+        metavar="SIZES",
+        action="store",
+        dest="sizes",
+        default="1000,10000,100000",
+        help="Comma separated number of `add` calls",
+    )
+    args = parser.parse_args()
+
+    print(
+        "\t".join(
+            [
+                "points",
+                "add_total_s",
+                "add_per_op_us",
+                "merge_total_s",
+                "merge_per_op_us",
+            ]
+        )
+    )
+    for n in [int(size) for size in args.sizes.split(",")]:
+        left, elapsed_add = fill(n)
+        right, _ = fill(n)
+        start = time.perf_counter()
+        left.merge(right)
+        elapsed_merge = time.perf_counter() - start
+        print(
+            "\t".join(
+                [
+                    str(n),
+                    "{:.4f}".format(elapsed_add),
+                    "{:.3f}".format(elapsed_add / n * 1e6),
+                    "{:.4f}".format(elapsed_merge),
+                    "{:.3f}".format(elapsed_merge / len(right) * 1e6),
+                ]
+            )
+        )
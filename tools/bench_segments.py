@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+import argparse
+import datetime
+import gzip
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
+
+import bench_engines  # noqa: E402
+import columnar  # noqa: E402
+import engine  # noqa: E402
+import fakes  # noqa: E402
+import logs  # noqa: E402
+import segments  # noqa: E402
+import window  # noqa: E402
+
+__doc__ = "bench_segments.py compares aggregating gzip objects with aggregating their cached segments"
+
+KEY = "alb.log.gz"
+
+
+def best(repeat, f):
+    """Return the least seconds `f()` takes in `repeat` runs and its last result."""
+    seconds = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = f()
+        elapsed = time.perf_counter() - start
+        if seconds is None or elapsed < seconds:
+            seconds = elapsed
+    return seconds, result
+
+
+if __name__ == "__main__":
+    description = __doc__
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        "--rows",
+        metavar="ROWS",
+        action="store",
+        dest="rows",
+        default="10000,100000",
+        help="Comma separated number of log lines",
+    )
+    parser.add_argument(
+        "--targets",
+        metavar="TARGETS",
+        action="store",
+        dest="targets",
+        type=int,
+        default=40,
+        help="Number of targets",
+    )
+    parser.add_argument(
+        "--repeat",
+        metavar="REPEAT",
+        action="store",
+        dest="repeat",
+        type=int,
+        default=3,
+        help="Runs of each measure, the fastest is reported",
+    )
+    args = parser.parse_args()
+
+    now = datetime.datetime(2018, 7, 2, 22, 31)
+    windows = window.windows(now=now, duration=60)
+    engines = [("local", engine.aggregate_local)]
+    if columnar.available():
+        engines.append(("numpy", columnar.aggregate_numpy))
+
+    directory = tempfile.mkdtemp()
+    print(
+        "\t".join(
+            [
+                "engine",
+                "rows",
+                "gzip_bytes",
+                "segment_bytes",
+                "parse_s",
+                "write_s",
+                "gzip_s",
+                "segment_s",
+                "speedup",
+            ]
+        )
+    )
+    try:
+        for rows in [int(n) for n in args.rows.split(",")]:
+            body = gzip.compress(
+                "\n".join(bench_engines.generate(rows, args.targets, now)).encode(
+                    "utf-8"
+                )
+                + b"\n"
+            )
+            s3 = fakes.S3(objects={KEY: (body, now)})
+            shutil.rmtree(directory)
+            cache = segments.Cache(directory=directory, max_bytes=1 << 40)
+
+            def parse():
+                # Records of every field a segment keeps, `request` and `user_agent` quoted
+                records = logs.read_object(
+                    s3_client=s3, bucket="", key=KEY, columns=segments.COLUMNS
+                )
+                return sum(1 for _ in records)
+
+            parsed, _ = best(args.repeat, parse)
+
+            def write():
+                records = logs.read_object(
+                    s3_client=s3, bucket="", key=KEY, columns=segments.COLUMNS
+                )
+                cache.put(key=KEY, etag="", records=records).close()
+
+            written, _ = best(args.repeat, write)
+            size = sum(
+                os.path.getsize(os.path.join(directory, name))
+                for name in os.listdir(directory)
+            )
+            for name, aggregate in engines:
+
+                def from_gzip():
+                    return aggregate(s3_client=s3, bucket="", key=KEY, windows=windows)
+
+                def from_segment():
+                    with cache.get(key=KEY, etag="") as segment:
+                        return segments.summarize(segment, windows, engine_name=name)
+
+                gzip_seconds, _ = best(args.repeat, from_gzip)
+                segment_seconds, _ = best(args.repeat, from_segment)
+                print(
+                    "\t".join(
+                        [
+                            name,
+                            str(rows),
+                            str(len(body)),
+                            str(size),
+                            "{:.3f}".format(parsed),
+                            "{:.3f}".format(written),
+                            "{:.3f}".format(gzip_seconds),
+                            "{:.3f}".format(segment_seconds),
+                            "{:.1f}".format(gzip_seconds / segment_seconds),
+                        ]
+                    )
+                )
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
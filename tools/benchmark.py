@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
+
+import aggregator  # noqa: E402
+import instrument  # noqa: E402
+import resolver  # noqa: E402
+from cli import Cli  # noqa: E402
+
+import fakes  # noqa: E402
+import loggen  # noqa: E402
+
+__doc__ = "benchmark.py runs the aggregator against synthetic logs and local stand-ins of AWS and Mackerel"
+
+NOW = datetime.datetime(2018, 7, 2, 22, 31)
+ENVIRONMENT = {
+    "MACKEREL_APIKEY": "benchmark",
+    "REGION": "us-east-2",
+    "PREFIX": "alb",
+    "MACKEREL_SERVICE": "benchmark",
+    "MACKEREL_ROLE": "web",
+}
+
+
+def commit():
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL
+            )
+            .decode("utf-8")
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def bench(engine="local", rate=10.0, targets=10, workers=1):
+    profile = loggen.Profile(rate=rate, targets=targets)
+    objects = {}
+    lines = 0
+    # Objects of the 15 minutes before `NOW` cover every aggregated window
+    for key, body, last_modified in loggen.objects(
+        start=NOW - datetime.timedelta(minutes=15), end=NOW, profile=profile
+    ):
+        objects[key] = (body, last_modified)
+    for body, _ in objects.values():
+        lines += fakes.gzip.decompress(body).count(b"\n")
+
+    os.environ.update(ENVIRONMENT)
+    os.environ["LOAD_BALANCER_NAME"] = profile.name
+    os.environ["ENGINE"] = engine
+    os.environ["WORKERS"] = str(workers)
+    cli = Cli()
+    mkr = fakes.Mackerel(profile=profile)
+    clients = {
+        "mackerel": mkr,
+        "sts": fakes.STS(account=profile.account),
+        "s3": fakes.S3(objects=objects),
+        "ec2": fakes.EC2(),
+        "elbv2": fakes.ELBv2(profile=profile),
+    }
+
+    resolver.clear()
+    recorder = instrument.start(enabled=True)
+    start = time.perf_counter()
+    aggregator.run(cli=cli, clients=clients, now=NOW)
+    elapsed = time.perf_counter() - start
+    result = {
+        "engine": engine,
+        "rate": rate,
+        "targets": targets,
+        "workers": workers,
+        "objects": len(objects),
+        "lines": lines,
+        "points": len(mkr.metrics),
+        "seconds": elapsed,
+        "lines_per_second": lines / elapsed,
+        "stages": {
+            name: timer["seconds"]
+            for name, timer in recorder.to_dict()["timers"].items()
+        },
+    }
+    instrument.start(enabled=False)
+    return result
+
+
+def compare(results, baseline):
+    previous = {
+        (r["engine"], r["rate"], r["targets"], r["workers"]): r
+        for r in baseline["results"]
+    }
+    print(
+        "\t".join(
+            ["engine", "rate", "targets", "workers", "seconds", "baseline", "ratio"]
+        )
+    )
+    for r in results:
+        p = previous.get((r["engine"], r["rate"], r["targets"], r["workers"]))
+        if p is None:
+            continue
+        print(
+            "\t".join(
+                [
+                    r["engine"],
+                    str(r["rate"]),
+                    str(r["targets"]),
+                    str(r["workers"]),
+                    "{:.3f}".format(r["seconds"]),
+                    "{:.3f}".format(p["seconds"]),
+                    "{:.2f}".format(r["seconds"] / p["seconds"]),
+                ]
+            )
+        )
+
+
+if __name__ == "__main__":
+    description = __doc__
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        "--engines",
+        metavar="ENGINES",
+        action="store",
+        dest="engines",
+        default="projection,local,numpy",
+        help="Comma separated engines, s3select is slow as the queries run in Python",
+    )
+    parser.add_argument(
+        "--rates",
+        metavar="RATES",
+        action="store",
+        dest="rates",
+        default="5,50,200",
+        help="Comma separated requests per second of the generated logs",
+    )
+    parser.add_argument(
+        "--targets",
+        metavar="TARGETS",
+        action="store",
+        dest="targets",
+        type=int,
+        default=10,
+    )
+    parser.add_argument(
+        "--workers",
+        metavar="WORKERS",
+        action="store",
+        dest="workers",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--output",
+        metavar="FILE",
+        action="store",
+        dest="output",
+        default="bench_output.json",
+        help="JSON file the results are written to",
+    )
+    parser.add_argument(
+        "--baseline",
+        metavar="FILE",
+        action="store",
+        dest="baseline",
+        default="",
+        help="JSON file of a previous run to compare with",
+    )
+    args = parser.parse_args()
+
+    results = []
+    for rate in [float(r) for r in args.rates.split(",")]:
+        for engine in args.engines.split(","):
+            if engine == "numpy" and not aggregator.columnar.available():
+                continue
+            result = bench(
+                engine=engine, rate=rate, targets=args.targets, workers=args.workers
+            )
+            results.append(result)
+            print(
+                "\t".join(
+                    [
+                        engine,
+                        str(rate),
+                        "{lines} lines".format(lines=result["lines"]),
+                        "{:.3f}s".format(result["seconds"]),
+                        " ".join(
+                            "{name}={seconds:.3f}".format(name=name, seconds=seconds)
+                            for name, seconds in sorted(result["stages"].items())
+                        ),
+                    ]
+                )
+            )
+
+    with open(args.output, "w") as f:
+        json.dump(
+            {
+                "commit": commit(),
+                "python": platform.python_version(),
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+    if args.baseline != "":
+        with open(args.baseline, "r") as f:
+            compare(results, json.load(f))
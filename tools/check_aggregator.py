@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+import argparse
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
+
+import aggregator  # noqa: E402
+import backfill  # noqa: E402
+import instrument  # noqa: E402
+import reaggregate  # noqa: E402
+import resolver  # noqa: E402
+import segments  # noqa: E402
+import cli  # noqa: E402
+from cli import Cli  # noqa: E402
+
+import fakes  # noqa: E402
+import loggen  # noqa: E402
+
+__doc__ = "check_aggregator.py runs the aggregator over synthetic logs and checks what it posts across runs"
+
+NOW = datetime.datetime(2018, 7, 2, 22, 31)
+ENVIRONMENT = {
+    "MACKEREL_APIKEY": "check",
+    "REGION": "us-east-2",
+    "PREFIX": "alb",
+    "MACKEREL_SERVICE": "check",
+    "MACKEREL_ROLE": "web",
+    "ENGINE": "local",
+}
+SELF = "custom.alb.aggregator."
+
+
+def generate(rate=5.0, targets=3, **kwargs):
+    profile = loggen.Profile(rate=rate, targets=targets, **kwargs)
+    objects = {}
+    for key, body, last_modified in loggen.objects(
+        start=NOW - datetime.timedelta(minutes=15), end=NOW, profile=profile
+    ):
+        objects[key] = (body, last_modified)
+    return profile, objects
+
+
+def run(objects=None, profile=None, now=NOW, **environment):
+    """Run the aggregator over `objects` and return the posted points."""
+    for name in ("CHECKPOINT", "INSTRUMENT", "LOG_CACHE"):
+        os.environ.pop(name, None)
+    os.environ.update(ENVIRONMENT)
+    os.environ.update(environment)
+    os.environ["LOAD_BALANCER_NAME"] = profile.name
+    cli = Cli()
+    mkr = fakes.Mackerel(profile=profile)
+    clients = {
+        "mackerel": mkr,
+        "sts": fakes.STS(account=profile.account),
+        "s3": fakes.S3(objects=objects),
+        "ec2": fakes.EC2(),
+        "elbv2": fakes.ELBv2(profile=profile),
+    }
+    resolver.clear()
+    instrument.start(enabled=cli.instrument)
+    try:
+        aggregator.run(cli=cli, clients=clients, now=now)
+    finally:
+        instrument.start(enabled=False)
+    return {(p["hostId"], p["name"], p["time"]): p["value"] for p in mkr.metrics}
+
+
+def check_self_metrics_not_checkpointed():
+    profile, objects = generate()
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "checkpoint.json")
+        first = run(objects=objects, profile=profile, CHECKPOINT=path, INSTRUMENT="1")
+        second = run(objects=objects, profile=profile, CHECKPOINT=path, INSTRUMENT="1")
+    finally:
+        shutil.rmtree(directory)
+    logs = {k: v for k, v in first.items() if not k[1].startswith(SELF)}
+    assert len(logs) > 0 and len(logs) < len(first), len(first)
+    # The second run posts the checkpointed windows as they were
+    assert {k: v for k, v in second.items() if not k[1].startswith(SELF)} == logs
+    # and only its own self-metrics, not those of the first run added to them
+    calls = [
+        v for k, v in second.items() if k[1] == SELF + "calls.listing" and k[0] == "alb"
+    ]
+    assert calls == [1.0], calls
+
+
+def check_reaggregate_account():
+    # Load balancers of the same name in two accounts, logging to one cache
+    profile, objects = generate()
+    other, other_objects = generate(
+        account="210987654321", load_balancer_id="0123456789abcdef"
+    )
+    start = NOW - datetime.timedelta(minutes=6)
+    end = NOW - datetime.timedelta(minutes=1)
+    directory = tempfile.mkdtemp()
+    try:
+        posted = run(objects=objects, profile=profile, LOG_CACHE=directory)
+        run(objects=other_objects, profile=other, LOG_CACHE=directory)
+        cache = segments.Cache(directory=directory, max_bytes=1 << 30)
+        found = list(cache.segments(start=start, end=end))
+        assert len(found) == 4, found
+        metrics, _ = reaggregate.reaggregate(
+            cli=Cli(),
+            mkr_client=fakes.Mackerel(profile=profile),
+            cache=cache,
+            start=start,
+            end=end,
+            account_id=profile.account,
+        )
+    finally:
+        shutil.rmtree(directory)
+    # Only the segments of the account are reaggregated
+    points = {(p["hostId"], p["name"], p["time"]): p["value"] for p in metrics}
+    assert points == posted, sorted(set(points) ^ set(posted))[:3]
+
+
+def check_path_patterns():
+    assert cli.path_patterns('[["^[0-9]+$", ":id"]]') == [["^[0-9]+$", ":id"]]
+    for value in (
+        "[[",
+        '{"^a$": "b"}',
+        '["^a$", "b"]',
+        '[["^a$"]]',
+        '[["^a$", 1]]',
+        '[["(", "b"]]',
+        '[["^a$", "\\\\9"]]',
+    ):
+        try:
+            cli.path_patterns(value)
+        except ValueError as e:
+            assert "TOPK_PATH_PATTERNS" in str(e), e
+            continue
+        raise AssertionError("{value} is taken as path patterns".format(value=value))
+    os.environ.update(ENVIRONMENT)
+    os.environ["LOAD_BALANCER_NAME"] = "my-lb"
+    os.environ["TOPK_PATH_PATTERNS"] = "[]x"
+    try:
+        Cli()
+    except ValueError as e:
+        assert "TOPK_PATH_PATTERNS" in str(e), e
+    else:
+        raise AssertionError("Cli takes malformed TOPK_PATH_PATTERNS")
+    finally:
+        del os.environ["TOPK_PATH_PATTERNS"]
+
+
+def check_backfill_shards():
+    start = datetime.datetime(2018, 7, 2)
+    # (shard minutes, window seconds, minutes of the range), ranges and shards
+    # not multiples of the shards and windows
+    for minutes, duration, length in (
+        (60, 60, 150),
+        (60, 300, 95),
+        (7, 300, 95),
+        (60, 420, 61),
+        (1, 300, 12),
+    ):
+        end = start + datetime.timedelta(minutes=length)
+        shards = backfill.shards(
+            start=start, end=end, minutes=minutes, duration=duration
+        )
+        windows = [w for s in shards for w in s.windows]
+        # Windows follow each other without overlap, each in its shard
+        assert windows[0].start == start and windows[-1].end == end, (
+            minutes,
+            duration,
+        )
+        for previous, w in zip(windows, windows[1:]):
+            assert previous.end == w.start, (minutes, duration, previous.end, w.start)
+        for s in shards:
+            assert s.windows[0].start == s.start and s.windows[-1].end == s.end, (
+                minutes,
+                duration,
+                s.id,
+            )
+
+
+CHECKS = (
+    ("self-metrics not checkpointed", check_self_metrics_not_checkpointed),
+    ("reaggregate account", check_reaggregate_account),
+    ("path patterns", check_path_patterns),
+    ("backfill shards", check_backfill_shards),
+)
+
+
+if __name__ == "__main__":
+    description = __doc__
+    parser = argparse.ArgumentParser(description=description)
+    parser.parse_args()
+
+    failed = 0
+    for name, check in CHECKS:
+        try:
+            check()
+        except AssertionError as e:
+            failed += 1
+            print("FAIL\t{name}\t{e}".format(name=name, e=e))
+            continue
+        print("ok\t{name}".format(name=name))
+    if failed > 0:
+        sys.exit(1)
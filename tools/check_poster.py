@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
+
+import fakes  # noqa: E402
+import poster  # noqa: E402
+
+__doc__ = (
+    "check_poster.py posts points and graph definitions to a local fake Mackerel server"
+)
+
+# Short enough to check retries without waiting
+BACKOFF = 0.01
+
+
+def points(n):
+    return [
+        {
+            "hostId": "host-0",
+            "name": "custom.alb.n{i}".format(i=i),
+            "time": i,
+            "value": 1.0,
+        }
+        for i in range(n)
+    ]
+
+
+def client(server):
+    from mackerel.clienthde import Client
+
+    return Client(mackerel_api_key="check", mackerel_origin=server.origin)
+
+
+def posts(server):
+    return [
+        path
+        for method, path in server.requests
+        if method == "POST" and path == "/api/v0/tsdb"
+    ]
+
+
+def check_batches():
+    data = points(1234)
+    with fakes.MackerelServer() as server:
+        result = poster.post(mkr_client=client(server), data=data, size=500, workers=3)
+    assert result.batches == 3, result.batches
+    assert result.posted == len(data) and result.failed == [], (
+        result.posted,
+        result.failed,
+    )
+    assert len(posts(server)) == 3, posts(server)
+    assert sorted(p["name"] for p in server.metrics) == sorted(p["name"] for p in data)
+
+
+def check_retries():
+    data = points(1000)
+    # Every batch fails once or twice before it is posted
+    with fakes.MackerelServer(failures=2) as server:
+        result = poster.post(
+            mkr_client=client(server),
+            data=data,
+            size=500,
+            workers=1,
+            attempts=3,
+            backoff=BACKOFF,
+        )
+    assert result.posted == len(data) and result.failed == [], (
+        result.posted,
+        result.failed,
+    )
+    assert len(posts(server)) == 4, posts(server)
+    assert len(server.metrics) == len(data)
+
+
+def check_backoff():
+    sleeps = []
+
+    def fail():
+        raise IOError("injected")
+
+    try:
+        poster.retry(fail, attempts=4, backoff=1.0, sleep=sleeps.append)
+    except IOError:
+        pass
+    else:
+        raise AssertionError("the last failure is not raised")
+    # No sleep after the last attempt, each under the doubled backoff
+    assert len(sleeps) == 3, sleeps
+    for attempt, seconds in enumerate(sleeps):
+        assert 0 <= seconds <= 2**attempt, (attempt, seconds)
+
+
+def check_partial_failure():
+    data = points(1500)
+    # The first batch fails every attempt, the others are posted
+    with fakes.MackerelServer(failures=3, status=503) as server:
+        result = poster.post(
+            mkr_client=client(server),
+            data=data,
+            size=500,
+            workers=1,
+            attempts=3,
+            backoff=BACKOFF,
+        )
+    assert result.batches == 3, result.batches
+    assert result.posted == 1000, result.posted
+    assert len(result.failed) == 1 and result.failed_points == 500, result.failed
+    assert result.failed[0][0] == data[:500]
+    assert sorted(p["time"] for p in server.metrics) == list(range(500, 1500))
+
+
+def check_graph_definitions():
+    params = [
+        {
+            "name": "custom.alb.{name}".format(name=name),
+            "unit": "integer",
+            "metrics": [
+                {
+                    "name": "custom.alb.{name}.count".format(name=name),
+                    "isStacked": False,
+                }
+            ],
+        }
+        for name in ("a", "b", "c")
+    ]
+    cache = {}
+    with fakes.MackerelServer() as server:
+        mkr = client(server)
+        created = [
+            poster.create_graph_definitions(mkr_client=mkr, params=params, cache=cache)
+        ]
+        # Unchanged definitions are skipped, a changed one is created again
+        created.append(
+            poster.create_graph_definitions(mkr_client=mkr, params=params, cache=cache)
+        )
+        params[1] = dict(params[1], unit="float")
+        created.append(
+            poster.create_graph_definitions(mkr_client=mkr, params=params, cache=cache)
+        )
+        # Every definition is created again once older than `ttl`
+        created.append(
+            poster.create_graph_definitions(
+                mkr_client=mkr, params=params, cache=cache, ttl=0
+            )
+        )
+    assert created == [3, 0, 1, 3], created
+    assert [d["name"] for d in server.graph_definitions] == [
+        "custom.alb.a",
+        "custom.alb.b",
+        "custom.alb.c",
+        "custom.alb.b",
+        "custom.alb.a",
+        "custom.alb.b",
+        "custom.alb.c",
+    ]
+
+
+CHECKS = (
+    ("batches", check_batches),
+    ("retries", check_retries),
+    ("backoff", check_backoff),
+    ("partial failure", check_partial_failure),
+    ("graph definitions", check_graph_definitions),
+)
+
+
+if __name__ == "__main__":
+    description = __doc__
+    parser = argparse.ArgumentParser(description=description)
+    parser.parse_args()
+
+    failed = 0
+    for name, check in CHECKS:
+        try:
+            check()
+        except AssertionError as e:
+            failed += 1
+            print("FAIL\t{name}\t{e}".format(name=name, e=e))
+            continue
+        print("ok\t{name}".format(name=name))
+    if failed > 0:
+        sys.exit(1)
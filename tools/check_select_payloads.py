@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+import argparse
+import csv
+import io
+import os
+import random
+import sys
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
+
+import aggregator  # noqa: E402
+import logs  # noqa: E402
+
+__doc__ = (
+    "check_select_payloads.py parses S3 Select output split into payloads at every byte"
+)
+
+# Rows as S3 Select writes them, with multi-byte characters and quoted fields
+# holding delimiters, quotes and line breaks
+ROWS = [
+    ["2018-07-02T22:23:00.186641Z", "10.0.0.1:80", "0.000", "0.001", "0.000", "200"],
+    ["2018-07-02T22:23:01.000000Z", "-", "-1", "-1", "-1", "-"],
+    ["2018-07-02T22:23:02.5Z", "10.0.0.2:80", "0.1", "0.2", "0.3", 'GET /é漢字🙂 "q"'],
+    ["2018-07-02T22:23:03Z", "a\tb", "line\nbreak", "", "0", "ü" * 7],
+    ["", "", "", "", "", ""],
+]
+
+
+def output(rows):
+    out = io.StringIO()
+    writer = csv.writer(out, delimiter="\t", quotechar='"', lineterminator="\n")
+    writer.writerows(rows)
+    return out.getvalue().encode("utf-8")
+
+
+def events(payloads, end=True):
+    result = [{"Records": {"Payload": p}} for p in payloads]
+    result.append(
+        {
+            "Stats": {
+                "Details": {"BytesScanned": 0, "BytesProcessed": 0, "BytesReturned": 0}
+            }
+        }
+    )
+    if end:
+        result.append({"End": {}})
+    return result
+
+
+def parsed(payloads, end=True):
+    chunks = aggregator.select_payloads(events(payloads, end=end), key="check")
+    return [list(row) for row in logs.parse_rows(logs.stream_lines(chunks))]
+
+
+def check_every_offset():
+    data = output(ROWS)
+    for offset in range(len(data) + 1):
+        rows = parsed([data[:offset], data[offset:]])
+        assert rows == ROWS, (offset, rows)
+
+
+def check_every_pair_of_offsets():
+    data = output(ROWS[2:4])
+    for first in range(len(data) + 1):
+        for second in range(first, len(data) + 1):
+            rows = parsed([data[:first], data[first:second], data[second:]])
+            assert rows == ROWS[2:4], (first, second, rows)
+
+
+def check_single_bytes():
+    data = output(ROWS)
+    rows = parsed([data[i : i + 1] for i in range(len(data))])  # noqa: E203
+    assert rows == ROWS, rows
+
+
+def check_multi_byte_characters():
+    data = output(ROWS)
+    # Offsets inside a character, where bytes are continuation bytes
+    inside = [i for i in range(1, len(data)) if data[i] & 0xC0 == 0x80]
+    assert len(inside) > 10, inside
+    for offset in inside:
+        rows = parsed([data[:offset], data[offset:]])
+        assert rows == ROWS, (offset, rows)
+
+
+def check_random_splits():
+    r = random.Random(1)
+    rows = [[r.choice(ROWS)[i] for i in range(6)] for _ in range(200)]
+    data = output(rows)
+    for _ in range(200):
+        cuts = sorted(r.sample(range(len(data) + 1), r.randint(1, 50)))
+        payloads = [data[a:b] for a, b in zip([0] + cuts, cuts + [len(data)])]
+        assert parsed(payloads) == rows, cuts
+
+
+def check_types():
+    data = output([["1.5", "", "2"], ["", "", ""]])
+    for offset in range(len(data) + 1):
+        chunks = aggregator.select_payloads(
+            events([data[:offset], data[offset:]]), key="check"
+        )
+        rows = list(logs.parse_rows(logs.stream_lines(chunks), types=(float,) * 3))
+        assert rows == [(1.5, None, 2.0), (None, None, None)], (offset, rows)
+
+
+def check_missing_end():
+    data = output(ROWS)
+    try:
+        parsed([data[:10], data[10:]], end=False)
+    except IOError:
+        return
+    raise AssertionError("a response without End event is taken as complete")
+
+
+CHECKS = (
+    ("every offset", check_every_offset),
+    ("every pair of offsets", check_every_pair_of_offsets),
+    ("single bytes", check_single_bytes),
+    ("multi-byte characters", check_multi_byte_characters),
+    ("random splits", check_random_splits),
+    ("types", check_types),
+    ("missing End", check_missing_end),
+)
+
+
+if __name__ == "__main__":
+    description = __doc__
+    parser = argparse.ArgumentParser(description=description)
+    parser.parse_args()
+
+    failed = 0
+    for name, check in CHECKS:
+        try:
+            check()
+        except AssertionError as e:
+            failed += 1
+            print("FAIL\t{name}\t{e}".format(name=name, e=e))
+            continue
+        print("ok\t{name}".format(name=name))
+    if failed > 0:
+        sys.exit(1)
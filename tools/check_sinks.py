@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
+
+import fakes  # noqa: E402
+import sinks  # noqa: E402
+
+__doc__ = "check_sinks.py writes points through the sinks to a local gmond listener, file and fake Mackerel server"
+
+# Seconds a check waits for what a sink thread writes
+TIMEOUT = 5.0
+
+
+def points(n, host_id="host-0", time=1530570660):
+    return [
+        {
+            "hostId": host_id,
+            "name": "custom.alb.n{i}".format(i=i),
+            "time": time,
+            "value": float(i),
+        }
+        for i in range(n)
+    ]
+
+
+def wait(condition, timeout=TIMEOUT):
+    """Return whether `condition()` became true within `timeout` seconds."""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def write(sink, data):
+    """Write `data` through a Fanout to `sink` and return the `ok` of its mark."""
+    fanout = sinks.Fanout(sinks=[sink])
+    ok = []
+    for point in data:
+        fanout.put(point)
+    fanout.mark(ok.append)
+    fanout.close()
+    return ok[0]
+
+
+class BlockingSink(sinks.Sink):
+    """BlockingSink writes nothing until `release` is set."""
+
+    name = "blocking"
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.release = threading.Event()
+
+    def write(self, points):
+        self.release.wait()
+        self.written += len(points)
+
+
+class ListSink(sinks.Sink):
+    name = "list"
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.points = []
+
+    def write(self, points):
+        self.points.extend(points)
+        self.written += len(points)
+
+
+def check_ganglia():
+    data = points(50)
+    with fakes.GmondListener() as listener:
+        sink = sinks.GangliaSink(
+            host="127.0.0.1", port=listener.port, group="alb", batch_size=20
+        )
+        assert write(sink, data)
+        assert wait(lambda: len(listener.values) == len(data)), len(listener.values)
+    assert sink.written == len(data) and sink.failed == [], sink.failed
+    # Spoofed as the host ID, named without `custom.`
+    for point, (host, name, value) in zip(data, listener.values):
+        assert host == "host-0:host-0", host
+        assert name == point["name"][len("custom.") :], name  # noqa: E203
+        assert value == point["value"], (name, value)
+        metadata = listener.metadata[(host, name)]
+        assert metadata["GROUP"] == "alb" and metadata["SPOOF_HOST"] == host, metadata
+        assert metadata["type"] == "double" and metadata["tmax"] == sinks.GANGLIA_TMAX
+
+
+def check_openmetrics():
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "alb.prom")
+        sink = sinks.OpenMetricsSink(path=path, batch_size=10)
+        data = (
+            points(20, time=1530570660)
+            + points(20, time=1530570600)
+            + points(1, host_id='a"b', time=1530570660)
+        )
+        data[0] = dict(data[0], value=float("nan"))
+        assert write(sink, data)
+        assert sink.written == len(data) and sink.failed == [], sink.failed
+        with open(path) as f:
+            text = f.read()
+        assert os.listdir(directory) == ["alb.prom"], os.listdir(directory)
+    finally:
+        shutil.rmtree(directory)
+    lines = text.splitlines()
+    assert lines[-1] == "# EOF", lines[-1]
+    # The latest point of each series, the older ones put after it are dropped,
+    # without timestamp as the node_exporter textfile collector rejects them
+    assert 'custom_alb_n0{host_id="a\\"b"} 0.0' in lines, lines[:3]
+    assert 'custom_alb_n0{host_id="host-0"} NaN' in lines, lines[:3]
+    assert 'custom_alb_n7{host_id="host-0"} 7.0' in lines
+    assert len([line for line in lines if line.startswith("# TYPE ")]) == 20
+    assert len([line for line in lines if not line.startswith("#")]) == 21
+
+
+def check_openmetrics_families():
+    sink = sinks.OpenMetricsSink(path="")
+    # `x0` sorts between `x.y` and `x_y`, which are sanitized the same
+    for name, timestamp, value in (
+        ("x.y", 1530570660, 1.0),
+        ("x0", 1530570660, 0.0),
+        ("x_y", 1530570600, 2.0),
+    ):
+        sink.series[("custom.alb." + name, "host-0")] = dict(
+            points(1, time=timestamp)[0], name="custom.alb." + name, value=value
+        )
+    lines = sink.render().splitlines()
+    # One family each, with the latest point of those sanitized the same
+    assert lines == [
+        "# TYPE custom_alb_x0 gauge",
+        'custom_alb_x0{host_id="host-0"} 0.0',
+        "# TYPE custom_alb_x_y gauge",
+        'custom_alb_x_y{host_id="host-0"} 1.0',
+        "# EOF",
+    ], lines
+
+
+def check_mackerel():
+    from mackerel.clienthde import Client
+
+    data = points(2000)
+    with fakes.MackerelServer(delay=0.05) as server:
+        sink = sinks.MackerelSink(
+            mkr_client=Client(mackerel_api_key="check", mackerel_origin=server.origin),
+            workers=4,
+            batch_size=100,
+            flush_interval=60,
+        )
+        assert write(sink, data)
+    assert sink.written == len(data), sink.written
+    assert len(server.metrics) == len(data), len(server.metrics)
+    # Requests of `batch_size`, `workers` at a time
+    assert len(server.requests) == 20, len(server.requests)
+    assert server.max_in_flight == 4, server.max_in_flight
+
+
+def check_mackerel_failure():
+    from mackerel.clienthde import Client
+
+    data = points(300)
+    with fakes.MackerelServer(failures=2) as server:
+        sink = sinks.MackerelSink(
+            mkr_client=Client(mackerel_api_key="check", mackerel_origin=server.origin),
+            workers=1,
+            attempts=1,
+            batch_size=100,
+        )
+        ok = write(sink, data)
+    assert not ok
+    assert sink.written == 100 and sink.failed_points == 200, sink.failed
+
+
+def check_backpressure():
+    queue_size = 10
+    fast = ListSink(batch_size=1, flush_interval=60)
+    slow = BlockingSink(batch_size=1, flush_interval=60)
+    fanout = sinks.Fanout(sinks=[fast, slow], queue_size=queue_size)
+    put = [0]
+
+    def produce():
+        for point in points(100):
+            fanout.put(point)
+            put[0] += 1
+
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+    # One point in the blocked write and `queue_size` queued behind it
+    assert wait(lambda: put[0] == queue_size + 1)
+    time.sleep(0.2)
+    assert producer.is_alive() and put[0] == queue_size + 1, put[0]
+    # The other sink is not held back by the points the slow one queued
+    assert wait(lambda: fast.written == queue_size + 2), fast.written
+    slow.release.set()
+    producer.join(TIMEOUT)
+    fanout.close()
+    assert put[0] == 100 and fast.written == 100 and slow.written == 100
+
+
+def check_flush_interval():
+    sink = ListSink(batch_size=1000, flush_interval=0.2)
+    fanout = sinks.Fanout(sinks=[sink])
+    began = time.monotonic()
+    for point in points(5):
+        fanout.put(point)
+    # Written before the batch is full or the Fanout is closed
+    assert wait(lambda: sink.written == 5, timeout=1.0), sink.written
+    assert time.monotonic() - began >= 0.1
+    full = ListSink(batch_size=10, flush_interval=60)
+    fanout_full = sinks.Fanout(sinks=[full])
+    for point in points(25):
+        fanout_full.put(point)
+    assert wait(lambda: full.written == 20, timeout=1.0), full.written
+    time.sleep(0.2)
+    assert full.written == 20, full.written
+    fanout.close()
+    fanout_full.close()
+    assert full.written == 25, full.written
+
+
+CHECKS = (
+    ("ganglia", check_ganglia),
+    ("openmetrics", check_openmetrics),
+    ("openmetrics families", check_openmetrics_families),
+    ("mackerel", check_mackerel),
+    ("mackerel failure", check_mackerel_failure),
+    ("backpressure", check_backpressure),
+    ("flush interval", check_flush_interval),
+)
+
+
+if __name__ == "__main__":
+    description = __doc__
+    parser = argparse.ArgumentParser(description=description)
+    parser.parse_args()
+
+    failed = 0
+    for name, check in CHECKS:
+        try:
+            check()
+        except AssertionError as e:
+            failed += 1
+            print("FAIL\t{name}\t{e}".format(name=name, e=e))
+            continue
+        print("ok\t{name}".format(name=name))
+    if failed > 0:
+        sys.exit(1)
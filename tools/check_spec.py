@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+import argparse
+import copy
+import csv
+import datetime
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
+
+import spec  # noqa: E402
+
+import fakes  # noqa: E402
+import loggen  # noqa: E402
+
+__doc__ = "check_spec.py validates metric specs and evaluates their S3 Select conditions over synthetic logs"
+
+START = datetime.datetime(2018, 7, 2, 22, 25)
+
+
+def rows():
+    """Return the fields of synthetic log lines as S3 Select splits them."""
+    profile = loggen.Profile(rate=50, targets=3, no_dispatch=0.2)
+    lines = loggen.lines(
+        start=START, end=START + datetime.timedelta(minutes=1), profile=profile
+    )
+    return list(csv.reader(lines, delimiter=" ", quotechar='"'))
+
+
+def invalid(metric):
+    """Return the error of a spec of the default metrics and `metric`."""
+    err = spec.validate(copy.deepcopy(spec.DEFAULT) + [metric])
+    assert err is not None, metric
+    return err
+
+
+def check_dispatched_partition():
+    records = rows()
+    dispatched = fakes._expression(spec._predicate("dispatched", True))
+    undispatched = fakes._expression(spec._predicate("dispatched", False))
+    n = 0
+    for f in records:
+        # Every record is either one or the other, as the local engines see it
+        assert dispatched(f) != undispatched(f), f[:10]
+        assert dispatched(f) == (f[5] != "-1" and f[6] != "-1" and f[7] != "-1")
+        n += 0 if dispatched(f) else 1
+    assert 0 < n < len(records), (n, len(records))
+
+
+def check_undispatched_timings():
+    records = rows()
+    record = ["", "-", "-1", "-1", "-1", "-", "503", "100", "200"]
+    for field in spec.TIMINGS:
+        assert spec._number(field, record, False) is None, field
+        # S3 Select sums the timings of dispatched requests only, as the
+        # local engines do
+        sql = "SELECT {columns} FROM S3Object s".format(
+            columns=", ".join(spec._select(aggregate="sum", field=field))
+        )
+        total = float(fakes.select(records, sql))
+        expected = sum(
+            (
+                float(f[5]) + float(f[6]) + float(f[7])
+                if field == "latency"
+                else float(f[5 + spec.TIMINGS.index(field) - 1])
+            )
+            for f in records
+            if f[5] != "-1"
+        )
+        assert abs(total - expected) < 1e-9, (field, total, expected)
+
+
+def check_not_a_mapping():
+    assert "mapping" in invalid("latency"), invalid("latency")
+    assert "mapping" in invalid(dict(spec.DEFAULT[1], filter=["dispatched"]))
+    assert "list" in invalid(dict(spec.DEFAULT[0], group_by="status_class"))
+
+
+def check_dispatched_not_bool():
+    for value in ("false", "true", 0, [None]):
+        err = invalid(dict(spec.DEFAULT[1], filter={"dispatched": value}))
+        assert "dispatched" in err, err
+    assert spec.validate([dict(spec.DEFAULT[1], filter={"dispatched": False})]) is None
+
+
+def check_placeholders():
+    assert "elb_status_class" in invalid(
+        dict(spec.DEFAULT[0], name="x.{elb_status_class}xx")
+    )
+    assert "target" in invalid(dict(spec.DEFAULT[3], name="x.{target}.{status_class}"))
+    assert "invalid name" in invalid(dict(spec.DEFAULT[0], name="x.{status_class"))
+    assert spec.validate(spec.DEFAULT) is None
+
+
+def check_load_errors():
+    metrics, err = spec.load(os.path.join(os.path.dirname(__file__), "missing.json"))
+    assert metrics is None and err is not None, err
+    metrics, err = spec.load(os.path.abspath(__file__))
+    assert metrics is None and "JSON" in err, err
+
+
+CHECKS = (
+    ("dispatched partition", check_dispatched_partition),
+    ("undispatched timings", check_undispatched_timings),
+    ("not a mapping", check_not_a_mapping),
+    ("dispatched not bool", check_dispatched_not_bool),
+    ("placeholders", check_placeholders),
+    ("load errors", check_load_errors),
+)
+
+
+if __name__ == "__main__":
+    description = __doc__
+    parser = argparse.ArgumentParser(description=description)
+    parser.parse_args()
+
+    failed = 0
+    for name, check in CHECKS:
+        try:
+            check()
+        except AssertionError as e:
+            failed += 1
+            print("FAIL\t{name}\t{e}".format(name=name, e=e))
+            continue
+        print("ok\t{name}".format(name=name))
+    if failed > 0:
+        sys.exit(1)
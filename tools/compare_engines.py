@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+import argparse
+import datetime
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
+
+import aggregator  # noqa: E402
+import resolver  # noqa: E402
+import spec  # noqa: E402
+import window  # noqa: E402
+from cli import Cli  # noqa: E402
+
+import fakes  # noqa: E402
+import loggen  # noqa: E402
+
+__doc__ = "compare_engines.py checks that every engine posts the same points for the same synthetic logs"
+
+NOW = datetime.datetime(2018, 7, 2, 22, 31)
+ENVIRONMENT = {
+    "MACKEREL_APIKEY": "compare",
+    "REGION": "us-east-2",
+    "PREFIX": "alb",
+    "MACKEREL_SERVICE": "compare",
+    "MACKEREL_ROLE": "web",
+    "PERCENTILES": "50,90,99,99.9",
+    "TOPK_FIELDS": "path,elb_status_code",
+}
+# Metrics of a METRIC_SPEC file, with every aggregate and key
+SPEC = [
+    {
+        "graph": "sent_bytes.status",
+        "name": "sent_bytes.status.{elb_status_class}xx",
+        "unit": "bytes",
+        "aggregate": "sum",
+        "field": "sent_bytes",
+        "filter": {"elb_status_class": ["2", "3", "4", "5"]},
+        "group_by": ["elb_status_class"],
+    },
+    {
+        "graph": "received_bytes.target",
+        "name": "received_bytes",
+        "unit": "bytes",
+        "aggregate": "distribution",
+        "field": "received_bytes",
+        "filter": {"status_class": ["2", "3"]},
+        "group_by": ["target"],
+    },
+    {
+        "graph": "target_processing_time.",
+        "name": "target_processing_time",
+        "unit": "float",
+        "aggregate": "distribution",
+        "field": "target_processing_time",
+        "filter": {"dispatched": [True]},
+    },
+    {
+        "graph": "errors.target",
+        "name": "errors.{status_class}xx",
+        "unit": "integer",
+        "aggregate": "count",
+        "filter": {"status_class": ["4", "5"]},
+        "group_by": ["target", "status_class"],
+    },
+]
+# Relative difference tolerated between the values of two engines
+TOLERANCE = 1e-9
+
+
+def run(objects=None, profile=None, engine="local", **environment):
+    """Run the aggregator with `engine` over `objects` and return the posted points."""
+    for name in ("ENGINE", "METRIC_SPEC", "LOG_CACHE"):
+        os.environ.pop(name, None)
+    os.environ.update(ENVIRONMENT)
+    os.environ.update(environment)
+    os.environ["LOAD_BALANCER_NAME"] = profile.name
+    os.environ["ENGINE"] = engine
+    cli = Cli()
+    metric_spec, err = spec.load(cli.metric_spec)
+    if err is not None:
+        raise ValueError(err)
+    mkr = fakes.Mackerel(profile=profile)
+    clients = {
+        "mackerel": mkr,
+        "sts": fakes.STS(account=profile.account),
+        "s3": fakes.S3(objects=objects),
+        "ec2": fakes.EC2(),
+        "elbv2": fakes.ELBv2(profile=profile),
+    }
+    resolver.clear()
+    aggregator.run(cli=cli, clients=clients, now=NOW, metric_spec=metric_spec)
+    return {(p["hostId"], p["name"], p["time"]): p["value"] for p in mkr.metrics}
+
+
+def differences(points, reference, subset=False):
+    """Return the differences of `points` from `reference`.
+
+    With `subset`, series `points` lacks are not differences, for engines that
+    post only some of the metrics.
+    """
+    result = []
+    missing = set(reference) - set(points)
+    if not subset and len(missing) > 0:
+        result.append(
+            "missing {n} points, e.g. {p}".format(n=len(missing), p=min(missing))
+        )
+    extra = set(points) - set(reference)
+    if len(extra) > 0:
+        result.append("extra {n} points, e.g. {p}".format(n=len(extra), p=min(extra)))
+    for k in sorted(set(points) & set(reference)):
+        a, b = points[k], reference[k]
+        if a != a and b != b:
+            continue
+        if abs(a - b) > TOLERANCE * max(1.0, abs(b)):
+            result.append("{k} is {a}, not {b}".format(k=k, a=a, b=b))
+    return result
+
+
+def exact_counts(objects=None, profile=None, prefix="alb"):
+    """Count the requests of each target status class in each window from the raw lines."""
+    cli = Cli()
+    windows = window.windows(now=NOW, duration=cli.duration, epochs=cli.epochs)
+    result = {}
+    for body, _ in objects.values():
+        for line in fakes.gzip.decompress(body).decode("utf-8").splitlines():
+            fields = line.split(" ")
+            if fields[9] == "-":
+                continue
+            for w in windows:
+                if not w.contains(fields[1]):
+                    continue
+                k = (
+                    "alb",
+                    "custom.{prefix}.target_status_code.all.{c}xx".format(
+                        prefix=prefix, c=fields[9][0]
+                    ),
+                    int((w.end - datetime.datetime(1970, 1, 1)).total_seconds()) - 1,
+                )
+                result[k] = result.get(k, 0) + 1
+    return result
+
+
+def compare(rate=5.0, targets=5, engines=aggregator.ENGINES):
+    profile = loggen.Profile(rate=rate, targets=targets)
+    objects = {}
+    for key, body, last_modified in loggen.objects(
+        start=NOW - datetime.timedelta(minutes=15), end=NOW, profile=profile
+    ):
+        objects[key] = (body, last_modified)
+
+    failures = []
+    directory = tempfile.mkdtemp()
+    try:
+        spec_path = os.path.join(directory, "spec.json")
+        with open(spec_path, "w") as f:
+            json.dump(SPEC, f)
+        for label, environment in (
+            ("default", {}),
+            ("spec", {"METRIC_SPEC": spec_path}),
+        ):
+            results = {}
+            for engine in engines:
+                if engine == "numpy" and not aggregator.columnar.available():
+                    continue
+                results[engine] = run(
+                    objects=objects, profile=profile, engine=engine, **environment
+                )
+            # The segment cache is written by the first run and read by the second
+            for engine in ("local", "numpy"):
+                if engine not in results:
+                    continue
+                cache = os.path.join(
+                    directory, "{label}-{engine}".format(label=label, engine=engine)
+                )
+                os.mkdir(cache)
+                for attempt in ("written", "read"):
+                    results[
+                        "{engine} cache {attempt}".format(
+                            engine=engine, attempt=attempt
+                        )
+                    ] = run(
+                        objects=objects,
+                        profile=profile,
+                        engine=engine,
+                        LOG_CACHE=cache,
+                        **environment
+                    )
+                if sum(len(files) for _, _, files in os.walk(cache)) == 0:
+                    failures.append(
+                        "{label}\t{engine} cache\tno segment written".format(
+                            label=label, engine=engine
+                        )
+                    )
+
+            reference = results["local"]
+            counts = {}
+            if label == "default":
+                counts = exact_counts(objects=objects, profile=profile)
+            for name, points in sorted(results.items()):
+                # S3 Select posts neither percentiles nor top items
+                found = differences(points, reference, subset=name == "s3select")
+                if len(counts) > 0:
+                    found.extend(
+                        "exact " + d
+                        for d in differences(
+                            {k: v for k, v in points.items() if k in counts}, counts
+                        )
+                    )
+                print(
+                    "{label}\t{name}\t{n} points\t{result}".format(
+                        label=label,
+                        name=name,
+                        n=len(points),
+                        result="ok" if len(found) == 0 else "FAIL",
+                    )
+                )
+                failures.extend(
+                    "{label}\t{name}\t{d}".format(label=label, name=name, d=d)
+                    for d in found
+                )
+    finally:
+        shutil.rmtree(directory)
+    return failures
+
+
+if __name__ == "__main__":
+    description = __doc__
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        "--engines",
+        metavar="ENGINES",
+        action="store",
+        dest="engines",
+        default=",".join(aggregator.ENGINES),
+        help="Comma separated engines compared with the local engine",
+    )
+    parser.add_argument(
+        "--rate",
+        metavar="RATE",
+        action="store",
+        dest="rate",
+        type=float,
+        default=5.0,
+        help="Requests per second of the generated logs",
+    )
+    parser.add_argument(
+        "--targets",
+        metavar="TARGETS",
+        action="store",
+        dest="targets",
+        type=int,
+        default=5,
+    )
+    args = parser.parse_args()
+
+    engines = args.engines.split(",")
+    if "local" not in engines:
+        engines.append("local")
+    failures = compare(rate=args.rate, targets=args.targets, engines=engines)
+    for failure in failures[:20]:
+        print("FAIL\t" + failure)
+    if len(failures) > 0:
+        sys.exit(1)
@@ -0,0 +1,417 @@
+import csv
+import datetime
+import gzip
+import http.server
+import io
+import json
+import re
+import socket
+import socketserver
+import struct
+import threading
+import time
+import zlib
+
+__doc__ = "fakes.py holds local stand-ins of the AWS and Mackerel clients the aggregator calls"
+
+
+def _case(sql):
+    """Translate `CASE WHEN c THEN x [ELSE y] END`, innermost first."""
+    while "CASE WHEN " in sql:
+        start = sql.rindex("CASE WHEN ")
+        end = sql.index(" END", start)
+        inner = sql[start + len("CASE WHEN ") : end]  # noqa: E203
+        condition, _, values = inner.partition(" THEN ")
+        value, _, otherwise = values.partition(" ELSE ")
+        sql = "{head}(({value}) if ({condition}) else ({otherwise})){tail}".format(
+            head=sql[:start],
+            value=value,
+            condition=condition,
+            otherwise=otherwise or "None",
+            tail=sql[end + len(" END") :],  # noqa: E203
+        )
+    return sql
+
+
+def _expression(sql):
+    """Translate the SQL expressions built by `query.Builder` into Python."""
+    e = re.sub(r"CAST\((s\._\d+) AS FLOAT\)", r"float(\1)", _case(sql))
+    e = re.sub(r"CAST\((s\._\d+) AS INT\)", r"int(\1)", e)
+    e = re.sub(r"\bTRUE\b", "True", e)
+    e = re.sub(r"(s\._\d+) LIKE '([^'%]*)%'", r"\1.startswith('\2')", e)
+    e = re.sub(r"(s\._\d+) LIKE '([^'%]*)'", r"(\1 == '\2')", e)
+    e = re.sub(r"(s\._\d+) BETWEEN ('[^']*') AND ('[^']*')", r"(\2 <= \1 <= \3)", e)
+    e = re.sub(r"(s\._\d+) = (-?[\d.]+)", r"(float(\1) == \2)", e)
+    e = re.sub(r"(s\._\d+) <> (-?[\d.]+)", r"(float(\1) != \2)", e)
+    e = re.sub(r"(s\._\d+) = '", r"\1 == '", e)
+    e = re.sub(r"(s\._\d+) <> '", r"\1 != '", e)
+    e = e.replace(" AND ", " and ").replace(" OR ", " or ")
+    e = re.sub(r"s\._(\d+)", lambda m: "f[{i}]".format(i=int(m.group(1)) - 1), e)
+    return eval("lambda f: " + e)
+
+
+def _split(columns):
+    result, depth, current = [], 0, ""
+    for c in columns:
+        depth += {"(": 1, ")": -1}.get(c, 0)
+        if c == "," and depth == 0:
+            result.append(current.strip())
+            current = ""
+        else:
+            current += c
+    result.append(current.strip())
+    return result
+
+
+def select(rows, sql):
+    """Evaluate `sql` over `rows` like S3 Select and return the CSV output."""
+    m = re.match(r"SELECT (.*) FROM S3Object s(?: WHERE (.*))?$", sql)
+    where = _expression(m.group(2)) if m.group(2) else (lambda f: True)
+    selected = [f for f in rows if where(f)]
+
+    out = io.StringIO()
+    writer = csv.writer(out, delimiter="\t", quotechar='"', lineterminator="\n")
+    columns = _split(m.group(1))
+    aggregates = [re.match(r"(COUNT|AVG|SUM|MIN|MAX)\((.*)\)$", c) for c in columns]
+    if not all(aggregates):
+        getters = [_expression(c) for c in columns]
+        for f in selected:
+            writer.writerow([g(f) for g in getters])
+        return out.getvalue()
+
+    row = []
+    for a in aggregates:
+        if a.group(1) == "COUNT":
+            row.append(len(selected))
+            continue
+        g = _expression(a.group(2))
+        # Aggregates skip null values
+        values = [v for v in (g(f) for f in selected) if v is not None]
+        if len(values) == 0:
+            row.append("")
+        elif a.group(1) == "AVG":
+            row.append(repr(sum(values) / len(values)))
+        elif a.group(1) == "SUM":
+            row.append(repr(sum(values)))
+        elif a.group(1) == "MIN":
+            row.append(repr(min(values)))
+        else:
+            row.append(repr(max(values)))
+    writer.writerow(row)
+    return out.getvalue()
+
+
+class S3:
+    """S3 serves gzip objects from memory, including a subset of S3 Select."""
+
+    def __init__(self, objects=None, chunk_size=65536):
+        # key -> (gzip bytes, last modified)
+        self.objects = objects or {}
+        self.chunk_size = chunk_size
+        self.exceptions = type("exceptions", (), {"NoSuchKey": KeyError})
+        # key -> parsed rows, S3 Select runs many queries over each object
+        self._rows = {}
+
+    def list_objects_v2(
+        self, Bucket="", Prefix="", MaxKeys=1000, StartAfter="", ContinuationToken=None
+    ):
+        keys = sorted(
+            k for k in self.objects if k.startswith(Prefix) and k > StartAfter
+        )
+        start = int(ContinuationToken or 0)
+        page = keys[start : start + MaxKeys]  # noqa: E203
+        resp = {"KeyCount": len(page)}
+        if len(page) > 0:
+            resp["Contents"] = [
+                {
+                    "Key": k,
+                    "LastModified": self.objects[k][1],
+                    "Size": len(self.objects[k][0]),
+                    "ETag": '"{:08x}"'.format(zlib.crc32(self.objects[k][0])),
+                }
+                for k in page
+            ]
+        if start + MaxKeys < len(keys):
+            resp["NextContinuationToken"] = str(start + MaxKeys)
+        return resp
+
+    def get_object(self, Bucket="", Key=""):
+        if Key not in self.objects:
+            raise KeyError(Key)
+        return {
+            "Body": io.BytesIO(self.objects[Key][0]),
+            "ContentLength": len(self.objects[Key][0]),
+        }
+
+    def put_object(self, Bucket="", Key="", Body=b"", **kwargs):
+        self.objects[Key] = (Body, datetime.datetime.utcnow())
+        self._rows.pop(Key, None)
+
+    def select_object_content(self, Bucket="", Key="", Expression="", **kwargs):
+        text = gzip.decompress(self.objects[Key][0]).decode("utf-8")
+        if Key not in self._rows:
+            self._rows[Key] = list(
+                csv.reader(io.StringIO(text), delimiter=" ", quotechar='"')
+            )
+        rows = self._rows[Key]
+        payload = select(rows, Expression).encode("utf-8")
+        events = [
+            {"Records": {"Payload": payload[i : i + self.chunk_size]}}  # noqa: E203
+            for i in range(0, len(payload), self.chunk_size)
+        ]
+        events.append(
+            {
+                "Stats": {
+                    "Details": {
+                        "BytesScanned": len(self.objects[Key][0]),
+                        "BytesProcessed": len(text),
+                        "BytesReturned": len(payload),
+                    }
+                }
+            }
+        )
+        events.append({"End": {}})
+        return {"Payload": iter(events)}
+
+
+class STS:
+    def __init__(self, account="123456789012"):
+        self.account = account
+
+    def get_caller_identity(self):
+        return {"Account": self.account}
+
+
+class ELBv2:
+    def __init__(self, profile=None, bucket="alb-logs", prefix=""):
+        self.profile = profile
+        self.bucket = bucket
+        self.prefix = prefix
+        self.arn = "arn:aws:elasticloadbalancing:{region}:{account}:loadbalancer/app/{name}/{id}".format(
+            region=profile.region,
+            account=profile.account,
+            name=profile.name,
+            id=profile.load_balancer_id,
+        )
+
+    def describe_load_balancers(self, Names=None, **kwargs):
+        return {
+            "LoadBalancers": [
+                {"LoadBalancerArn": self.arn, "LoadBalancerName": self.profile.name}
+            ]
+        }
+
+    def describe_load_balancer_attributes(self, LoadBalancerArn=""):
+        return {
+            "Attributes": [
+                {"Key": "access_logs.s3.enabled", "Value": "true"},
+                {"Key": "access_logs.s3.bucket", "Value": self.bucket},
+                {"Key": "access_logs.s3.prefix", "Value": self.prefix},
+            ]
+        }
+
+    def describe_target_groups(self, LoadBalancerArn="", **kwargs):
+        return {"TargetGroups": [{"TargetGroupArn": "tg", "TargetType": "ip"}]}
+
+    def describe_target_health(self, TargetGroupArn=""):
+        return {
+            "TargetHealthDescriptions": [
+                {"Target": {"Id": t.split(":")[0], "Port": int(t.split(":")[1])}}
+                for t in self.profile.targets
+            ]
+        }
+
+
+class EC2:
+    def describe_instances(self, **kwargs):
+        return {"Reservations": []}
+
+
+class Host:
+    def __init__(self, id="", name="", ip=""):
+        self.id = id
+        self.name = name
+        self.interfaces = [{"ipAddress": ip}]
+
+
+class Mackerel:
+    """Mackerel keeps what the aggregator posts instead of sending it."""
+
+    def __init__(self, profile=None):
+        self.hosts = [Host(id="alb", name=profile.name, ip="")] + [
+            Host(
+                id="host-{i}".format(i=i),
+                name="web-{i}".format(i=i),
+                ip=t.split(":")[0],
+            )
+            for i, t in enumerate(profile.targets)
+        ]
+        self.graph_definitions = []
+        self.metrics = []
+
+    def get_hosts(self, service="", role=None):
+        if role == "alb":
+            return self.hosts[:1]
+        return self.hosts[1:]
+
+    def create_graph_definition(self, **kwargs):
+        self.graph_definitions.append(kwargs)
+
+    def post_metrics(self, metrics=None):
+        self.metrics.extend(metrics)
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class MackerelServer:
+    """MackerelServer serves the Mackerel API endpoints the aggregator calls over HTTP.
+
+    Pass `origin` as `mackerel_origin` of `mackerel.clienthde.Client`. The first
+    `failures` requests posting metrics fail with `status`. Each request posting
+    metrics takes `delay` seconds, and `max_in_flight` counts those served at once.
+    """
+
+    def __init__(self, hosts=None, failures=0, status=500, delay=0.0):
+        self.hosts = hosts or []
+        self.failures = failures
+        self.status = status
+        self.delay = delay
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.requests = []
+        self.graph_definitions = []
+        self.metrics = []
+        self._lock = threading.Lock()
+        self._server = _ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.origin = "http://127.0.0.1:{port}".format(
+            port=self._server.server_address[1]
+        )
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+        return False
+
+    def _handler(self):
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _reply(self, status, body):
+                payload = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                with server._lock:
+                    server.requests.append(("GET", self.path))
+                if self.path.startswith("/api/v0/hosts"):
+                    return self._reply(200, {"hosts": server.hosts})
+                return self._reply(404, {"error": self.path})
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                if self.path == "/api/v0/tsdb":
+                    with server._lock:
+                        server.in_flight += 1
+                        server.max_in_flight = max(
+                            server.max_in_flight, server.in_flight
+                        )
+                    time.sleep(server.delay)
+                    with server._lock:
+                        server.in_flight -= 1
+                with server._lock:
+                    server.requests.append(("POST", self.path))
+                    if self.path == "/api/v0/tsdb" and server.failures > 0:
+                        server.failures -= 1
+                        return self._reply(server.status, {"error": "injected"})
+                    if self.path == "/api/v0/tsdb":
+                        server.metrics.extend(json.loads(body.decode("utf-8")))
+                    elif self.path == "/api/v0/graph-defs/create":
+                        server.graph_definitions.extend(
+                            json.loads(body.decode("utf-8"))
+                        )
+                    else:
+                        return self._reply(404, {"error": self.path})
+                return self._reply(200, {"success": True})
+
+        return Handler
+
+
+class _XDR:
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def uint(self):
+        (value,) = struct.unpack_from(">I", self.data, self.offset)
+        self.offset += 4
+        return value
+
+    def string(self):
+        n = self.uint()
+        value = self.data[self.offset : self.offset + n].decode("utf-8")  # noqa: E203
+        self.offset += n + (-n % 4)
+        return value
+
+
+class GmondListener:
+    """GmondListener receives gmetric UDP packets like gmond and decodes them.
+
+    `metadata` maps (host, name) to the declared metric and `values` lists
+    every (host, name, value) received.
+    """
+
+    def __init__(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # Room for bursts of packets, UDP drops what does not fit
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        self.socket.bind(("127.0.0.1", 0))
+        self.socket.settimeout(0.2)
+        self.port = self.socket.getsockname()[1]
+        self.metadata = {}
+        self.values = []
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._receive)
+        self._thread.daemon = True
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._closed.set()
+        self._thread.join()
+        self.socket.close()
+        return False
+
+    def _receive(self):
+        while not self._closed.is_set():
+            try:
+                data, _ = self.socket.recvfrom(65536)
+            except socket.timeout:
+                continue
+            x = _XDR(data)
+            message = x.uint()
+            host, name, _ = x.string(), x.string(), x.uint()
+            if message == 128:
+                metric = {"type": x.string(), "name": x.string(), "units": x.string()}
+                metric.update(slope=x.uint(), tmax=x.uint(), dmax=x.uint())
+                metric.update({x.string(): x.string() for _ in range(x.uint())})
+                self.metadata[(host, name)] = metric
+            elif message == 133:
+                x.string()  # format
+                self.values.append((host, name, float(x.string())))
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+import argparse
+import datetime
+import gzip
+import os
+import random
+import zlib
+
+__doc__ = (
+    "loggen.py writes synthetic ALB access log objects as the ALB delivers them to S3"
+)
+
+LINE = (
+    "{type} {time} app/{name}/{id} {client} {target} "
+    "{request_time} {target_time} {response_time} {elb_status} {target_status} {received} {sent} "
+    '"{method} https://{domain}:443{path} HTTP/1.1" "{user_agent}" ECDHE-RSA-AES128-GCM-SHA256 TLSv1.2 '
+    "arn:aws:elasticloadbalancing:{region}:{account}:targetgroup/{name}-targets/73e2d6bc24d8a067 "
+    '"Root=1-{trace}" "{domain}" "arn:aws:acm:{region}:{account}:certificate/12345678-1234-1234-1234-123456789012" '
+    '0 {time} "forward" "-" "-" "{target}" "{target_status}" "-" "-"'
+)
+
+PATHS = ["/", "/login", "/api/v1/users/{n}", "/api/v1/items/{n}", "/static/{n}.js"]
+USER_AGENTS = ["curl/7.46.0", "Mozilla/5.0 (X11; Linux x86_64)", "python-requests/2.20"]
+
+
+class Profile:
+    """Profile describes the traffic of a load balancer to generate."""
+
+    def __init__(
+        self,
+        rate=100.0,
+        targets=10,
+        status=None,
+        latency=(-3.5, 1.0),
+        no_dispatch=0.001,
+        name="my-lb",
+        load_balancer_id="50dc6c495c0c9188",
+        account="123456789012",
+        region="us-east-2",
+        nodes=1,
+    ):
+        # Requests per second
+        self.rate = rate
+        self.targets = [
+            "10.0.{a}.{b}:80".format(a=i // 250, b=i % 250 + 1) for i in range(targets)
+        ]
+        # Status code -> weight
+        self.status = status or {"200": 90, "301": 3, "404": 4, "500": 1, "503": 1}
+        # (mu, sigma) of the lognormal target processing time in seconds
+        self.latency = latency
+        # Ratio of requests never dispatched to a target
+        self.no_dispatch = no_dispatch
+        self.name = name
+        self.load_balancer_id = load_balancer_id
+        self.account = account
+        self.region = region
+        # Load balancer nodes, each delivers its own object per interval
+        self.nodes = nodes
+
+
+def lines(start=None, end=None, profile=None, seed=0):
+    """Generate log lines between `start` and `end` in time order."""
+    r = random.Random(seed)
+    codes = list(profile.status)
+    weights = [profile.status[c] for c in codes]
+    t = start
+    while True:
+        t = t + datetime.timedelta(seconds=r.expovariate(profile.rate))
+        if t >= end:
+            return
+        target = r.choice(profile.targets)
+        target_status = r.choices(codes, weights)[0]
+        elb_status = target_status
+        times = (
+            r.expovariate(2000),
+            r.lognormvariate(*profile.latency),
+            r.expovariate(20000),
+        )
+        timing = ["{:.3f}".format(t) for t in times]
+        if r.random() < profile.no_dispatch:
+            # ALB logs `-1` as is for requests never dispatched
+            target, target_status, elb_status = "-", "-", "503"
+            timing = ["-1", "-1", "-1"]
+        yield LINE.format(
+            type="https",
+            time=t.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+            name=profile.name,
+            id=profile.load_balancer_id,
+            client="192.168.{a}.{b}:{port}".format(
+                a=r.randint(0, 255), b=r.randint(1, 254), port=r.randint(1024, 65535)
+            ),
+            target=target,
+            request_time=timing[0],
+            target_time=timing[1],
+            response_time=timing[2],
+            elb_status=elb_status,
+            target_status=target_status,
+            received=r.randint(100, 2000),
+            sent=r.randint(100, 20000),
+            method=r.choice(["GET", "GET", "GET", "POST"]),
+            domain="www.example.com",
+            path=r.choice(PATHS).format(n=r.randint(1, 1000)),
+            user_agent=r.choice(USER_AGENTS),
+            region=profile.region,
+            account=profile.account,
+            trace="{:08x}-{:024x}".format(r.getrandbits(32), r.getrandbits(96)),
+        )
+
+
+def key(prefix="", profile=None, end=None, node=0):
+    return "{prefix}AWSLogs/{account}/elasticloadbalancing/{region}/{date}/{account}_elasticloadbalancing_{region}_app.{name}.{id}_{end}_10.1.0.{node}_{random}.log.gz".format(  # noqa: E501
+        prefix=prefix + "/" if prefix != "" else "",
+        account=profile.account,
+        region=profile.region,
+        date=end.strftime("%Y/%m/%d"),
+        name=profile.name,
+        id=profile.load_balancer_id,
+        end=end.strftime("%Y%m%dT%H%MZ"),
+        node=node + 1,
+        random="{:08x}".format(
+            zlib.crc32("{end}/{node}".format(end=end, node=node).encode())
+        ),
+    )
+
+
+def objects(start=None, end=None, profile=None, prefix="", seed=0):
+    """Generate `(key, gzip bytes, last modified)` for every 5 minutes logging interval."""
+    interval = datetime.timedelta(minutes=5)
+    t = start - datetime.timedelta(minutes=start.minute % 5, seconds=start.second)
+    rate = profile.rate
+    # Each node logs its share of the requests
+    profile.rate = rate / profile.nodes
+    try:
+        while t < end:
+            for node in range(profile.nodes):
+                body = "".join(
+                    line + "\n"
+                    for line in lines(
+                        start=t,
+                        end=t + interval,
+                        profile=profile,
+                        seed="{seed}/{t}/{node}".format(seed=seed, t=t, node=node),
+                    )
+                )
+                yield (
+                    key(prefix=prefix, profile=profile, end=t + interval, node=node),
+                    gzip.compress(body.encode("utf-8")),
+                    t + interval + datetime.timedelta(seconds=30),
+                )
+            t = t + interval
+    finally:
+        profile.rate = rate
+
+
+if __name__ == "__main__":
+    description = __doc__
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        "--output", metavar="DIR", action="store", dest="output", required=True
+    )
+    parser.add_argument(
+        "--start",
+        metavar="YYYY-MM-DDTHH:MM",
+        action="store",
+        dest="start",
+        default="2018-07-02T22:00",
+        help="UTC time of the first request",
+    )
+    parser.add_argument(
+        "--minutes",
+        metavar="MINUTES",
+        action="store",
+        dest="minutes",
+        type=int,
+        default=30,
+    )
+    parser.add_argument(
+        "--rate",
+        metavar="RATE",
+        action="store",
+        dest="rate",
+        type=float,
+        default=100.0,
+        help="Requests per second",
+    )
+    parser.add_argument(
+        "--targets",
+        metavar="TARGETS",
+        action="store",
+        dest="targets",
+        type=int,
+        default=10,
+    )
+    parser.add_argument(
+        "--status",
+        metavar="CODE=WEIGHT,...",
+        action="store",
+        dest="status",
+        default="200=90,301=3,404=4,500=1,503=1",
+    )
+    parser.add_argument(
+        "--latency",
+        metavar="MU,SIGMA",
+        action="store",
+        dest="latency",
+        default="-3.5,1.0",
+        help="Lognormal parameters of the target processing time",
+    )
+    parser.add_argument(
+        "--prefix", metavar="PREFIX", action="store", dest="prefix", default=""
+    )
+    args = parser.parse_args()
+
+    profile = Profile(
+        rate=args.rate,
+        targets=args.targets,
+        status={
+            code: float(weight)
+            for code, weight in (s.split("=") for s in args.status.split(","))
+        },
+        latency=tuple(float(v) for v in args.latency.split(",")),
+    )
+    start = datetime.datetime.strptime(args.start, "%Y-%m-%dT%H:%M")
+    end = start + datetime.timedelta(minutes=args.minutes)
+    for k, body, _ in objects(
+        start=start, end=end, profile=profile, prefix=args.prefix
+    ):
+        path = os.path.join(args.output, k)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(body)
+        print(path)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+import argparse
+import math
+import os
+import random
+import sys
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
+
+import sketch  # noqa: E402
+
+__doc__ = "sketch_accuracy.py compares the quantiles of latency sketches with exact quantiles of synthetic data"
+
+QUANTILES = (0.001, 0.01, 0.05, 0.25, 0.5, 0.75, 0.9, 0.95, 0.99, 0.999)
+# Samplers of latency-like values in seconds
+DISTRIBUTIONS = {
+    "exponential": lambda r: r.expovariate(20),
+    "lognormal": lambda r: r.lognormvariate(-3, 1.5),
+    "pareto": lambda r: 0.005 * r.paretovariate(1.2),
+    "bimodal": lambda r: (
+        r.gauss(0.02, 0.002) if r.random() < 0.9 else r.gauss(1.5, 0.3)
+    ),
+    "with zeros": lambda r: 0.0 if r.random() < 0.2 else r.expovariate(100),
+}
+# Tolerated above the relative accuracy, for rounding
+EPSILON = 1e-9
+
+
+def exact(values, q):
+    """Return the quantile `q` of sorted `values` as `Sketch.quantile` ranks it."""
+    return values[int(q * (len(values) - 1))]
+
+
+def error(estimate, value):
+    if value <= sketch.MIN_VALUE:
+        return 0.0 if estimate <= sketch.MIN_VALUE else math.inf
+    return abs(estimate - value) / value
+
+
+def sketches(values, parts=4, max_buckets=sketch.MAX_BUCKETS):
+    """Return a sketch of `values` and one merged from `parts` serialized sketches."""
+    single = sketch.Sketch(max_buckets=max_buckets)
+    pieces = [sketch.Sketch(max_buckets=max_buckets) for _ in range(parts)]
+    for i, v in enumerate(values):
+        single.add(v)
+        pieces[i % parts].add(v)
+    merged = sketch.Sketch(max_buckets=max_buckets)
+    for piece in pieces:
+        # Partials and checkpoints keep sketches as dicts between runs
+        restored = sketch.Sketch.from_dict(piece.to_dict())
+        restored.max_buckets = max_buckets
+        merged.merge(restored)
+    return single, merged
+
+
+def evaluate(name="exponential", length=100000, max_buckets=64, seed=1):
+    r = random.Random(seed)
+    sample = DISTRIBUTIONS[name]
+    values = [max(sample(r), 0.0) for _ in range(length)]
+    ordered = sorted(values)
+    result = {"violations": 0}
+
+    for label, buckets in (("", sketch.MAX_BUCKETS), ("collapsed_", max_buckets)):
+        single, merged = sketches(values, max_buckets=buckets)
+        gamma = math.exp(single.log_gamma)
+        for kind, s in (("single", single), ("merged", merged)):
+            if s.count != length or len(s.buckets) > buckets:
+                result["violations"] += 1
+            # Values folded into the lowest bucket by `_collapse` are at or
+            # below its lower bound, and only their quantiles lose accuracy
+            bound = 0.0
+            if len(s.buckets) > 0 and label != "":
+                bound = gamma ** (min(s.buckets) - 1)
+            above = 0.0
+            below = 0.0
+            for q in QUANTILES:
+                value = exact(ordered, q)
+                estimate = s.quantile(q)
+                e = error(estimate, value)
+                if value > bound:
+                    above = max(above, e)
+                    continue
+                below = max(below, e)
+                # Overestimated, up to the lowest bucket at most
+                if value > sketch.MIN_VALUE and not (
+                    value * (1 - s.relative_accuracy) - EPSILON
+                    <= estimate
+                    <= gamma ** min(s.buckets) + EPSILON
+                ):
+                    result["violations"] += 1
+            if above > s.relative_accuracy + EPSILON:
+                result["violations"] += 1
+            result[label + kind] = above
+            result[label + kind + "_low"] = below
+        result[label + "bound"] = bound
+    return result
+
+
+if __name__ == "__main__":
+    description = __doc__
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        "--length",
+        metavar="N",
+        action="store",
+        dest="length",
+        type=int,
+        default=100000,
+        help="Values of each distribution",
+    )
+    parser.add_argument(
+        "--max-buckets",
+        metavar="N",
+        action="store",
+        dest="max_buckets",
+        type=int,
+        default=64,
+        help="Buckets of the collapsed sketches",
+    )
+    args = parser.parse_args()
+
+    violations = 0
+    print(
+        "distribution\tmax error\tmerged max error\tcollapsed below\t"
+        "collapsed max error\tcollapsed merged max error\tlow end max error"
+    )
+    for name in DISTRIBUTIONS:
+        result = evaluate(name=name, length=args.length, max_buckets=args.max_buckets)
+        violations += result["violations"]
+        print(
+            "{name}\t{single:.4%}\t{merged:.4%}\t{collapsed_bound:.6f}\t"
+            "{collapsed_single:.4%}\t{collapsed_merged:.4%}\t{low:.2%}".format(
+                name=name,
+                low=max(result["collapsed_single_low"], result["collapsed_merged_low"]),
+                **result
+            )
+        )
+    if violations > 0:
+        print("{n} sketches out of their relative accuracy".format(n=violations))
+        sys.exit(1)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+import time
+
+# Taken before anything else is imported, see `measure`
+STARTED = time.perf_counter()
+
+import argparse  # noqa: E402
+import datetime  # noqa: E402
+import json  # noqa: E402
+import os  # noqa: E402
+import statistics  # noqa: E402
+import subprocess  # noqa: E402
+import sys  # noqa: E402
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+__doc__ = "startup.py reports the import time and the cold and warm invocation latency of the aggregator"
+
+NOW = datetime.datetime(2018, 7, 2, 22, 31)
+ENVIRONMENT = {
+    "MACKEREL_APIKEY": "startup",
+    "REGION": "us-east-2",
+    "PREFIX": "alb",
+    "MACKEREL_SERVICE": "startup",
+    "MACKEREL_ROLE": "web",
+    # The fake S3 Select of `fakes` is slow, startup is what is measured
+    "ENGINE": "local",
+}
+
+
+def measure(rate=10.0):
+    """Measure one fresh process, as a cold Lambda container runs the function.
+
+    Clients are created for real when boto3 and `mackerel.clienthde` are
+    installed, but the invocations read and post through the stand-ins of
+    `fakes`, so no request leaves the machine. Without them, client creation
+    is not measured and `missing` tells why.
+    """
+    sys.path.insert(0, SRC)
+    began = time.perf_counter()
+    import aggregator
+    from cli import Cli
+
+    imported = time.perf_counter()
+
+    import fakes
+    import loggen
+
+    profile = loggen.Profile(rate=rate)
+    objects = {}
+    for key, body, last_modified in loggen.objects(
+        start=NOW - datetime.timedelta(minutes=15), end=NOW, profile=profile
+    ):
+        objects[key] = (body, last_modified)
+    os.environ.update(ENVIRONMENT)
+    os.environ["LOAD_BALANCER_NAME"] = profile.name
+    cli = Cli()
+    stand_ins = {
+        "mackerel": fakes.Mackerel(profile=profile),
+        "sts": fakes.STS(account=profile.account),
+        "s3": fakes.S3(objects=objects),
+        "ec2": fakes.EC2(),
+        "elbv2": fakes.ELBv2(profile=profile),
+    }
+
+    result = {"import_seconds": imported - began, "process_seconds": imported - STARTED}
+    for invocation in ("first", "warm"):
+        start = time.perf_counter()
+        clients = {}
+        if "missing" not in result:
+            try:
+                clients = aggregator.create_clients(cli=cli)
+            except ImportError as e:
+                result["missing"] = str(e)
+        created = time.perf_counter()
+        # The stand-ins answer in place of the clients just created
+        aggregator.run(cli=cli, clients=dict(clients, **stand_ins), now=NOW)
+        end = time.perf_counter()
+        if "missing" not in result:
+            result[invocation + "_clients_seconds"] = created - start
+        result[invocation + "_invocation_seconds"] = end - start
+    return result
+
+
+if __name__ == "__main__":
+    description = __doc__
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        "--repeat",
+        metavar="N",
+        action="store",
+        dest="repeat",
+        type=int,
+        default=5,
+        help="Fresh processes measured, the median is reported",
+    )
+    parser.add_argument(
+        "--rate",
+        metavar="RATE",
+        action="store",
+        dest="rate",
+        type=float,
+        default=10.0,
+        help="Requests per second of the generated logs",
+    )
+    parser.add_argument(
+        "--measure", action="store_true", dest="measure", help=argparse.SUPPRESS
+    )
+    args = parser.parse_args()
+
+    if args.measure:
+        print(json.dumps(measure(rate=args.rate)))
+        sys.exit(0)
+
+    results = []
+    for _ in range(args.repeat):
+        out = subprocess.check_output(
+            [
+                sys.executable,
+                os.path.abspath(__file__),
+                "--measure",
+                "--rate",
+                str(args.rate),
+            ]
+        )
+        results.append(json.loads(out.decode("utf-8").strip().splitlines()[-1]))
+    missing = results[0].pop("missing", None)
+    if missing is not None:
+        print("Client creation is not measured: {missing}".format(missing=missing))
+    for name in sorted(results[0]):
+        values = [r[name] for r in results]
+        print(
+            "{name}\t{median:.3f}s\t(min {min:.3f}s, max {max:.3f}s)".format(
+                name=name,
+                median=statistics.median(values),
+                min=min(values),
+                max=max(values),
+            )
+        )
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+import argparse
+import collections
+import os
+import random
+import sys
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
+
+import topk  # noqa: E402
+
+__doc__ = (
+    "topk_accuracy.py compares the top-K breakdowns with exact counts of skewed streams"
+)
+
+
+def zipf(r, cardinality=1000, exponent=1.1):
+    """Return a sampler of item ranks in [1, `cardinality`], heaviest first."""
+    weights = [1.0 / (rank**exponent) for rank in range(1, cardinality + 1)]
+    total = sum(weights)
+    cumulative = []
+    acc = 0.0
+    for w in weights:
+        acc += w / total
+        cumulative.append(acc)
+    ranks = list(range(1, cardinality + 1))
+
+    def sample(n):
+        return r.choices(ranks, cum_weights=cumulative, k=n)
+
+    return sample
+
+
+def evaluate(
+    cardinality=1000, exponent=1.1, length=100000, capacity=topk.CAPACITY, k=10, seed=1
+):
+    r = random.Random(seed)
+    stream = [str(rank) for rank in zipf(r, cardinality, exponent)(length)]
+    exact = collections.Counter(stream)
+    hitters = topk.SpaceSaving(capacity=capacity)
+    # Split in two, as objects of the same window are merged
+    halves = (topk.SpaceSaving(capacity=capacity), topk.SpaceSaving(capacity=capacity))
+    for i, item in enumerate(stream):
+        hitters.add(item)
+        halves[i % 2].add(item)
+    merged = halves[0].merge(halves[1])
+
+    result = {"counters": len(hitters.counts), "violations": 0}
+    for name, summary in (("single", hitters), ("merged", merged)):
+        estimated = summary.top(k)
+        true_top = {item for item, _ in exact.most_common(k)}
+        # The true count of every item lies within its error bound
+        for item, count, error in estimated:
+            if not count - error <= exact[item] <= count:
+                result["violations"] += 1
+        result[name + "_recall"] = len(
+            true_top & {item for item, _, _ in estimated}
+        ) / float(k)
+        result[name + "_max_error"] = max(
+            count - exact[item] for item, count, _ in estimated
+        ) / float(length)
+    return result
+
+
+if __name__ == "__main__":
+    description = __doc__
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        "--cardinalities",
+        metavar="N,...",
+        action="store",
+        dest="cardinalities",
+        type=str,
+        default="100,1000,10000,100000",
+        help="Comma separated numbers of distinct items",
+    )
+    parser.add_argument(
+        "--exponent",
+        metavar="S",
+        action="store",
+        dest="exponent",
+        type=float,
+        default=1.1,
+        help="Exponent of the Zipf distribution of the items",
+    )
+    parser.add_argument(
+        "--length",
+        metavar="N",
+        action="store",
+        dest="length",
+        type=int,
+        default=100000,
+        help="Items in each stream",
+    )
+    parser.add_argument(
+        "--capacity",
+        metavar="N",
+        action="store",
+        dest="capacity",
+        type=int,
+        default=topk.CAPACITY,
+        help="Counters of the Space-Saving summary",
+    )
+    parser.add_argument(
+        "--size",
+        metavar="K",
+        action="store",
+        dest="size",
+        type=int,
+        default=topk.SIZE,
+        help="Heaviest items compared",
+    )
+    args = parser.parse_args()
+
+    violations = 0
+    print("cardinality\tcounters\trecall\tmerged recall\tmax error\tmerged max error")
+    for cardinality in [int(n) for n in args.cardinalities.split(",")]:
+        result = evaluate(
+            cardinality=cardinality,
+            exponent=args.exponent,
+            length=args.length,
+            capacity=args.capacity,
+            k=args.size,
+        )
+        violations += result["violations"]
+        print(
+            "{cardinality}\t{counters}\t{single_recall:.2f}\t{merged_recall:.2f}\t"
+            "{single_max_error:.4%}\t{merged_max_error:.4%}".format(
+                cardinality=cardinality, **result
+            )
+        )
+    if violations > 0:
+        print("{n} estimates out of their error bound".format(n=violations))
+        sys.exit(1)